@@ -0,0 +1,84 @@
+"""
+Microbenchmark of UserMemory.add_message with a history held at a fixed size,
+so every call also evicts the oldest message. Compared with the original
+algorithm, which re-summed every message's tokens and trimmed with list.pop(0).
+
+    python benchmarks/add_message_scaling.py [--sizes 10000 100000 1000000] [--calls 2000]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="nyxie-bench-"))
+logging.disable(logging.CRITICAL)
+import bot  # noqa: E402
+
+TEXT = "kısa bir örnek mesaj"
+TOKENS = len(TEXT.split())
+
+
+def make_history(size):
+    timestamp = datetime.now().isoformat()
+    return [{"role": "user", "content": TEXT, "timestamp": timestamp, "tokens": TOKENS} for _ in range(size)]
+
+
+def legacy_add_message(user_data, max_tokens, content):
+    """The add_message body from before the change (persistence left out)."""
+    message = {"role": "user", "content": content, "timestamp": datetime.now().isoformat(), "tokens": len(content.split())}
+    user_data["total_tokens"] = sum(msg.get("tokens", 0) for msg in user_data["messages"])
+    while user_data["total_tokens"] > max_tokens and user_data["messages"]:
+        removed = user_data["messages"].pop(0)
+        user_data["total_tokens"] -= removed.get("tokens", 0)
+    user_data["messages"].append(message)
+
+
+def bench_legacy(size, calls):
+    user_data = {"messages": make_history(size), "total_tokens": 0}
+    max_tokens = size * TOKENS - TOKENS  # full: every call trims one message
+    started = time.perf_counter()
+    for _ in range(calls):
+        legacy_add_message(user_data, max_tokens, TEXT)
+    return (time.perf_counter() - started) / calls
+
+
+def bench_current(size, calls):
+    # Big enough cache budget that the benchmark user is never evicted
+    memory = bot.UserMemory(storage_mode="json", max_cached_bytes=1 << 40)
+    memory.max_tokens = size * TOKENS
+    data = memory.get_user_settings("1")
+    data["messages"] = deque(make_history(size))
+    data["total_tokens"] = size * TOKENS
+    started = time.perf_counter()
+    for _ in range(calls):
+        memory.add_message("1", "user", TEXT)
+    elapsed = (time.perf_counter() - started) / calls
+    assert len(data["messages"]) == size
+    # Nothing is written: no flusher runs and the benchmark directory is thrown away
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--legacy-calls", type=int, default=50, help="the old algorithm is O(n) per call")
+    args = parser.parse_args()
+
+    print(f"{'stored messages':>16}{'before':>14}{'after':>12}")
+    for size in args.sizes:
+        before = bench_legacy(size, args.legacy_calls)
+        after = bench_current(size, args.calls)
+        print(f"{size:>16,}{before * 1e6:>11.0f} us{after * 1e6:>9.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Measures how far apart image_dhash puts re-encoded copies of the same image and
+distinct images, to pick IMAGE_CACHE_MAX_DISTANCE. Each source image is
+recompressed and resized the way Telegram clients and forwards do it, plus a
+small crop, and compared with the original; every pair of sources is compared
+as "different". Point it at folders of real photos and screenshots.
+
+    python benchmarks/image_dhash_radius.py ~/Pictures [more paths ...] [--radii 6 8 10 12 14]
+"""
+import argparse
+import hashlib
+import io
+import itertools
+import logging
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from PIL import Image
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="nyxie-bench-"))
+logging.disable(logging.CRITICAL)
+import bot  # noqa: E402
+
+EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def load_images(paths):
+    seen, images = set(), []
+    for root in paths:
+        root = Path(root)
+        files = [root] if root.is_file() else sorted(p for p in root.rglob("*") if p.suffix.lower() in EXTENSIONS)
+        for path in files:
+            data = path.read_bytes()
+            digest = hashlib.sha1(data).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+            try:
+                with Image.open(io.BytesIO(data)) as img:
+                    img = img.convert("RGB")
+            except Exception:
+                continue
+            if min(img.size) >= 64:
+                images.append(img)
+    return images
+
+
+def jpeg(img, quality):
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def resized(img, max_side):
+    copy = img.copy()
+    copy.thumbnail((max_side, max_side), Image.LANCZOS)
+    return copy
+
+
+def variants(img):
+    """Copies a forwarded or re-uploaded image plausibly arrives as."""
+    rerecompressed = Image.open(io.BytesIO(jpeg(resized(img, 1280), 80))).convert("RGB")
+    width, height = img.size
+    dx, dy = width // 50, height // 50
+    return {
+        "1280px q87": jpeg(resized(img, 1280), 87),
+        "800px q70": jpeg(resized(img, 800), 70),
+        "320px q60": jpeg(resized(img, 320), 60),
+        "half size q50": jpeg(img.resize((width // 2, height // 2)), 50),
+        "1280 q80 -> 640 q60": jpeg(resized(rerecompressed, 640), 60),
+        "2% crop q85": jpeg(img.crop((dx, dy, width - dx, height - dy)), 85),
+    }
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--radii", type=int, nargs="+", default=[6, 8, 10, 12, 14])
+    args = parser.parse_args()
+
+    images = load_images(args.paths)
+    if len(images) < 2:
+        sys.exit("need at least two distinct images")
+
+    originals, same = [], {}
+    for img in images:
+        original = bot.image_dhash(jpeg(img, 95))
+        originals.append(original)
+        for name, data in variants(img).items():
+            same.setdefault(name, []).append(distance(original, bot.image_dhash(data)))
+    different = sorted(distance(a, b) for a, b in itertools.combinations(originals, 2))
+
+    print(f"{len(images)} images, {len(different)} distinct pairs (current radius {bot.IMAGE_CACHE_MAX_DISTANCE})")
+    print(f"{'same image':<22}{'mean':>7}{'p95':>6}{'max':>6}")
+    for name, values in same.items():
+        values.sort()
+        print(f"{name:<22}{sum(values) / len(values):>7.2f}{percentile(values, 0.95):>6}{values[-1]:>6}")
+    print(f"{'different images':<22}{'min':>7}{'p1':>6}{'p5':>6}")
+    print(f"{'':<22}{different[0]:>7}{percentile(different, 0.01):>6}{percentile(different, 0.05):>6}")
+
+    resize_only = [d for name, values in same.items() if "crop" not in name for d in values]
+    cropped = [d for name, values in same.items() if "crop" in name for d in values]
+    print(f"\n{'radius':>6}{'re-encode hit':>15}{'crop hit':>10}{'false hit':>11}")
+    for radius in args.radii:
+        hit = sum(d <= radius for d in resize_only) / len(resize_only)
+        crop_hit = sum(d <= radius for d in cropped) / len(cropped)
+        false_hit = sum(d <= radius for d in different) / len(different)
+        print(f"{radius:>6}{hit:>15.1%}{crop_hit:>10.1%}{false_hit:>11.2%}")
+
+
+if __name__ == "__main__":
+    main()
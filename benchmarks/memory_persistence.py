@@ -0,0 +1,113 @@
+"""
+Per-message cost of persisting UserMemory: the original synchronous full JSON
+rewrite on every add_message against the write-behind flusher, for each storage
+backend and a few history sizes.
+
+Reports, per added message: time the event loop is blocked (add_message plus
+the flusher's on-loop snapshot), bytes written to disk, and time spent writing
+in worker threads (off the loop).
+
+    python benchmarks/memory_persistence.py [--history 100 1000 10000] [--messages 200]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="nyxie-bench-"))
+logging.disable(logging.CRITICAL)
+import bot  # noqa: E402
+
+TEXT = "bu bir örnek mesajdır ve yaklaşık yirmi kelime içerir ki geçmiş gerçekçi bir boyutta olsun diye yazıldı tamam mı"
+
+
+def legacy_add_and_save(users, user_id, role, content, path):
+    """add_message + save_user_memory as they were before write-behind: sum, pop(0), full rewrite on the loop."""
+    message = {"role": "user" if role == "user" else "model", "content": content,
+               "timestamp": datetime.now().isoformat(), "tokens": len(content.split())}
+    users[user_id]["total_tokens"] = sum(msg.get("tokens", 0) for msg in users[user_id]["messages"])
+    while users[user_id]["total_tokens"] > 1048576 and users[user_id]["messages"]:
+        removed = users[user_id]["messages"].pop(0)
+        users[user_id]["total_tokens"] -= removed.get("tokens", 0)
+    users[user_id]["messages"].append(message)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(users[user_id], f, ensure_ascii=False, indent=2)
+        return f.tell()
+
+
+def run_legacy(history, messages):
+    path = Path(tempfile.mkdtemp(prefix="nyxie-legacy-")) / "user_1.json"
+    users = {"1": {"messages": [], "language": "tr", "total_tokens": 0}}
+    for i in range(history):
+        users["1"]["messages"].append({"role": "user", "content": TEXT, "timestamp": datetime.now().isoformat(), "tokens": 20})
+    blocked, written = 0.0, 0
+    for i in range(messages):
+        started = time.perf_counter()
+        written += legacy_add_and_save(users, "1", "user" if i % 2 == 0 else "assistant", TEXT, path)
+        blocked += time.perf_counter() - started
+    return blocked, written, 0.0
+
+
+async def run_write_behind(mode, history, messages, flush_interval):
+    os.chdir(tempfile.mkdtemp(prefix=f"nyxie-{mode}-"))
+    # Seed the history and store it, then measure a fresh process-like instance
+    seed = bot.UserMemory(storage_mode=mode)
+    for _ in range(history):
+        seed.add_message("1", "user", TEXT)
+    await seed.close()
+
+    memory = bot.UserMemory(storage_mode=mode, flush_interval=flush_interval)
+    memory.get_user_settings("1")  # load outside the measurement, as the first message of a session would
+    # The flusher snapshots each dirty user on the loop before writing in a thread; count that too
+    blocked = 0.0
+    prepare_write = memory.backend.prepare_write
+
+    def timed_prepare_write(*args, **kwargs):
+        nonlocal blocked
+        started = time.perf_counter()
+        try:
+            return prepare_write(*args, **kwargs)
+        finally:
+            blocked += time.perf_counter() - started
+    memory.backend.prepare_write = timed_prepare_write
+    memory.start_background_flush()
+    for i in range(messages):
+        started = time.perf_counter()
+        memory.add_message("1", "user" if i % 2 == 0 else "assistant", TEXT)
+        blocked += time.perf_counter() - started
+        if i % 2:
+            await asyncio.sleep(0.005)  # a reply's worth of other work between turns
+    await memory.close()
+    stats = memory.persistence_stats
+    return blocked, stats["bytes_written"], stats["write_seconds"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--history", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--flush-interval", type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages added per run; costs are per message")
+    print(f"{'storage':<22}{'history':>9}{'loop blocked':>15}{'bytes written':>15}{'off-loop write':>16}")
+    for history in args.history:
+        runs = [("json, rewrite per save", run_legacy(history, args.messages))]
+        for mode in ("json", "log", "sqlite"):
+            runs.append((f"{mode}, write-behind", asyncio.run(run_write_behind(mode, history, args.messages, args.flush_interval))))
+        for name, (blocked, written, offloop) in runs:
+            n = args.messages
+            print(f"{name:<22}{history:>9}{blocked / n * 1e6:>12.0f} us{written / n:>13.0f} B{offloop / n * 1e6:>13.0f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Peak RSS of video ingestion: the old inline-bytes path against the streaming
+temp-file + File API path of handle_video.
+
+Each run happens in a fresh process so ru_maxrss only reflects that run. A local
+HTTP server plays Telegram's file endpoint and a stand-in uploader reads the
+upload in 1 MB chunks like the resumable File API client does; nothing leaves
+the machine.
+
+    python benchmarks/video_ingest_rss.py [--size-mb 20] [--concurrency 1 4]
+"""
+import argparse
+import asyncio
+import base64
+import functools
+import hashlib
+import http.server
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:
+    sys.exit("resource module not available; run this on Linux or macOS")
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class LocalUploader:
+    async def upload(self, fileobj, mime_type):
+        digest = hashlib.sha256()
+
+        def read():
+            while chunk := fileobj.read(1 << 20):
+                digest.update(chunk)
+        await asyncio.to_thread(read)
+        return SimpleNamespace(name="files/local", mime_type=mime_type)
+
+    async def delete(self, uploaded):
+        pass
+
+
+def child(mode, concurrency, video_dir, size):
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+    sys.path.insert(0, str(ROOT))
+    os.chdir(tempfile.mkdtemp(prefix="nyxie-bench-"))
+    import bot
+    logging.disable(logging.CRITICAL)
+
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=video_dir)
+    http.server.SimpleHTTPRequestHandler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/video.mp4"
+
+    async def generate(task, contents, **kwargs):
+        part = contents[1]
+        if isinstance(part, dict):
+            base64.b64encode(part["data"])  # what the SDK does with inline bytes
+        return SimpleNamespace(prompt_feedback=None, text="ok")
+
+    async def send(update, text):
+        pass
+
+    async def old_handle_video(update, context):
+        # The previous implementation: whole download as bytearray, copied to bytes, sent inline
+        video_file = await context.bot.get_file(update.message.video.file_id)
+        video_bytes = bytes(await video_file.download_as_bytearray())
+        await generate("video", ["prompt", {"mime_type": "video/mp4", "data": video_bytes}])
+
+    class OldFile:
+        async def download_as_bytearray(self):
+            result = await bot.http_client.get(url, max_bytes=size + 1)
+            return bytearray(result.content)
+
+    async def get_file(file_id):
+        return OldFile() if mode == "old" else SimpleNamespace(file_path=url)
+
+    class Message:
+        caption = None
+        video = SimpleNamespace(file_id="video", file_size=size, mime_type="video/mp4")
+
+        async def reply_text(self, text):
+            print(f"unexpected reply: {text}", file=sys.stderr)
+
+    bot.video_uploader = LocalUploader()
+    bot.gemini_models.generate = generate
+    bot.split_and_send_message = send
+    bot.user_memory = bot.UserMemory()
+    context = SimpleNamespace(bot=SimpleNamespace(get_file=get_file))
+    handle = old_handle_video if mode == "old" else bot.handle_video
+
+    async def run():
+        baseline = peak_rss_mb()
+        started = time.monotonic()
+        await asyncio.gather(*(handle(SimpleNamespace(message=Message(), effective_user=SimpleNamespace(id=i)), context)
+                               for i in range(concurrency)))
+        elapsed = time.monotonic() - started
+        await bot.http_client.close()
+        await bot.user_memory.close()
+        peak = peak_rss_mb()
+        print(f"{mode:>6} x{concurrency}: peak RSS {peak:.0f} MB (+{peak - baseline:.0f} MB over import baseline), {elapsed:.2f}s")
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "CONCURRENCY"), help=argparse.SUPPRESS)
+    parser.add_argument("--video-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    size = args.size_mb * 1024 * 1024
+
+    if args.child:
+        child(args.child[0], int(args.child[1]), args.video_dir, size)
+        return
+
+    with tempfile.TemporaryDirectory() as video_dir:
+        with open(os.path.join(video_dir, "video.mp4"), "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+        print(f"{args.size_mb} MB video, one process per run")
+        for concurrency in args.concurrency:
+            for mode in ("old", "stream"):
+                subprocess.run([sys.executable, __file__, "--child", mode, str(concurrency),
+                                "--video-dir", video_dir, "--size-mb", str(args.size_mb)],
+                               check=True, stderr=subprocess.DEVNULL)
+
+
+if __name__ == "__main__":
+    main()
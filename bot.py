@@ -3,13 +3,15 @@ import json
 import logging
 import sys
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from google.cloud import vision
 from telegram import Update
 from telegram.constants import ChatAction
-from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler
-from datetime import datetime
+from telegram.ext import Application, MessageHandler, filters, ContextTypes, CommandHandler, BaseRateLimiter, BaseUpdateProcessor
+from telegram.error import BadRequest, RetryAfter
+from datetime import datetime, timedelta
 import base64
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 from dotenv import load_dotenv
 import langdetect
@@ -18,14 +20,37 @@ import calendar
 from zoneinfo import ZoneInfo
 import emoji
 import random
+import re
 from pathlib import Path
-import requests
 from geopy.geocoders import Nominatim
 from timezonefinder import TimezoneFinder
 import asyncio
+from collections import OrderedDict, deque
+import bisect
+import contextvars
+import heapq
+import functools
+import itertools
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from duckduckgo_search import DDGS
-import requests
+import httpx
+import httpcore
+import contextlib
+import codecs
+from html.parser import HTMLParser
+import ipaddress
+import socket
+from urllib.parse import urlsplit, urlunsplit, urljoin, parse_qsl, urlencode
+import hashlib
 from bs4 import BeautifulSoup # For fallback search result parsing
+try:
+    import resource  # Unix only; used to log peak memory of video jobs
+except ImportError:
+    resource = None
 
 # Configure logging
 logging.basicConfig(
@@ -37,10 +62,112 @@ logging.basicConfig(
     ]
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request URL at INFO, and Bot API / file URLs embed the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+BOT_TOKEN_PATTERN = re.compile(r'/bot\d+:[\w-]+')
+
+def redact_bot_token(text):
+    """Replace the bot token in Telegram API/file URLs so they can be logged."""
+    return BOT_TOKEN_PATTERN.sub('/bot<token>', text)
 
 # Load environment variables
 load_dotenv()
 
+# User memory persistence settings
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "5"))  # seconds between background flushes
+MEMORY_STORAGE = os.getenv("MEMORY_STORAGE", "json")  # "json", "log" or "sqlite"
+MEMORY_COMPACT_RATIO = float(os.getenv("MEMORY_COMPACT_RATIO", "0.5"))  # dead-record ratio that triggers log compaction
+MEMORY_SQLITE_PATH = os.getenv("MEMORY_SQLITE_PATH")  # defaults to user_memories/memory.db
+MEMORY_HISTORY_WINDOW = int(os.getenv("MEMORY_HISTORY_WINDOW", "200"))  # messages kept in RAM per user (sqlite)
+MEMORY_CACHE_MAX_USERS = int(os.getenv("MEMORY_CACHE_MAX_USERS", "1000"))  # users kept in RAM
+MEMORY_CACHE_MAX_BYTES = int(float(os.getenv("MEMORY_CACHE_MAX_MB", "256")) * 1024 * 1024)  # estimated RAM budget for cached users
+
+# Prompt assembly settings
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "32000"))  # target prompt size for chat replies
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "10"))  # history messages considered per reply
+CONTEXT_SEARCH_SHARE = 0.4  # share of the free budget always available to web search results
+
+# Language detection settings
+LANG_CONFIDENCE_THRESHOLD = float(os.getenv("LANG_CONFIDENCE_THRESHOLD", "0.9"))  # min langdetect probability before asking Gemini
+LANG_STICKY_MIN_STREAK = 2  # consecutive messages in one language before short messages reuse it
+LANG_STICKY_MAX_CHARS = 20  # messages shorter than this count as short
+
+# Emoji settings
+EMOJI_MODE = os.getenv("EMOJI_MODE", "local")  # "local" (lexicon), "llm" (async Gemini call) or "off"
+EMOJI_LLM_TIMEOUT = 3.0
+
+# Reply streaming
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # minimum seconds between edits of a streamed reply
+STREAM_FINISH_ATTEMPTS = 3  # final syncs of a streamed reply before the missing text is sent as new messages
+
+# Updates handled at the same time across all users (one at a time per user)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+
+# Outbound Telegram rate limits (messages per second)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_MAX_RETRIES = 3
+
+# Web search settings
+SEARCH_MAX_CONCURRENCY = int(os.getenv("SEARCH_MAX_CONCURRENCY", "8"))  # searches running at once, across all users
+SEARCH_QUERY_TIMEOUT = float(os.getenv("SEARCH_QUERY_TIMEOUT", "10"))  # seconds per query
+SEARCH_FALLBACK_URL = os.getenv("SEARCH_FALLBACK_URL", "https://www.google.com/search")
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "900"))  # seconds a cached result set stays fresh
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "500"))
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", "")  # SQLite file for the on-disk tier; empty disables it
+DEEP_SEARCH_MIN_NOVELTY = float(os.getenv("DEEP_SEARCH_MIN_NOVELTY", "0.3"))  # stop deep search when less new content than this arrives
+DEEP_SEARCH_FETCH_PAGES = int(os.getenv("DEEP_SEARCH_FETCH_PAGES", "3"))  # result pages read in full for deep search; 0 disables
+PAGE_FETCH_BUDGET = float(os.getenv("PAGE_FETCH_BUDGET", "8"))  # seconds for the whole page fetch stage
+PAGE_FETCH_MAX_BYTES = 512 * 1024  # per page
+PAGE_FETCH_HOST_INTERVAL = 1.0  # seconds between requests to the same host
+PAGE_FETCH_MAX_REDIRECTS = 5
+PAGE_TEXT_MAX_CHARS = 6000  # stop reading a page once this much main text has been extracted
+PAGE_PASSAGE_CHARS = 800
+SEARCH_SIMHASH_MAX_DISTANCE = 10  # snippets whose 64-bit SimHashes differ in at most this many bits are duplicates
+
+# Shared outbound HTTP client settings
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "6"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))  # seconds; connect is capped separately below
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_MAX_RESPONSE_BYTES = int(os.getenv("HTTP_MAX_RESPONSE_MB", "5")) * 1024 * 1024
+HTTP_DNS_CACHE_TTL = float(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_MAX_TRACKED_HOSTS = 1024  # hosts kept in the DNS cache and per-host limiters; the least recently used go first
+
+# Image preprocessing before upload to Gemini
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))  # longer side in pixels; picks the Telegram rendition and caps downscaling
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_KB", "512")) * 1024
+IMAGE_JPEG_QUALITIES = (85, 75, 65, 50)  # tried in order until the image fits IMAGE_MAX_BYTES
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "86400"))  # seconds an image analysis is reused
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "2000"))
+# Images whose 64-bit dHashes differ in at most this many bits count as the same image.
+# Measured with benchmarks/image_dhash_radius.py: recompress+resize copies mostly land at 0-7 bits
+# but can reach 12, a 2% crop up to 13; different images almost always differ in 17+ bits, yet a few
+# near-identical shots of one scene fall within 12. The cache is shared, so a false hit would show one
+# user's analysis to another: across users only the conservative radius counts, and the wider one
+# is limited to the user's own earlier images.
+IMAGE_CACHE_MAX_DISTANCE = int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "10"))
+IMAGE_CACHE_SAME_USER_DISTANCE = int(os.getenv("IMAGE_CACHE_SAME_USER_DISTANCE", "12"))
+
+# Video ingestion
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_MB", "20")) * 1024 * 1024  # the cloud Bot API serves at most 20 MB anyway
+VIDEO_MAX_CONCURRENT_JOBS = int(os.getenv("VIDEO_MAX_CONCURRENT_JOBS", "2"))  # videos downloaded/uploaded at once, across all users
+VIDEO_DOWNLOAD_TIMEOUT = 120.0
+VIDEO_PROCESSING_TIMEOUT = 120.0  # seconds to wait for Gemini to finish processing an uploaded video
+
+# Per-stage timeouts (seconds) for the chat turn pipeline
+STAGE_TIMEOUTS = {
+    "language": float(os.getenv("STAGE_TIMEOUT_LANGUAGE", "8")),
+    "history": 2.0,
+    "search_decision": float(os.getenv("STAGE_TIMEOUT_SEARCH_DECISION", "8")),
+    "search": float(os.getenv("STAGE_TIMEOUT_SEARCH", "30")),
+    "generate": float(os.getenv("STAGE_TIMEOUT_GENERATE", "90")),
+    "emoji": 5.0,
+}
+
 # Configure Gemini API with error handling
 api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
@@ -49,13 +176,536 @@ if not api_key:
 
 try:
     genai.configure(api_key=api_key)
-    # Test the configuration with a simple generation
-    model = genai.GenerativeModel('gemini-2.0-flash-lite')
     logging.info("Gemini API configured successfully")
 except Exception as e:
     logging.error(f"Failed to configure Gemini API: {str(e)}")
     raise
 
+# Rate limiting primitives
+class TokenBucket:
+    """Async token bucket; waiters are served in FIFO order."""
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+    def wait_time(self, amount=1):
+        """Seconds until `amount` tokens can be taken (0 if right now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max((amount - self.tokens) / self.rate, self.blocked_until - time.monotonic(), 0.0)
+
+    def take(self, amount=1):
+        """Take tokens without waiting; the balance may go negative (e.g. to settle an underestimate)."""
+        self._refill()
+        self.tokens -= min(amount, self.capacity) if amount > 0 else amount
+
+    def block_for(self, seconds):
+        """Hand out nothing for the next `seconds` (e.g. after a 429)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, amount=1):
+        """Wait until `amount` tokens are available and take them. Returns the seconds waited."""
+        started = time.monotonic()
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return time.monotonic() - started
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+# Gemini admission control
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "30"))  # requests per minute for the API key
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))  # input tokens per minute
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "50"))  # beyond this many waiting calls, non-interactive ones are shed
+PRIORITY_INTERACTIVE, PRIORITY_CLASSIFIER, PRIORITY_BACKGROUND = 0, 1, 2
+MEDIA_PART_TOKENS = {"image": 258, "video": 16000}  # rough input cost of an inline media part
+
+class GeminiOverloaded(Exception):
+    """A Gemini call was shed by the scheduler instead of waiting for quota."""
+
+class GeminiScheduler:
+    """
+    Admission control for all Gemini calls: requests-per-minute and tokens-per-minute
+    token buckets, with waiting calls served strictly by priority (interactive replies,
+    then classifiers, then deep search). Lower priorities give up after a maximum wait,
+    and are refused outright when the queue is full.
+    """
+    PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_CLASSIFIER: "classifier", PRIORITY_BACKGROUND: "background"}
+    MAX_WAIT = {PRIORITY_INTERACTIVE: None, PRIORITY_CLASSIFIER: 5.0, PRIORITY_BACKGROUND: 60.0}
+    WAIT_BUCKETS = (0.05, 0.25, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, rpm=GEMINI_RPM, tpm=GEMINI_TPM, max_queue=GEMINI_MAX_QUEUE):
+        # Small bursts only, so a minute never goes far over the quota
+        self.requests = TokenBucket(rpm / 60, max(1, rpm // 10))
+        self.tokens = TokenBucket(tpm / 60, max(1, tpm // 10))
+        self.max_queue = max_queue
+        self._queue = []  # heap of (priority, seq, tokens, deadline, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.peak_depth = 0
+        self.shed = {name: 0 for name in self.PRIORITY_NAMES.values()}
+        self.wait_histograms = {
+            name: [0] * (len(self.WAIT_BUCKETS) + 1) for name in self.PRIORITY_NAMES.values()
+        }
+
+    def _record_wait(self, priority, seconds):
+        histogram = self.wait_histograms[self.PRIORITY_NAMES[priority]]
+        histogram[bisect.bisect_left(self.WAIT_BUCKETS, seconds)] += 1
+
+    def _shed(self, priority, future=None):
+        self.shed[self.PRIORITY_NAMES[priority]] += 1
+        error = GeminiOverloaded(f"Gemini busy, {self.PRIORITY_NAMES[priority]} call shed")
+        if future is None:
+            raise error
+        future.set_exception(error)
+
+    def queue_depth(self):
+        depth = {name: 0 for name in self.PRIORITY_NAMES.values()}
+        for priority, _, _, _, future in self._queue:
+            if not future.done():
+                depth[self.PRIORITY_NAMES[priority]] += 1
+        return depth
+
+    async def admit(self, priority, tokens):
+        """Wait until the call may be sent and charge it to the buckets. Raises GeminiOverloaded when shed."""
+        started = time.monotonic()
+        if self.try_admit(priority, tokens):
+            return
+        if priority != PRIORITY_INTERACTIVE and len(self._queue) >= self.max_queue:
+            self._shed(priority)
+        max_wait = self.MAX_WAIT[priority]
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), tokens, started + max_wait if max_wait else None, future))
+        self.peak_depth = max(self.peak_depth, len(self._queue))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await future
+        self._record_wait(priority, time.monotonic() - started)
+
+    def try_admit(self, priority, tokens):
+        """Admit the call only if it needn't wait (nothing queued, quota available)."""
+        if self._queue or self.requests.wait_time() > 0 or self.tokens.wait_time(tokens) > 0:
+            return False
+        self.requests.take()
+        self.tokens.take(tokens)
+        self._record_wait(priority, 0.0)
+        return True
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Charge (or refund) the difference once the real prompt size is known."""
+        if actual_tokens:
+            self.tokens.take(actual_tokens - estimated_tokens)
+
+    def _expire(self, now):
+        expired = False
+        for priority, _, _, deadline, future in self._queue:
+            if deadline is not None and deadline <= now and not future.done():
+                self._shed(priority, future)
+                expired = True
+        if expired:
+            self._queue = [entry for entry in self._queue if not entry[4].done()]
+            heapq.heapify(self._queue)
+
+    async def _dispatch(self):
+        while self._queue:
+            now = time.monotonic()
+            self._expire(now)
+            if not self._queue:
+                break
+            priority, _, tokens, _, future = self._queue[0]
+            if future.done():
+                # Caller gave up (timeout or cancellation)
+                heapq.heappop(self._queue)
+                continue
+            delay = max(self.requests.wait_time(), self.tokens.wait_time(tokens))
+            if delay <= 0:
+                heapq.heappop(self._queue)
+                self.requests.take()
+                self.tokens.take(tokens)
+                future.set_result(None)
+                continue
+            deadlines = [entry[3] for entry in self._queue if entry[3] is not None]
+            if deadlines:
+                delay = min(delay, max(min(deadlines) - now, 0.0))
+            # Sleep until quota frees up, a deadline passes or a new call arrives
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def report(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "peak_depth": self.peak_depth,
+            "shed": self.shed,
+            "wait_histograms": {
+                name: dict(zip([f"<={bound}s" for bound in self.WAIT_BUCKETS] + ["more"], counts))
+                for name, counts in self.wait_histograms.items()
+            },
+        }
+
+def estimate_request_tokens(contents):
+    """Rough input size of a generate_content request, for TPM accounting."""
+    if isinstance(contents, str):
+        return token_counter.count(contents)
+    total = 0
+    for part in contents:
+        if isinstance(part, str):
+            total += token_counter.count(part)
+        elif isinstance(part, dict):
+            total += MEDIA_PART_TOKENS.get(str(part.get("mime_type", "")).split('/')[0], 1000)
+        elif hasattr(part, "mime_type"):  # uploaded file reference
+            total += MEDIA_PART_TOKENS.get(str(part.mime_type).split('/')[0], 1000)
+    return total
+
+# Gemini call resilience
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2"))  # retries on transient errors (5xx, 429, timeouts)
+GEMINI_RETRY_BASE_DELAY = 0.5  # seconds; full jitter, doubled per attempt
+GEMINI_RETRY_MAX_DELAY = 4.0
+GEMINI_HEDGE_AFTER = float(os.getenv("GEMINI_HEDGE_AFTER", "0"))  # send a duplicate of slow "hedge" calls after this many seconds; 0 disables
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))  # consecutive failures that open the circuit
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))  # seconds before a trial call is let through
+GEMINI_BREAKER_MIN_TIMEOUT = 30.0  # our own timeouts only count as Gemini failures for tasks allowed at least this long
+TURN_DEADLINE = float(os.getenv("TURN_DEADLINE", "120"))  # seconds for all Gemini calls of one chat/image/video turn
+DEEP_SEARCH_DEADLINE = float(os.getenv("DEEP_SEARCH_DEADLINE", "240"))
+
+# Deadline of the current turn; asyncio tasks copy it from the task that starts them
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+def start_deadline(seconds):
+    """Give the current task, and the tasks it starts, `seconds` for all their Gemini calls."""
+    request_deadline.set(time.monotonic() + seconds)
+
+def remaining_time():
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+class GeminiUnavailable(Exception):
+    """Gemini is failing; the circuit breaker is open and calls fail fast."""
+
+TRANSIENT_GEMINI_ERRORS = (
+    asyncio.TimeoutError, ConnectionError,
+    google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded, google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests, google_exceptions.Aborted,
+)
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive transient failures; while open, calls fail
+    fast. After `cooldown` one trial call is let through (half-open): success closes
+    the circuit, failure opens it again.
+    """
+    def __init__(self, threshold=GEMINI_BREAKER_THRESHOLD, cooldown=GEMINI_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self.stats = {"opened": 0, "fast_failures": 0}
+
+    def allow(self):
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.stats["fast_failures"] += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._trial_in_flight:
+                self.stats["fast_failures"] += 1
+                return False
+            self._trial_in_flight = True
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            if self.state != "open":
+                self.stats["opened"] += 1
+                logging.error(f"Gemini circuit opened after {self.failures} consecutive failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # A trial call was cancelled before it told us anything
+        self._trial_in_flight = False
+
+# Per-task Gemini model settings. Tasks with identical settings share one model object.
+# Optional keys: "generation_config", "safety_settings"; "timeout" is in seconds (None = no limit).
+# "cache": True memoizes generate_text() results; only use it for deterministic (temperature 0) tasks.
+# "priority" orders calls waiting for quota (see GeminiScheduler).
+# "hedge": True sends a duplicate request when the first is slower than GEMINI_HEDGE_AFTER (short, idempotent calls only).
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-lite")
+CLASSIFIER_CONFIG = {"temperature": 0}
+MODEL_TASKS = {
+    "chat": {"model": GEMINI_MODEL, "timeout": None, "priority": PRIORITY_INTERACTIVE},  # bounded by STAGE_TIMEOUTS["generate"]
+    "deep_search": {"model": GEMINI_MODEL, "timeout": 60.0, "priority": PRIORITY_BACKGROUND},
+    "search_queries": {"model": GEMINI_MODEL, "timeout": 10.0, "priority": PRIORITY_CLASSIFIER, "hedge": True},
+    "search_decision": {"model": GEMINI_MODEL, "timeout": 8.0, "priority": PRIORITY_CLASSIFIER,
+                        "generation_config": CLASSIFIER_CONFIG, "cache": True, "hedge": True},
+    "language": {"model": GEMINI_MODEL, "timeout": 8.0, "priority": PRIORITY_CLASSIFIER,
+                 "generation_config": CLASSIFIER_CONFIG, "cache": True, "hedge": True},
+    "emoji": {"model": GEMINI_MODEL, "timeout": EMOJI_LLM_TIMEOUT, "priority": PRIORITY_CLASSIFIER,
+              "generation_config": CLASSIFIER_CONFIG, "cache": True},
+    "image": {"model": GEMINI_MODEL, "timeout": 60.0, "priority": PRIORITY_INTERACTIVE},
+    "video": {"model": GEMINI_MODEL, "timeout": 120.0, "priority": PRIORITY_INTERACTIVE},
+}
+
+CLASSIFIER_CACHE_TTL = float(os.getenv("CLASSIFIER_CACHE_TTL", "3600"))  # seconds
+CLASSIFIER_CACHE_MAX_ENTRIES = 5000
+CLASSIFIER_CACHE_MAX_BYTES = int(os.getenv("CLASSIFIER_CACHE_MAX_MB", "16")) * 1024 * 1024
+
+class ResponseCache:
+    """
+    Content-addressed LRU+TTL cache for classifier-style Gemini answers. Keys hash
+    the task, model, generation config and the whitespace-normalized prompt, so a
+    hit returns exactly the text a fresh deterministic call would.
+    """
+    def __init__(self, ttl=CLASSIFIER_CACHE_TTL, max_entries=CLASSIFIER_CACHE_MAX_ENTRIES, max_bytes=CLASSIFIER_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (text, expires_at, size)
+        self._bytes = 0
+        self.stats = {}  # task -> {"hits": n, "misses": n}
+
+    @staticmethod
+    def make_key(task, config, prompt):
+        normalized = ' '.join(prompt.split())
+        material = f"{task}\0{config['model']}\0{config.get('generation_config')!r}\0{normalized}"
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _count(self, task, outcome):
+        self.stats.setdefault(task, {"hits": 0, "misses": 0})[outcome] += 1
+
+    def get(self, task, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(key)
+            self._count(task, "hits")
+            return entry[0]
+        if entry is not None:
+            self._remove(key)
+        self._count(task, "misses")
+        return None
+
+    def put(self, key, text):
+        if key in self._entries:
+            self._remove(key)
+        size = len(key) + len(text.encode('utf-8'))
+        self._entries[key] = (text, time.monotonic() + self.ttl, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def report(self):
+        tasks = {
+            task: {**counts, "hit_rate": round(counts["hits"] / (counts["hits"] + counts["misses"]), 3)}
+            for task, counts in self.stats.items() if counts["hits"] + counts["misses"]
+        }
+        return {"tasks": tasks, "entries": len(self._entries), "bytes": self._bytes}
+
+class ModelRegistry:
+    """
+    Builds each configured GenerativeModel once and hands it out per task. The
+    google-generativeai client (and its connection) is shared by all models;
+    warmup() opens it at startup so the first user message doesn't pay for it.
+    """
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self._models = {}
+        self.cache = ResponseCache()
+        self.scheduler = GeminiScheduler()
+        self.breaker = CircuitBreaker()
+        self.stats = {"retries": 0, "hedged": 0, "hedge_wins": 0, "uncounted_timeouts": 0}
+
+    def get(self, task):
+        config = self.tasks[task]
+        key = (config["model"], repr(config.get("generation_config")), repr(config.get("safety_settings")))
+        model = self._models.get(key)
+        if model is None:
+            model = self._models[key] = genai.GenerativeModel(
+                config["model"],
+                generation_config=config.get("generation_config"),
+                safety_settings=config.get("safety_settings"),
+            )
+        return model
+
+    def _call_timeout(self, config):
+        """The task's timeout, shortened to what is left of the turn's deadline."""
+        timeout = config.get("timeout")
+        remaining = remaining_time()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise asyncio.TimeoutError("turn deadline exceeded")
+        return remaining if timeout is None else min(timeout, remaining)
+
+    async def _call(self, task, contents, timeout, **kwargs):
+        call = self.get(task).generate_content_async(contents, **kwargs)
+        return await (call if timeout is None else asyncio.wait_for(call, timeout=timeout))
+
+    async def _hedged_call(self, task, contents, timeout, priority, estimated_tokens, **kwargs):
+        first = asyncio.ensure_future(self._call(task, contents, timeout, **kwargs))
+        done, _ = await asyncio.wait({first}, timeout=GEMINI_HEDGE_AFTER)
+        # Don't spend quota on a duplicate when calls are already waiting for it
+        if done or not self.scheduler.try_admit(priority, estimated_tokens):
+            return await first
+        self.stats["hedged"] += 1
+        second = asyncio.ensure_future(self._call(task, contents, None if timeout is None else max(timeout - GEMINI_HEDGE_AFTER, 0.1), **kwargs))
+        pending = {first, second}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    if finished.exception() is None:
+                        if finished is second:
+                            self.stats["hedge_wins"] += 1
+                        return finished.result()
+                if not pending:
+                    # Both failed; report the original request's error
+                    return first.result()
+        finally:
+            for request in pending:
+                request.cancel()
+
+    async def generate(self, task, contents, **kwargs):
+        """
+        generate_content_async for a task: admitted by the scheduler, bounded by the
+        task timeout and the turn deadline, retried with jitter on transient errors,
+        optionally hedged, and failing fast with GeminiUnavailable while the circuit is open.
+        """
+        config = self.tasks[task]
+        priority = config.get("priority", PRIORITY_INTERACTIVE)
+        estimated_tokens = estimate_request_tokens(contents)
+        hedge = config.get("hedge") and GEMINI_HEDGE_AFTER > 0 and not kwargs.get("stream")
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            if not self.breaker.allow():
+                raise GeminiUnavailable(f"Gemini circuit open, {task} call not sent")
+            try:
+                # Waiting for quota counts against the deadline but says nothing about Gemini's health
+                timeout = self._call_timeout(config)
+                admission = self.scheduler.admit(priority, estimated_tokens)
+                await (admission if timeout is None else asyncio.wait_for(admission, timeout=timeout))
+                timeout = self._call_timeout(config)
+            except BaseException:
+                self.breaker.release()
+                raise
+            # A timeout only says Gemini is unhealthy if the call had its task's full, generous
+            # budget; one cut short by the caller's deadline, or a short classifier budget,
+            # must not open the circuit for everyone
+            full_timeout = config.get("timeout")
+            timeout_is_failure = full_timeout is not None and timeout == full_timeout and full_timeout >= GEMINI_BREAKER_MIN_TIMEOUT
+            outcome_recorded = False
+            try:
+                if hedge:
+                    response = await self._hedged_call(task, contents, timeout, priority, estimated_tokens, **kwargs)
+                else:
+                    response = await self._call(task, contents, timeout, **kwargs)
+                self.breaker.record_success()
+                outcome_recorded = True
+            except Exception as e:
+                if not isinstance(e, TRANSIENT_GEMINI_ERRORS):
+                    # Gemini answered (bad request, blocked, token limit...): it is healthy
+                    self.breaker.record_success()
+                    outcome_recorded = True
+                    raise
+                if isinstance(e, asyncio.TimeoutError) and not timeout_is_failure:
+                    self.stats["uncounted_timeouts"] += 1
+                else:
+                    self.breaker.record_failure()
+                    outcome_recorded = True
+                    if self.breaker.state == "open":
+                        raise GeminiUnavailable(f"Gemini circuit open after {task} call failed: {e!r}") from e
+                delay = random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+                remaining = remaining_time()
+                if attempt == GEMINI_MAX_RETRIES or (remaining is not None and delay >= remaining):
+                    raise
+                if isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+                    # Quota errors: hold everyone back, not just this call
+                    self.scheduler.requests.block_for(delay)
+                self.stats["retries"] += 1
+                logging.warning(f"Gemini {task} call failed ({e!r}), retry {attempt + 1}/{GEMINI_MAX_RETRIES} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if not outcome_recorded:
+                    self.breaker.release()
+            if not kwargs.get("stream"):
+                usage = getattr(response, 'usage_metadata', None)
+                self.scheduler.settle(estimated_tokens, getattr(usage, 'prompt_token_count', 0) if usage else 0)
+            return response
+
+    async def generate_text(self, task, prompt):
+        """Text answer for a text prompt, served from the response cache for tasks with "cache": True.
+        Returns None when the prompt is blocked."""
+        config = self.tasks[task]
+        key = None
+        if config.get("cache"):
+            key = self.cache.make_key(task, config, prompt)
+            cached = self.cache.get(task, key)
+            if cached is not None:
+                return cached
+        response = await self.generate(task, prompt)
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            logging.warning(f"Gemini {task} prompt blocked: {response.prompt_feedback.block_reason}")
+            return None
+        text = response.text
+        if key is not None:
+            self.cache.put(key, text)
+        return text
+
+    async def warmup(self):
+        started = time.monotonic()
+        warmed = set()
+        for task, config in self.tasks.items():
+            model = self.get(task)
+            if config["model"] in warmed:
+                continue
+            warmed.add(config["model"])
+            try:
+                # count_tokens is free and opens the same async channel generate_content uses
+                await asyncio.wait_for(model.count_tokens_async("ping"), timeout=10)
+            except Exception as e:
+                logging.warning(f"Gemini warmup failed for {config['model']}: {e}")
+        logging.info(f"Gemini models ready: {len(self._models)} model(s) for {len(self.tasks)} tasks, warmup {time.monotonic() - started:.2f}s")
+
+gemini_models = ModelRegistry(MODEL_TASKS)
+
 # Time-aware personality context (same as before)
 def get_time_aware_personality(current_time, user_lang, timezone_name):
     """Generate a dynamic, context-aware personality prompt"""
@@ -141,83 +791,714 @@ def get_day_period(hour):
     else:
         return "Night"
 
+# User memory storage backends
+def default_user_memory():
+    return {
+        "messages": [],
+        "language": "tr",
+        "current_topic": None,
+        "total_tokens": 0,
+        "preferences": {
+            "custom_language": None,
+            "timezone": "Europe/Istanbul"
+        }
+    }
+
+def write_file_atomic(path, payload):
+    """Atomically replace path with payload (temp file + rename)."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(payload)
+
+class MemoryBackend:
+    """
+    Storage interface used by UserMemory.
+
+    load() and prepare_write() run on the event loop and must stay cheap;
+    write() runs in a worker thread and receives only the job built by
+    prepare_write(), never the live user dict.
+    """
+    name = "base"
+    # True when load() returns only the most recent messages (older ones stay on disk)
+    partial_history = False
+
+    def load(self, user_id):
+        """
+        Return a dict with "data" (the user memory), "disk_count" (live messages
+        stored on disk), "offloaded_tokens" (token counts of stored messages not
+        included in data["messages"], oldest first) and "rewrite" (whether the
+        stored copy has to be rewritten in full). Return None for unknown users.
+        """
+        raise NotImplementedError
+
+    def prepare_write(self, user_id, data, change, offloaded_tokens=()):
+        """Build a write job from the pending change record; runs on the event loop."""
+        raise NotImplementedError
+
+    def write(self, job):
+        """Persist a job built by prepare_write() and return the number of bytes written."""
+        raise NotImplementedError
+
+    def recent_messages(self, user_id, limit, before=None):
+        """Return up to `limit` stored messages older than the `before` timestamp, oldest first."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class JsonMemoryBackend(MemoryBackend):
+    """One JSON document per user (user_<id>.json)."""
+    name = "json"
+
+    def __init__(self, memory_dir):
+        self.memory_dir = Path(memory_dir)
+
+    def get_user_file_path(self, user_id):
+        return self.memory_dir / f"user_{user_id}.json"
+
+    def load(self, user_id):
+        user_file = self.get_user_file_path(user_id)
+        if not user_file.exists():
+            return None
+        with open(user_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {"data": data, "disk_count": len(data.get("messages", [])), "offloaded_tokens": [], "rewrite": False}
+
+    def prepare_write(self, user_id, data, change, offloaded_tokens=()):
+        # Shallow copy on the event loop so the writer thread never sees a dict
+        # that is being mutated. Message dicts are never modified after creation.
+        document = dict(data)
+        document["messages"] = list(data.get("messages", []))
+        if isinstance(data.get("preferences"), dict):
+            document["preferences"] = dict(data["preferences"])
+        return {"user_id": user_id, "document": document}
+
+    def write(self, job):
+        payload = json.dumps(job["document"], ensure_ascii=False, indent=2).encode('utf-8')
+        return write_file_atomic(self.get_user_file_path(job["user_id"]), payload)
+
+    def recent_messages(self, user_id, limit, before=None):
+        loaded = self.load(user_id)
+        messages = loaded["data"].get("messages", []) if loaded else []
+        if before is not None:
+            messages = [msg for msg in messages if msg.get("timestamp", "") < before]
+        return messages[-limit:] if limit else []
+
+def snapshot_user_settings(data):
+    settings = {key: value for key, value in data.items() if key not in ("messages", "total_tokens")}
+    if isinstance(settings.get("preferences"), dict):
+        settings["preferences"] = dict(settings["preferences"])
+    return settings
+
+class LogMemoryBackend(MemoryBackend):
+    """Append-only message log (user_<id>.log) plus a settings sidecar (user_<id>.settings.json)."""
+    name = "log"
+
+    def __init__(self, memory_dir, compact_ratio=MEMORY_COMPACT_RATIO, compact_min_records=100):
+        self.memory_dir = Path(memory_dir)
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self.legacy = JsonMemoryBackend(memory_dir)
+        self._records = {}  # user_id -> lines in the log file
+        self.compactions = 0
+
+    def get_user_log_path(self, user_id):
+        return self.memory_dir / f"user_{user_id}.log"
+
+    def get_user_settings_path(self, user_id):
+        return self.memory_dir / f"user_{user_id}.settings.json"
+
+    def load(self, user_id):
+        log_file = self.get_user_log_path(user_id)
+        settings_file = self.get_user_settings_path(user_id)
+
+        if not log_file.exists() and not settings_file.exists():
+            legacy = self.legacy.load(user_id)
+            if legacy is None:
+                return None
+            # Migrate: the flusher writes the full log and sidecar on the next flush
+            logger.info(f"Migrating memory of user {user_id} to the message log format")
+            self._records[user_id] = 0
+            legacy["disk_count"] = 0
+            legacy["rewrite"] = True
+            return legacy
+
+        data = default_user_memory()
+        if settings_file.exists():
+            with open(settings_file, 'r', encoding='utf-8') as f:
+                data.update(json.load(f))
+
+        messages, start, records, corrupt = self._read_log(log_file)
+        data["messages"] = messages[start:]
+        data["total_tokens"] = sum(msg.get("tokens", 0) for msg in data["messages"])
+        self._records[user_id] = records
+        # Compact a damaged log on the first flush so the bad bytes don't stay on disk
+        return {"data": data, "disk_count": len(data["messages"]), "offloaded_tokens": [], "rewrite": corrupt > 0}
+
+    def _read_log(self, log_file):
+        messages, start, records, corrupt = [], 0, 0, 0
+        if not log_file.exists():
+            return messages, start, records, corrupt
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn last line from an interrupted append
+                    logger.warning(f"Skipping corrupt record in {log_file}")
+                    corrupt += 1
+                    continue
+                records += 1
+                if "drop" in record:
+                    start = min(start + record["drop"], len(messages))
+                else:
+                    messages.append(record)
+        return messages, start, records, corrupt
+
+    def prepare_write(self, user_id, data, change, offloaded_tokens=()):
+        job = {"user_id": user_id}
+        if change["settings"] or change["rewrite"]:
+            job["settings"] = snapshot_user_settings(data)
+
+        messages = data["messages"]
+        records = self._records.get(user_id, 0) + len(change["appended"]) + (1 if change["dropped"] else 0)
+        dead_ratio = (records - len(messages)) / records if records else 0.0
+        if change["rewrite"] or (records >= self.compact_min_records and dead_ratio > self.compact_ratio):
+            job["rewrite"] = list(messages)
+            records = len(messages)
+        else:
+            job["dropped"] = change["dropped"]
+            job["appended"] = list(change["appended"])
+        self._records[user_id] = records
+        return job
+
+    def _encode_records(self, records):
+        return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode('utf-8')
+
+    def write(self, job):
+        user_id = job["user_id"]
+        written = 0
+        if "rewrite" in job:
+            written += write_file_atomic(self.get_user_log_path(user_id), self._encode_records(job["rewrite"]))
+            self.compactions += 1
+        elif job["dropped"] or job["appended"]:
+            records = ([{"drop": job["dropped"]}] if job["dropped"] else []) + job["appended"]
+            payload = self._encode_records(records)
+            self.memory_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.get_user_log_path(user_id), 'a+b') as f:
+                # After a torn append the file lacks its final newline; don't glue the next record onto it
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        payload = b"\n" + payload
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            written += len(payload)
+        if "settings" in job:
+            payload = json.dumps(job["settings"], ensure_ascii=False, indent=2).encode('utf-8')
+            written += write_file_atomic(self.get_user_settings_path(user_id), payload)
+        legacy_file = self.legacy.get_user_file_path(user_id)
+        if "rewrite" in job and legacy_file.exists():
+            # Keep the original document around instead of deleting it
+            os.replace(legacy_file, legacy_file.with_name(legacy_file.name + ".migrated"))
+        return written
+
+    def recent_messages(self, user_id, limit, before=None):
+        messages, start, _, _ = self._read_log(self.get_user_log_path(user_id))
+        messages = messages[start:]
+        if before is not None:
+            messages = [msg for msg in messages if msg.get("timestamp", "") < before]
+        return messages[-limit:] if limit else []
+
+class SQLiteMemoryBackend(MemoryBackend):
+    """
+    Single SQLite database in WAL mode. Only the most recent `history_window`
+    messages are loaded per user; older ones are read on demand with an
+    indexed (user_id, timestamp) query.
+    """
+    name = "sqlite"
+    partial_history = True
+
+    def __init__(self, db_path, history_window=MEMORY_HISTORY_WINDOW):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.history_window = history_window
+        # Loads run on the event loop and writes in worker threads; one lock serializes access
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    tokens INTEGER NOT NULL DEFAULT 0
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages (user_id, timestamp)")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS settings (
+                    user_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                )""")
+
+    @staticmethod
+    def _row_to_message(row):
+        return {"role": row["role"], "content": row["content"], "timestamp": row["timestamp"], "tokens": row["tokens"]}
+
+    def load(self, user_id):
+        with self._lock:
+            settings_row = self._conn.execute("SELECT data FROM settings WHERE user_id = ?", (user_id,)).fetchone()
+            if settings_row is None:
+                return None
+            recent = self._conn.execute(
+                "SELECT role, content, timestamp, tokens FROM messages WHERE user_id = ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_id, self.history_window)
+            ).fetchall()
+            # Token counts of everything older than the window, without reading message bodies
+            older = self._conn.execute(
+                "SELECT tokens FROM messages WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?",
+                (user_id, self.history_window)
+            ).fetchall()
+
+        data = default_user_memory()
+        data.update(json.loads(settings_row["data"]))
+        data["messages"] = [self._row_to_message(row) for row in reversed(recent)]
+        offloaded_tokens = [row["tokens"] for row in reversed(older)]
+        data["total_tokens"] = sum(msg["tokens"] for msg in data["messages"]) + sum(offloaded_tokens)
+        return {
+            "data": data,
+            "disk_count": len(recent) + len(older),
+            "offloaded_tokens": offloaded_tokens,
+            "rewrite": False,
+        }
+
+    def prepare_write(self, user_id, data, change, offloaded_tokens=()):
+        job = {"user_id": user_id, "dropped": change["dropped"], "appended": list(change["appended"])}
+        if change["settings"] or change["rewrite"]:
+            job["settings"] = snapshot_user_settings(data)
+        if change["rewrite"]:
+            job["rewrite"] = list(data["messages"])
+            job["older_count"] = len(offloaded_tokens)
+        return job
+
+    def _insert_messages(self, user_id, messages):
+        self._conn.executemany(
+            "INSERT INTO messages (user_id, role, content, timestamp, tokens) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, msg["role"], msg["content"], msg["timestamp"], msg.get("tokens", 0)) for msg in messages]
+        )
+        return sum(len(msg["content"].encode('utf-8')) for msg in messages)
+
+    def _write_settings(self, user_id, settings):
+        payload = json.dumps(settings, ensure_ascii=False)
+        self._conn.execute(
+            "INSERT INTO settings (user_id, data) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+            (user_id, payload)
+        )
+        return len(payload.encode('utf-8'))
+
+    def write(self, job):
+        user_id = job["user_id"]
+        written = 0
+        with self._lock, self._conn:
+            if "rewrite" in job:
+                # Only the loaded window is known in memory: replace it and keep
+                # the newest `older_count` stored messages that precede it
+                if job["rewrite"]:
+                    boundary = job["rewrite"][0]["timestamp"]
+                    self._conn.execute("DELETE FROM messages WHERE user_id = ? AND timestamp >= ?", (user_id, boundary))
+                    self._conn.execute(
+                        "DELETE FROM messages WHERE id IN ("
+                        "SELECT id FROM messages WHERE user_id = ? AND timestamp < ? "
+                        "ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?)",
+                        (user_id, boundary, job["older_count"])
+                    )
+                elif not job["older_count"]:
+                    self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+                written += self._insert_messages(user_id, job["rewrite"])
+            else:
+                if job["dropped"]:
+                    self._conn.execute(
+                        "DELETE FROM messages WHERE id IN ("
+                        "SELECT id FROM messages WHERE user_id = ? ORDER BY timestamp, id LIMIT ?)",
+                        (user_id, job["dropped"])
+                    )
+                if job["appended"]:
+                    written += self._insert_messages(user_id, job["appended"])
+            if "settings" in job:
+                written += self._write_settings(user_id, job["settings"])
+        return written
+
+    def recent_messages(self, user_id, limit, before=None):
+        query = "SELECT role, content, timestamp, tokens FROM messages WHERE user_id = ?"
+        params = [user_id]
+        if before is not None:
+            query += " AND timestamp < ?"
+            params.append(before)
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [self._row_to_message(row) for row in reversed(rows)]
+
+    def import_users(self, users):
+        """Bulk import (user_id, data) pairs in a single transaction, replacing existing rows."""
+        imported = 0
+        with self._lock, self._conn:
+            for user_id, data in users:
+                self._conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+                self._insert_messages(user_id, data.get("messages", []))
+                self._write_settings(user_id, snapshot_user_settings(data))
+                imported += 1
+        return imported
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def create_memory_backend(storage_mode, memory_dir):
+    if storage_mode == "sqlite":
+        return SQLiteMemoryBackend(MEMORY_SQLITE_PATH or Path(memory_dir) / "memory.db")
+    if storage_mode == "log":
+        return LogMemoryBackend(memory_dir)
+    if storage_mode != "json":
+        logger.warning(f"Unknown MEMORY_STORAGE '{storage_mode}', falling back to json")
+    return JsonMemoryBackend(memory_dir)
+
+def estimate_message_bytes(message):
+    # Rough in-RAM footprint: dict + string objects plus the content itself
+    return 400 + len(message.get("content", ""))
+
+def estimate_user_bytes(data, offloaded_tokens=()):
+    return 1024 + sum(estimate_message_bytes(msg) for msg in data.get("messages", [])) + 36 * len(offloaded_tokens)
+
+class UserCache:
+    """LRU cache of loaded user memories, bounded by user count and estimated bytes."""
+
+    def __init__(self, max_users=MEMORY_CACHE_MAX_USERS, max_bytes=MEMORY_CACHE_MAX_BYTES, on_evict=None):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._entries = OrderedDict()  # user_id -> user memory, least recently used first
+        self._sizes = {}
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "dirty_evictions": 0}
+
+    def __contains__(self, user_id):
+        return user_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, user_id):
+        return self._entries[user_id]
+
+    def get(self, user_id):
+        """Look up a user, counting the hit or miss and marking it most recently used."""
+        data = self._entries.get(user_id)
+        if data is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self._entries.move_to_end(user_id)
+        return data
+
+    def peek(self, user_id):
+        """Look up a user without touching LRU order or counters."""
+        return self._entries.get(user_id)
+
+    def put(self, user_id, data, size):
+        self.pop(user_id)
+        self._entries[user_id] = data
+        self._sizes[user_id] = size
+        self.total_bytes += size
+        self._evict()
+
+    def resize(self, user_id, delta):
+        if user_id in self._sizes:
+            self._sizes[user_id] += delta
+            self.total_bytes += delta
+            if delta > 0:
+                self._evict()
+
+    def pop(self, user_id):
+        data = self._entries.pop(user_id, None)
+        if data is not None:
+            self.total_bytes -= self._sizes.pop(user_id)
+        return data
+
+    def _evict(self):
+        # The most recently used entry is never evicted, even if it alone exceeds the budget
+        while len(self._entries) > 1 and (len(self._entries) > self.max_users or self.total_bytes > self.max_bytes):
+            user_id, data = self._entries.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(user_id)
+            self.stats["evictions"] += 1
+            if self.on_evict is not None and self.on_evict(user_id, data):
+                self.stats["dirty_evictions"] += 1
+
 # UserMemory class (same as before)
 class UserMemory:
-    def __init__(self):
-        self.users = {}
+    def __init__(self, flush_interval=MEMORY_FLUSH_INTERVAL, storage_mode=MEMORY_STORAGE, backend=None,
+                 max_cached_users=MEMORY_CACHE_MAX_USERS, max_cached_bytes=MEMORY_CACHE_MAX_BYTES):
+        self.users = UserCache(max_cached_users, max_cached_bytes, on_evict=self._on_evict)
         self.memory_dir = "user_memories"
         self.max_tokens = 1048576
         # Ensure memory directory exists on initialization
         Path(self.memory_dir).mkdir(parents=True, exist_ok=True)
+        self.backend = backend or create_memory_backend(storage_mode, self.memory_dir)
+        # Write-behind state: pending changes per user since the last flush
+        self.flush_interval = flush_interval
+        self._dirty = {}
+        self._evicting = {}  # dirty users evicted from the cache, kept until their next flush
+        self._flushing = set()  # users whose write is in flight
+        self._disk_counts = {}  # user_id -> live messages stored on disk after the last flush
+        self._offloaded_tokens = {}  # user_id -> token counts of stored messages not kept in RAM
+        self._flush_lock = asyncio.Lock()
+        self._flush_requested = asyncio.Event()
+        self._flush_task = None
+        self.persistence_stats = {
+            "marked": 0,          # changes recorded
+            "coalesced": 0,       # changes absorbed by an already pending write
+            "flushes": 0,         # user writes completed
+            "bytes_written": 0,
+            "write_seconds": 0.0,  # time spent writing, off the event loop
+            "mark_seconds": 0.0,   # time spent on the event loop marking users dirty
+        }
 
-    def get_user_settings(self, user_id):
-        user_id = str(user_id)
-        if user_id not in self.users:
+    @property
+    def storage_mode(self):
+        return self.backend.name
+
+    def cache_stats(self):
+        """Cache counters and current footprint, for sizing MEMORY_CACHE_MAX_USERS/MB."""
+        stats = dict(self.users.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["users"] = len(self.users)
+        stats["estimated_bytes"] = self.users.total_bytes
+        stats["pending_evictions"] = len(self._evicting)
+        return stats
+
+    def _get_user(self, user_id):
+        data = self.users.get(user_id)
+        if data is None:
             self.load_user_memory(user_id)
-        return self.users[user_id]
+            data = self.users.peek(user_id)
+        return data
+
+    def get_user_settings(self, user_id):
+        return self._get_user(str(user_id))
 
     def update_user_settings(self, user_id, settings_dict):
         user_id = str(user_id)
-        if user_id not in self.users:
-            self.load_user_memory(user_id)
-        self.users[user_id].update(settings_dict)
+        self._get_user(user_id).update(settings_dict)
         self.save_user_memory(user_id)
 
     def ensure_memory_directory(self):
         Path(self.memory_dir).mkdir(parents=True, exist_ok=True)
 
-    def get_user_file_path(self, user_id):
-        return Path(self.memory_dir) / f"user_{user_id}.json"
-
     def load_user_memory(self, user_id):
         user_id = str(user_id)
-        user_file = self.get_user_file_path(user_id)
+        if user_id in self._evicting:
+            # Evicted but not flushed yet: the in-RAM copy is the newest one
+            data = self._evicting.pop(user_id)
+            self.users.put(user_id, data, estimate_user_bytes(data, self._offloaded_tokens.get(user_id, ())))
+            return
+
         try:
-            if user_file.exists():
-                with open(user_file, 'r', encoding='utf-8') as f:
-                    self.users[user_id] = json.load(f)
-            else:
-                self.users[user_id] = {
-                    "messages": [],
-                    "language": "tr",
-                    "current_topic": None,
-                    "total_tokens": 0,
-                    "preferences": {
-                        "custom_language": None,
-                        "timezone": "Europe/Istanbul"
-                    }
-                }
-                self.save_user_memory(user_id)
+            loaded = self.backend.load(user_id)
         except Exception as e:
             logger.error(f"Error loading memory for user {user_id}: {e}")
-            self.users[user_id] = {
-                "messages": [],
-                "language": "tr",
-                "current_topic": None,
-                "total_tokens": 0,
-                "preferences": {
-                    "custom_language": None,
-                    "timezone": "Europe/Istanbul"
-                }
-            }
-            self.save_user_memory(user_id)
+            loaded = None
+
+        if loaded is None:
+            loaded = {"data": default_user_memory(), "disk_count": 0, "offloaded_tokens": [], "rewrite": True}
+
+        # History lives in deques so trimming from the front is O(1); the token
+        # total is recomputed once here and maintained incrementally afterwards
+        data = loaded["data"]
+        data["messages"] = deque(data.get("messages", []))
+        offloaded_tokens = deque(loaded["offloaded_tokens"])
+        data["total_tokens"] = sum(msg.get("tokens", 0) for msg in data["messages"]) + sum(offloaded_tokens)
+        self._disk_counts[user_id] = loaded["disk_count"]
+        self._offloaded_tokens[user_id] = offloaded_tokens
+        self.users.put(user_id, data, estimate_user_bytes(data, offloaded_tokens))
+        if loaded["rewrite"]:
+            change = self._mark_dirty(user_id)
+            change["settings"] = True
+            change["rewrite"] = True
+
+    def _on_evict(self, user_id, data):
+        """Cache eviction callback; returns True when the user still had unsaved changes."""
+        if user_id in self._dirty or user_id in self._flushing:
+            # Keep it until the flusher has written it, and ask for that flush now
+            self._evicting[user_id] = data
+            self._flush_requested.set()
+            return True
+        self._forget_user(user_id)
+        return False
+
+    def _forget_user(self, user_id):
+        self._disk_counts.pop(user_id, None)
+        self._offloaded_tokens.pop(user_id, None)
+
+    def _mark_dirty(self, user_id):
+        """Return the pending change record for a user, creating it if needed."""
+        started = time.perf_counter()
+        self.persistence_stats["marked"] += 1
+        change = self._dirty.get(user_id)
+        if change is None:
+            change = {"appended": deque(), "dropped": 0, "settings": False, "rewrite": False}
+            self._dirty[user_id] = change
+        else:
+            self.persistence_stats["coalesced"] += 1
+        self.persistence_stats["mark_seconds"] += time.perf_counter() - started
+        return change
 
     def save_user_memory(self, user_id):
-        user_id = str(user_id)
-        user_file = self.get_user_file_path(user_id)
-        try:
-            self.ensure_memory_directory()
-            with open(user_file, 'w', encoding='utf-8') as f:
-                json.dump(self.users[user_id], f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"Error saving memory for user {user_id}: {e}")
+        """Mark the user's memory dirty; the background flusher writes it to disk."""
+        self._mark_dirty(str(user_id))["settings"] = True
+
+    def _record_append(self, user_id, message):
+        change = self._mark_dirty(user_id)
+        if not change["rewrite"]:
+            change["appended"].append(message)
+
+    def _drop_oldest_message(self, user_id):
+        """Remove the oldest message from the user's history and return its token count."""
+        offloaded = self._offloaded_tokens.get(user_id)
+        if offloaded:
+            # The oldest message only exists on disk
+            removed_tokens = offloaded.popleft()
+            self.users.resize(user_id, -36)
+        else:
+            removed = self.users.peek(user_id)["messages"].popleft()
+            removed_tokens = removed.get("tokens", 0)
+            self.users.resize(user_id, -estimate_message_bytes(removed))
+
+        change = self._mark_dirty(user_id)
+        if not change["rewrite"]:
+            if self._disk_counts.get(user_id, 0) - change["dropped"] <= 0 and change["appended"]:
+                # The dropped message was never written; just forget it
+                change["appended"].popleft()
+            else:
+                change["dropped"] += 1
+        return removed_tokens
+
+    def _offload_old_messages(self, user_id):
+        # Backends with lazy history keep only a window of recent messages in RAM
+        if not self.backend.partial_history:
+            return
+        messages = self.users.peek(user_id)["messages"]
+        while len(messages) > self.backend.history_window:
+            removed = messages.popleft()
+            self._offloaded_tokens[user_id].append(removed.get("tokens", 0))
+            self.users.resize(user_id, 36 - estimate_message_bytes(removed))
+
+    async def flush_dirty(self):
+        """Write every dirty user's memory to disk without blocking the event loop."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            jobs = []
+            for user_id, change in dirty.items():
+                data = self.users.peek(user_id)
+                if data is None:
+                    data = self._evicting.get(user_id)
+                    if data is None:
+                        continue
+                offloaded_tokens = self._offloaded_tokens.get(user_id, [])
+                jobs.append(self.backend.prepare_write(user_id, data, change, offloaded_tokens))
+                self._disk_counts[user_id] = len(data["messages"]) + len(offloaded_tokens)
+            self._flushing = set(dirty)
+            try:
+                failed = await asyncio.to_thread(self._write_jobs, jobs)
+            finally:
+                self._flushing = set()
+            # Retry failed users on the next flush; a full rewrite keeps the stored copy consistent
+            for user_id in failed:
+                change = self._mark_dirty(user_id)
+                change["settings"] = True
+                change["rewrite"] = True
+            # Release evicted users that are now safely on disk
+            for user_id in list(self._evicting):
+                if user_id not in self._dirty:
+                    del self._evicting[user_id]
+                    self._forget_user(user_id)
+
+    def _write_jobs(self, jobs):
+        written, failed = 0, []
+        started = time.perf_counter()
+        for job in jobs:
+            try:
+                written += self.backend.write(job)
+                self.persistence_stats["flushes"] += 1
+            except Exception as e:
+                logger.error(f"Error saving memory for user {job['user_id']}: {e}")
+                failed.append(job["user_id"])
+        self.persistence_stats["bytes_written"] += written
+        self.persistence_stats["write_seconds"] += time.perf_counter() - started
+        return failed
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                # Flush every interval, or right away when a dirty user was evicted
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self.flush_dirty()
+            except Exception as e:
+                logger.error(f"Background memory flush error: {e}")
+
+    def start_background_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+            logger.info(f"User memory write-behind started (storage: {self.storage_mode}, interval: {self.flush_interval}s)")
+
+    async def close(self):
+        """Stop the background flusher, write any pending changes and close the backend."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush_dirty()
+        self.backend.close()
+        logger.info(f"User memory flushed on shutdown. Stats: {self.persistence_stats}, cache: {self.cache_stats()}")
 
     def add_message(self, user_id, role, content):
         user_id = str(user_id)
 
         # Load user's memory if not already loaded
-        if user_id not in self.users:
-            self.load_user_memory(user_id)
+        user_data = self._get_user(user_id)
 
         # Normalize role for consistency
         normalized_role = "user" if role == "user" else "model"
@@ -230,26 +1511,34 @@ class UserMemory:
             "tokens": len(content.split())  # Rough token estimation
         }
 
-        # Update total tokens
-        self.users[user_id]["total_tokens"] = sum(msg.get("tokens", 0) for msg in self.users[user_id]["messages"])
+        user_data["messages"].append(message)
+        self._record_append(user_id, message)
+        self.users.resize(user_id, estimate_message_bytes(message))
 
-        # Remove oldest messages if token limit exceeded
-        while self.users[user_id]["total_tokens"] > self.max_tokens and self.users[user_id]["messages"]:
-            removed_msg = self.users[user_id]["messages"].pop(0)
-            self.users[user_id]["total_tokens"] -= removed_msg.get("tokens", 0)
+        # Update the running token total
+        user_data["total_tokens"] += message["tokens"]
 
-        self.users[user_id]["messages"].append(message)
-        self.save_user_memory(user_id)
+        # Remove oldest messages if token limit exceeded (always keep the new one)
+        while user_data["total_tokens"] > self.max_tokens and (len(user_data["messages"]) > 1 or self._offloaded_tokens.get(user_id)):
+            user_data["total_tokens"] -= self._drop_oldest_message(user_id)
 
-    def get_relevant_context(self, user_id, max_messages=10):
-        """Get relevant conversation context for the user"""
+        self._offload_old_messages(user_id)
+
+    def get_recent_messages(self, user_id, max_messages=10):
+        """Return the last max_messages messages, reading older ones from storage if needed."""
         user_id = str(user_id)
-        if user_id not in self.users:
-            self.load_user_memory(user_id)
+        messages = self._get_user(user_id)["messages"]
+        recent_messages = list(itertools.islice(reversed(messages), max(max_messages, 0)))[::-1]
+        missing = max_messages - len(recent_messages)
+        if missing > 0 and self._offloaded_tokens.get(user_id):
+            # Indexed LIMIT query for messages that are no longer kept in RAM
+            before = messages[0]["timestamp"] if messages else None
+            recent_messages = self.backend.recent_messages(user_id, missing, before=before) + recent_messages
+        return recent_messages
 
-        messages = self.users[user_id].get("messages", [])
-        # Get the last N messages
-        recent_messages = messages[-max_messages:] if messages else []
+    def get_relevant_context(self, user_id, max_messages=10):
+        """Get relevant conversation context for the user"""
+        recent_messages = self.get_recent_messages(user_id, max_messages)
 
         # Format messages into a string
         context = "\n".join([
@@ -261,14 +1550,49 @@ class UserMemory:
 
     def trim_context(self, user_id):
         user_id = str(user_id)
-        if user_id not in self.users:
-            self.load_user_memory(user_id)
+        user_data = self._get_user(user_id)
+
+        if user_data["messages"] or self._offloaded_tokens.get(user_id):
+            user_data["total_tokens"] -= self._drop_oldest_message(user_id)
+
+def migrate_memory_directory(memory_dir="user_memories", db_path=None):
+    """Bulk import every user from a json/log memory directory into the SQLite backend."""
+    json_backend = JsonMemoryBackend(memory_dir)
+    log_backend = LogMemoryBackend(memory_dir)
+    sqlite_backend = SQLiteMemoryBackend(db_path or MEMORY_SQLITE_PATH or Path(memory_dir) / "memory.db")
+
+    user_ids = set()
+    for path in Path(memory_dir).glob("user_*"):
+        name = path.name
+        for suffix in (".settings.json", ".json", ".log"):
+            if name.endswith(suffix):
+                user_ids.add(name[len("user_"):-len(suffix)])
+                break
+
+    def iter_users():
+        for user_id in sorted(user_ids):
+            try:
+                # Prefer the log format when both exist: it is the newer copy
+                has_log = log_backend.get_user_log_path(user_id).exists() or log_backend.get_user_settings_path(user_id).exists()
+                loaded = log_backend.load(user_id) if has_log else json_backend.load(user_id)
+            except Exception as e:
+                logger.error(f"Skipping user {user_id} during migration: {e}")
+                continue
+            if loaded is not None:
+                yield user_id, loaded["data"]
 
-        if self.users[user_id]["messages"]:
-            self.users[user_id]["messages"].pop(0)
-            self.save_user_memory(user_id)
+    started = time.perf_counter()
+    try:
+        imported = sqlite_backend.import_users(iter_users())
+    finally:
+        sqlite_backend.close()
+    logger.info(f"Imported {imported} users into {sqlite_backend.db_path} in {time.perf_counter() - started:.2f}s")
+    return imported
 
 # Language detection functions (same as before)
+VALID_LANG_CODES = ['en', 'tr', 'es', 'fr', 'de', 'ru', 'ar', 'zh', 'ja', 'ko',
+                    'it', 'pt', 'hi', 'nl', 'pl', 'uk', 'sv', 'da', 'fi', 'no']
+
 async def detect_language_with_gemini(message_text):
     # ... (same as before)
     try:
@@ -288,42 +1612,127 @@ Rules:
 - If you cannot confidently determine the language, respond with 'en'
 """
 
-        # Use Gemini Pro for language detection
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        response = await model.generate_content_async(language_detection_prompt)
+        response_text = await gemini_models.generate_text("language", language_detection_prompt)
 
         # Extract the language code
-        detected_lang = response.text.strip().lower()
+        detected_lang = (response_text or '').strip().lower()
 
         # Validate and sanitize the language code
-        valid_lang_codes = ['en', 'tr', 'es', 'fr', 'de', 'ru', 'ar', 'zh', 'ja', 'ko',
-                             'it', 'pt', 'hi', 'nl', 'pl', 'uk', 'sv', 'da', 'fi', 'no']
-
-        if detected_lang not in valid_lang_codes:
+        if detected_lang not in VALID_LANG_CODES:
             logger.warning(f"Invalid language detected: {detected_lang}. Defaulting to English.")
             return 'en'
 
         logger.info(f"Gemini detected language: {detected_lang}")
         return detected_lang
 
+    except (GeminiOverloaded, GeminiUnavailable, asyncio.TimeoutError):
+        # No answer at all; the caller decides, rather than guessing English
+        raise
     except Exception as e:
         logger.error(f"Gemini language detection error: {e}")
         return 'en'
 
+# Local (tier 1-3) language detection; Gemini is only asked when these are not confident
+langdetect.DetectorFactory.seed = 0  # langdetect is non-deterministic without a fixed seed
+
+language_detection_stats = {"script": 0, "sticky": 0, "local": 0, "gemini": 0}
+
+# Character ranges that identify a single supported language on their own
+SCRIPT_LANGUAGES = [
+    ('ko', [(0xAC00, 0xD7AF), (0x1100, 0x11FF), (0x3130, 0x318F)]),  # Hangul
+    ('ja', [(0x3040, 0x30FF)]),  # Hiragana / Katakana
+    ('zh', [(0x4E00, 0x9FFF), (0x3400, 0x4DBF)]),  # CJK ideographs (checked after kana)
+    ('ar', [(0x0600, 0x06FF), (0x0750, 0x077F)]),  # Arabic
+    ('hi', [(0x0900, 0x097F)]),  # Devanagari
+    ('ru', [(0x0400, 0x04FF)]),  # Cyrillic (refined to 'uk' below)
+]
+UKRAINIAN_LETTERS = set('іїєґІЇЄҐ')
+TURKISH_LETTERS = set('ğışĞİŞ')
+
+def detect_language_by_script(text):
+    """Return (lang, confidence) from the writing system, or (None, 0.0) for Latin/mixed text."""
+    letters = [ch for ch in text if ch.isalpha()]
+    if not letters:
+        return None, 0.0
+    for lang, ranges in SCRIPT_LANGUAGES:
+        count = sum(1 for ch in letters if any(start <= ord(ch) <= end for start, end in ranges))
+        if count / len(letters) >= 0.5 or (lang == 'ja' and count):
+            if lang == 'ru' and any(ch in UKRAINIAN_LETTERS for ch in letters):
+                lang = 'uk'
+            return lang, count / len(letters)
+    if any(ch in TURKISH_LETTERS for ch in letters):
+        # ğ, ı and ş do not occur in any other supported Latin-script language
+        return 'tr', 0.95
+    return None, 0.0
+
+def detect_language_with_langdetect(text):
+    """Return (lang, probability) from langdetect, or (None, 0.0)."""
+    try:
+        candidates = langdetect.detect_langs(text)
+    except langdetect.LangDetectException:
+        return None, 0.0
+    for candidate in candidates:
+        lang = candidate.lang.split('-')[0]  # zh-cn / zh-tw -> zh
+        if lang in VALID_LANG_CODES:
+            return lang, candidate.prob
+    return None, 0.0
+
+def language_detection_report():
+    total = sum(language_detection_stats.values())
+    if not total:
+        return "no detections yet"
+    return ", ".join(f"{tier}: {count} ({count / total:.0%})" for tier, count in language_detection_stats.items())
+
 async def detect_and_set_user_language(message_text, user_id):
-    # ... (same as before)
+    """
+    Tiered language detection: writing system, then the user's sticky language
+    for short messages, then langdetect, and only then Gemini.
+    """
     try:
+        user_settings = user_memory.get_user_settings(user_id)
+        previous_lang = user_settings.get('language', 'en')
+        streak = user_settings.get('language_streak', 0)
+
         # If message is too short, use previous language
         clean_text = ' '.join(message_text.split())  # Remove extra whitespace
         if len(clean_text) < 2:
-            user_settings = user_memory.get_user_settings(user_id)
-            return user_settings.get('language', 'en')
-
-        # Detect language using Gemini
-        detected_lang = await detect_language_with_gemini(message_text)
-
-        # Update user's language preference
-        user_memory.update_user_settings(user_id, {'language': detected_lang})
+            return previous_lang
+
+        detected_lang, confidence = detect_language_by_script(clean_text)
+        tier = "script"
+        if detected_lang is None:
+            is_short = len(clean_text) < LANG_STICKY_MAX_CHARS or len(clean_text.split()) < 3
+            if is_short and streak >= LANG_STICKY_MIN_STREAK:
+                # "ok", "thanks", "haha"... from an established user: keep their language
+                detected_lang, tier = previous_lang, "sticky"
+            else:
+                detected_lang, confidence = detect_language_with_langdetect(clean_text)
+                tier = "local"
+                # Accept a weaker local guess when it agrees with the user's language;
+                # langdetect is unreliable on short text, so a short message must agree
+                if detected_lang == previous_lang:
+                    threshold = 0.5
+                else:
+                    threshold = LANG_CONFIDENCE_THRESHOLD if not is_short else float('inf')
+                if detected_lang is None or confidence < threshold:
+                    try:
+                        detected_lang = await detect_language_with_gemini(message_text)
+                        tier = "gemini"
+                    except GeminiOverloaded:
+                        # No quota to spare for a classifier; keep the user's language unless the local guess is usable
+                        detected_lang = previous_lang if is_short or detected_lang is None else detected_lang
+                    except (GeminiUnavailable, asyncio.TimeoutError) as e:
+                        # An outage says nothing about the user's language: answer in the current one, save nothing
+                        logger.warning(f"Gemini language detection unavailable, keeping {previous_lang}: {e!r}")
+                        return previous_lang
+
+        language_detection_stats[tier] += 1
+        logger.info(f"Language {detected_lang} detected by {tier} tier (confidence: {confidence:.2f})")
+
+        # Update user's language preference only when something changed
+        new_streak = min(streak + 1, 20) if detected_lang == previous_lang else 1
+        if detected_lang != previous_lang or new_streak != streak:
+            user_memory.update_user_settings(user_id, {'language': detected_lang, 'language_streak': new_streak})
 
         return detected_lang
 
@@ -402,6 +1811,19 @@ def get_error_message(error_type, lang):
             'ko': "검색 기록이 너무 깁니다. 딥 검색을 완료할 수 없습니다. 나중에 다시 시도하거나 더 짧은 쿼리로 다시 시도해 주세요. 🙏",
             'zh': "搜索历史记录太长。 无法完成深度搜索。 请稍后重试或使用较短的查询重试。 🙏"
         },
+        'service_unavailable': { # Gemini is failing; the circuit breaker returns this degraded reply
+            'en': "My AI service is having trouble right now, so I can't answer properly. Please try again in a minute. 🛠️",
+            'tr': "Yapay zeka servisim şu anda sorun yaşıyor, bu yüzden düzgün yanıt veremiyorum. Lütfen bir dakika sonra tekrar dene. 🛠️",
+            'es': "Mi servicio de IA tiene problemas en este momento, así que no puedo responder bien. Inténtalo de nuevo en un minuto. 🛠️",
+            'fr': "Mon service d'IA rencontre des difficultés en ce moment, je ne peux pas répondre correctement. Réessaie dans une minute. 🛠️",
+            'de': "Mein KI-Dienst hat gerade Probleme, daher kann ich nicht richtig antworten. Bitte versuche es in einer Minute erneut. 🛠️",
+            'it': "Il mio servizio di IA ha dei problemi in questo momento, quindi non posso rispondere bene. Riprova tra un minuto. 🛠️",
+            'pt': "Meu serviço de IA está com problemas agora, então não consigo responder direito. Tente novamente em um minuto. 🛠️",
+            'ru': "Мой ИИ-сервис сейчас работает с перебоями, поэтому я не могу нормально ответить. Попробуй еще раз через минуту. 🛠️",
+            'ja': "現在AIサービスに問題が発生しているため、うまく回答できません。1分後にもう一度お試しください。🛠️",
+            'ko': "지금 AI 서비스에 문제가 있어 제대로 답변할 수 없습니다. 1분 후에 다시 시도해 주세요. 🛠️",
+            'zh': "我的AI服务目前出现问题，暂时无法正常回答。请一分钟后再试。🛠️"
+        },
         'max_retries': { # New error type for max retries reached during deep search
             'en': "Maximum retries reached during deep search, could not complete the request. Please try again later. 🙏",
             'tr': "Derin arama sırasında maksimum deneme sayısına ulaşıldı, istek tamamlanamadı. Lütfen daha sonra tekrar deneyin. 🙏",
@@ -418,35 +1840,176 @@ def get_error_message(error_type, lang):
     }
     return messages[error_type].get(lang, messages[error_type]['en'])
 
-# Message splitting function (same as before)
-async def split_and_send_message(update: Update, text: str, max_length: int = 4096):
-    # ... (same as before)
-    if not text:  # Boş mesaj kontrolü
-        await update.message.reply_text("Üzgünüm, bir yanıt oluşturamadım. Lütfen tekrar deneyin. 🙏")
-        return
-
-    messages = []
-    current_message = ""
-
-    # Mesajı satır satır böl
-    lines = text.split('\n')
-
-    for line in lines:
-        if not line:  # Boş satır kontrolü
-            continue
+# Concurrent update processing
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates from different users concurrently, but one at a time per user
+    and in arrival order, since UserMemory history and language state depend on it.
+    An update waits for its user's turn before taking one of the concurrency slots,
+    so a user with a backlog doesn't hold slots other users could use.
+    """
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        # The base class semaphore wraps the per-user wait too, so it only caps pending
+        # updates; the real concurrency limit is self._slots
+        super().__init__(max(max_concurrent_updates * 64, 1024))
+        self.concurrency_limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = {}
+        self._user_pending = {}
+        self.stats = {"processed": 0, "queued_behind_same_user": 0, "peak_running": 0}
+        self._running = 0
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            self._running += 1
+            self.stats["peak_running"] = max(self.stats["peak_running"], self._running)
+            try:
+                await coroutine
+            finally:
+                self._running -= 1
+                self.stats["processed"] += 1
 
-        # Eğer mevcut satır eklenince maksimum uzunluğu aşacaksa
-        if len(current_message + line + '\n') > max_length:
-            # Mevcut mesajı listeye ekle ve yeni mesaj başlat
-            if current_message.strip():  # Boş mesaj kontrolü
-                messages.append(current_message.strip())
-            current_message = line + '\n'
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        lock = self._user_locks.get(key)
+        if lock is None:
+            lock = self._user_locks[key] = asyncio.Lock()
+        elif lock.locked():
+            self.stats["queued_behind_same_user"] += 1
+        self._user_pending[key] = self._user_pending.get(key, 0) + 1
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, which keeps each user's updates in order
+            async with lock:
+                await self._run(coroutine)
+        finally:
+            self._user_pending[key] -= 1
+            if not self._user_pending[key]:
+                del self._user_pending[key]
+                del self._user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logging.info(f"Update processor: {self.stats}")
+
+# Outbound Telegram rate limiting
+class OutboundRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter for every Bot API call (plugged into the Application builder).
+    Messages and edits queue per chat, in order, behind a per-chat bucket and a
+    global bucket; other calls go straight through. A RetryAfter pauses the chat
+    (or everything, for calls without a chat) and the call is retried.
+    """
+    THROTTLED_PREFIXES = ('send', 'edit', 'copy', 'forward')
+    UNTHROTTLED_ENDPOINTS = {'sendChatAction'}
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 group_rate=TELEGRAM_GROUP_RATE, max_retries=TELEGRAM_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self.stats = {"requests": 0, "throttled": 0, "wait_seconds": 0.0, "retry_after": 0}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logging.info(f"Outbound rate limiter: {self.stats}")
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # Forget chats that have been quiet long enough to refill completely
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle}
+            is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.group_rate if is_group else self.chat_rate, 3)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        throttled = endpoint.startswith(self.THROTTLED_PREFIXES) and endpoint not in self.UNTHROTTLED_ENDPOINTS
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        self.stats["requests"] += 1
+        for attempt in range(max_retries + 1):
+            if throttled:
+                waited = (await chat_bucket.acquire() if chat_bucket else 0.0) + await self.global_bucket.acquire()
+                if waited > 0.01:
+                    self.stats["throttled"] += 1
+                    self.stats["wait_seconds"] = round(self.stats["wait_seconds"] + waited, 3)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                if attempt == max_retries:
+                    raise
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                logging.warning(f"Telegram flood control on {endpoint} (chat {chat_id}), retrying in {retry_after}s")
+                (chat_bucket or self.global_bucket).block_for(retry_after + 0.1)
+                if not throttled:
+                    await asyncio.sleep(retry_after + 0.1)
+
+# Message splitting
+SENTENCE_END = re.compile(r'[.!?…][)"\'»]*\s')
+
+def split_message_text(text, max_length=4096):
+    """
+    Split text into Telegram-sized parts (UTF-16 length), cutting at the last paragraph
+    break, line break, sentence end or space in the second half of each window, and
+    hard-cutting lines with no break at all. Blank lines inside a part are kept.
+    Each window is scanned once, so this is linear in the text length. Cut points only
+    depend on the text before them, so a growing text keeps the same earlier parts
+    (StreamingReply relies on this).
+    """
+    # units[i] = UTF-16 length of text[:i]
+    units = [0, *itertools.accumulate(2 if ord(char) > 0xFFFF else 1 for char in text)]
+    parts = []
+    start = 0
+    length = len(text)
+    while start < length:
+        if units[length] - units[start] <= max_length:
+            parts.append(text[start:].rstrip())
+            break
+        end = bisect.bisect_right(units, units[start] + max_length, start) - 1
+        floor = start + (end - start) // 2
+        cut, resume = end, end
+        for separator in ('\n\n', '\n'):
+            position = text.rfind(separator, floor, end)
+            if position > start:
+                cut, resume = position, position + len(separator)
+                break
         else:
-            current_message += line + '\n'
+            sentence_ends = [match.end() for match in SENTENCE_END.finditer(text, floor, end)]
+            position = sentence_ends[-1] if sentence_ends else text.rfind(' ', floor, end)
+            if position > start:
+                cut, resume = position, position + (0 if sentence_ends else 1)
+        parts.append(text[start:cut].rstrip())
+        start = resume
+        while start < length and text[start] in ' \n':
+            start += 1
+    return [part for part in parts if part.strip()]
 
-    # Son mesajı ekle
-    if current_message.strip():  # Boş mesaj kontrolü
-        messages.append(current_message.strip())
+async def split_and_send_message(update: Update, text: str, max_length: int = 4096):
+    """Send text as one or more messages; OutboundRateLimiter paces them."""
+    messages = split_message_text(text, max_length) if text else []
 
     # Eğer hiç mesaj oluşturulmadıysa
     if not messages:
@@ -455,150 +2018,1015 @@ async def split_and_send_message(update: Update, text: str, max_length: int = 40
 
     # Mesajları sırayla gönder
     for message in messages:
-        if message.strip():  # Son bir boş mesaj kontrolü
-            await update.message.reply_text(message)
+        await update.message.reply_text(message)
+
+class StreamingReply:
+    """
+    Shows a reply while Gemini is still generating it: the first chunk is sent as a
+    new message, later chunks edit it at most once per edit_interval, and text past
+    Telegram's 4096 character limit rolls over into a new message. A failed send or
+    edit never interrupts the stream; finish() retries it and, if edits keep failing,
+    sends whatever is still missing as new messages like split_and_send_message.
+    """
+    def __init__(self, message, edit_interval=STREAM_EDIT_INTERVAL, max_length=4096):
+        self.message = message  # the user's message we are replying to
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self.text = ""
+        self.first_visible_at = None
+        self._sent = []  # [telegram Message, text currently shown]
+        self._last_edit = 0.0
+
+    @property
+    def started(self):
+        return bool(self._sent)
+
+    def _pending(self):
+        """(index, part, text shown) for every part not shown in full yet."""
+        parts = split_message_text(self.text, self.max_length)
+        return [(index, part, self._sent[index][1] if index < len(self._sent) else None)
+                for index, part in enumerate(parts)
+                if index >= len(self._sent) or self._sent[index][1] != part]
+
+    async def _sync(self, force):
+        """Bring the sent messages up to date; returns the last Telegram error instead of raising it."""
+        error = None
+        parts = split_message_text(self.text, self.max_length)
+        for index, part in enumerate(parts):
+            if index >= len(self._sent):
+                try:
+                    sent_message = await self.message.reply_text(part)
+                except Exception as e:
+                    # Later parts must follow this one; try again on the next sync
+                    logger.warning(f"Streamed reply send failed: {e}")
+                    return e
+                self._sent.append([sent_message, part])
+                self._last_edit = time.monotonic()
+                if self.first_visible_at is None:
+                    self.first_visible_at = time.monotonic()
+                continue
+            shown = self._sent[index]
+            if shown[1] == part:
+                continue
+            # Parts that rolled over are complete, so they are finalized right away
+            complete = index < len(parts) - 1
+            if not (force or complete) and time.monotonic() - self._last_edit < self.edit_interval:
+                continue
+            try:
+                await shown[0].edit_text(part)
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    logger.warning(f"Streamed reply edit failed: {e}")
+                    error = e
+                    continue
+            except Exception as e:
+                # Flood control or a transient error; the final sync writes the full text again
+                logger.warning(f"Streamed reply edit failed: {e}")
+                error = e
+                continue
+            shown[1] = part
+            self._last_edit = time.monotonic()
+        return error
+
+    async def feed(self, chunk):
+        self.text += chunk
+        await self._sync(force=False)
+
+    async def finish(self, final_text=None):
+        """Show the complete reply (final_text may add to the streamed text, e.g. an emoji)."""
+        if final_text is not None:
+            self.text = final_text
+        for attempt in range(STREAM_FINISH_ATTEMPTS):
+            error = await self._sync(force=True)
+            if error is None and not self._pending():
+                return
+            if attempt < STREAM_FINISH_ATTEMPTS - 1:
+                retry_after = getattr(error, 'retry_after', 1.0)
+                retry_after = retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+                await asyncio.sleep(min(retry_after, 5.0))
+        # Edits keep failing: send the text the user has not seen as new messages
+        for index, part, shown in self._pending():
+            missing = part[len(shown):].lstrip() if shown and part.startswith(shown) else part
+            if missing:
+                sent_message = await self.message.reply_text(missing)
+                if index >= len(self._sent):
+                    self._sent.append([sent_message, part])
+
+async def stream_response(response, streamer):
+    """Feed a streaming Gemini response into a StreamingReply chunk by chunk."""
+    async for chunk in response:
+        if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+            break
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunk without text parts (e.g. only a finish reason)
+            continue
+        if text:
+            await streamer.feed(text)
 
 # Start command handler (same as before)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     welcome_message = "Hello! I'm Nyxie, a Protogen created by Waffieu. I'm here to chat, help, and learn with you! Feel free to talk to me about anything or share images with me. I'll automatically detect your language and respond accordingly.\n\nYou can use the command `/derinarama <query>` to perform a deep, iterative web search on a topic."
     await update.message.reply_text(welcome_message)
 
-# Intelligent web search function (modified for potential iterative use)
-async def intelligent_web_search(user_message, model, user_id, iteration=0): # user_id parametresi eklendi
+# Shared HTTP client
+class CachingDnsBackend(httpcore.AsyncNetworkBackend):
     """
-    Intelligently generate and perform web searches using Gemini, now with iteration info and user context
+    Network backend that caches getaddrinfo results for a TTL. TLS still uses the
+    original hostname for SNI. With public_only, connections to non-global addresses
+    are refused here, on the address actually connected to, so neither redirects
+    nor DNS rebinding can reach internal services.
     """
-    try:
-        logging.info(f"Web search başlatıldı (Iteration {iteration}): {user_message}, User ID: {user_id}")
-
-        # Konuşma geçmişini al
-        context_messages = user_memory.get_user_settings(user_id).get("messages", [])
-        history_text = "\n".join([
-            f"{'Kullanıcı' if msg['role'] == 'user' else 'Asistan'}: {msg['content']}"
-            for msg in context_messages[-5:] # Son 5 mesajı alalım, isteğe göre ayarlanabilir
-        ])
+    def __init__(self, ttl=HTTP_DNS_CACHE_TTL, public_only=False, max_entries=HTTP_MAX_TRACKED_HOSTS):
+        self._inner = httpcore.AnyIOBackend()
+        self._ttl = ttl
+        self.public_only = public_only
+        self.max_entries = max_entries
+        self._cache = OrderedDict()  # (host, port) -> (address, expires_at), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, host, port):
+        try:
+            ipaddress.ip_address(host)
+            return host
+        except ValueError:
+            pass
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached and cached[1] > time.monotonic():
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return cached[0]
+        self.misses += 1
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        address = infos[0][4][0]
+        self._cache[key] = (address, time.monotonic() + self._ttl)
+        self._cache.move_to_end(key)
+        # Deep search touches many one-off hosts; keep only the most recently used
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return address
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        address = await self.resolve(host, port)
+        if self.public_only and not ipaddress.ip_address(address).is_global:
+            raise httpcore.ConnectError(f"Refusing to connect to non-public address {address} for {host}")
+        try:
+            return await self._inner.connect_tcp(address, port, timeout=timeout, local_address=local_address, socket_options=socket_options)
+        except Exception:
+            # The cached address may be stale; resolve again next time
+            self._cache.pop((host, port), None)
+            raise
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self._inner.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds):
+        await self._inner.sleep(seconds)
+
+# httpcore exceptions and the httpx ones callers catch; subclasses come before their bases
+HTTPCORE_ERRORS = (
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+)
 
-        # First, generate search queries using Gemini
-        query_generation_prompt = f"""
-        Görevin, kullanıcının son mesajını ve önceki konuşma bağlamını dikkate alarak en alakalı web arama sorgularını oluşturmak.
-        Bu sorgular, derinlemesine araştırma yapmak için kullanılacak. Eğer kullanıcının son mesajı önceki konuşmaya bağlı bir devam sorusu ise,
-        bağlamı kullanarak daha eksiksiz ve anlamlı sorgular üret.
+@contextlib.contextmanager
+def httpx_errors(request):
+    """Re-raise httpcore errors as the matching httpx exception."""
+    try:
+        yield
+    except Exception as exc:
+        for core_error, httpx_error in HTTPCORE_ERRORS:
+            if isinstance(exc, core_error):
+                raise httpx_error(str(exc), request=request) from exc
+        raise
+
+class CoreResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream, request):
+        self._stream = stream
+        self._request = request
+
+    async def __aiter__(self):
+        with httpx_errors(self._request):
+            async for chunk in self._stream:
+                yield chunk
+
+    async def aclose(self):
+        if hasattr(self._stream, 'aclose'):
+            await self._stream.aclose()
+
+class DnsCachingTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport over an httpcore connection pool that uses our network backend.
+    httpx.AsyncHTTPTransport has no network_backend option, and patching its private
+    pool would silently stop applying DNS caching and the public-address check after
+    an httpcore upgrade; this only relies on the documented transport and pool APIs.
+    """
+    def __init__(self, network_backend, max_connections, keepalive_expiry=30, http2=False, retries=1):
+        self.pool = httpcore.AsyncConnectionPool(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+            http1=True,
+            http2=http2,
+            retries=retries,
+            network_backend=network_backend,
+        )
 
-        Önceki Konuşma Bağlamı (Son 5 Mesaj):
-        ```
-        {history_text}
-        ```
+    async def handle_async_request(self, request):
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=request.url.raw_scheme, host=request.url.raw_host,
+                             port=request.url.port, target=request.url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with httpx_errors(request):
+            response = await self.pool.handle_async_request(core_request)
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=CoreResponseStream(response.stream, request),
+            extensions=response.extensions,
+        )
 
-        Kullanıcı Mesajı: {user_message}
+    async def aclose(self):
+        await self.pool.aclose()
+
+class HttpResult:
+    """Body of a size-capped GET. `truncated` is True when the body hit the byte cap."""
+    def __init__(self, url, status_code, headers, content, truncated):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.truncated = truncated
+
+    @property
+    def text(self):
+        content_type = self.headers.get('content-type', '')
+        match = re.search(r'charset=([\w-]+)', content_type)
+        try:
+            return self.content.decode(match.group(1) if match else 'utf-8', errors='replace')
+        except LookupError:
+            return self.content.decode('utf-8', errors='replace')
+
+class HttpBody:
+    """Async iterator over a response body that stops after max_bytes."""
+    def __init__(self, response, max_bytes):
+        self._response = response
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.truncated = False
+
+    async def __aiter__(self):
+        async for chunk in self._response.aiter_bytes():
+            remaining = self.max_bytes - self.size
+            if len(chunk) > remaining:
+                # Keep the prefix, stop downloading the rest
+                self.truncated = True
+                if remaining > 0:
+                    self.size += remaining
+                    yield chunk[:remaining]
+                return
+            self.size += len(chunk)
+            yield chunk
 
-        Kurallar:
-        - En fazla 3 sorgu oluştur
-        - Her sorgu yeni bir satırda olmalı
-        - Sorgular net ve spesifik olmalı
-        - Türkçe dilinde ve güncel bilgi içermeli
-        - Eğer bu bir derin arama iterasyonu ise, önceki arama sonuçlarını ve kullanıcı mesajını dikkate alarak daha spesifik ve derinlemesine sorgular oluştur.
+class HostLimiter:
+    """Per-host concurrency limit; `users` counts requests waiting for or holding a slot."""
+    def __init__(self, limit):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0
+        self.waiting = 0
 
-        Önceki sorgular ve sonuçlar (varsa): ... (Şimdilik boş, iterasyonlar eklendikçe burası dolacak)
-        """
+class HostPacer:
+    """
+    Serializes requests to each host and spaces them `interval` seconds apart. Lives on
+    the shared HttpClientPool, so concurrent deep searches share one schedule per host.
+    Keeps at most max_hosts hosts; only hosts nobody is using and whose interval has
+    passed are forgotten, so dropping one never lets a request jump the queue.
+    """
+    def __init__(self, max_hosts=HTTP_MAX_TRACKED_HOSTS):
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()  # host -> [lock, users, ready_at], least recently used first
+
+    def _state(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = [asyncio.Lock(), 0, 0.0]
+            if len(self._hosts) > self.max_hosts:
+                now = time.monotonic()
+                idle = [name for name, (_, users, ready_at) in self._hosts.items()
+                        if not users and ready_at <= now and name != host]
+                for name in idle[:len(self._hosts) - self.max_hosts]:
+                    del self._hosts[name]
+        else:
+            self._hosts.move_to_end(host)
+        return state
 
-        # Use Gemini to generate search queries with timeout and retry logic
-        logging.info(f"Generating search queries with Gemini (Iteration {iteration})")
+    @contextlib.asynccontextmanager
+    async def turn(self, host, interval):
+        state = self._state(host)
+        state[1] += 1
         try:
-            query_response = await asyncio.wait_for(
-                model.generate_content_async(query_generation_prompt),
-                timeout=10.0  # 10 second timeout
+            async with state[0]:
+                wait = state[2] - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    yield
+                finally:
+                    state[2] = time.monotonic() + interval
+        finally:
+            state[1] -= 1
+
+    def __len__(self):
+        return len(self._hosts)
+
+class HttpClientPool:
+    """
+    Process-wide async HTTP client: one pooled httpx.AsyncClient (HTTP/2 when the
+    optional h2 package is installed), per-host connection limits, DNS caching,
+    response size caps and the same timeouts for every outbound web request.
+    """
+    USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+    def __init__(self, max_connections=HTTP_MAX_CONNECTIONS, max_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+                 timeout=HTTP_TIMEOUT, max_response_bytes=HTTP_MAX_RESPONSE_BYTES, public_only=False):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.timeout = httpx.Timeout(timeout, connect=min(HTTP_CONNECT_TIMEOUT, timeout))
+        self.max_response_bytes = max_response_bytes
+        self.dns = CachingDnsBackend(public_only=public_only)
+        self._client = None
+        self._transport = None
+        self._hosts = OrderedDict()  # host -> HostLimiter, least recently used first
+        self.pacer = HostPacer()  # per-host spacing for polite crawling (PageFetcher)
+        self.stats = {"requests": 0, "errors": 0, "truncated": 0, "bytes": 0, "in_flight": 0, "peak_in_flight": 0}
+
+    def _get_client(self):
+        if self._client is None:
+            try:
+                import h2  # noqa: F401 - optional, enables HTTP/2
+                http2 = True
+            except ImportError:
+                http2 = False
+            self._transport = DnsCachingTransport(self.dns, self.max_connections, http2=http2)
+            self._client = httpx.AsyncClient(
+                transport=self._transport,
+                timeout=self.timeout,
+                follow_redirects=True,
+                headers={'User-Agent': self.USER_AGENT},
             )
-            logging.info(f"Gemini response received for queries (Iteration {iteration}): {query_response.text}")
-        except asyncio.TimeoutError:
-            logging.error(f"Gemini API request timed out (Query generation, Iteration {iteration})")
-            return "Üzgünüm, şu anda arama yapamıyorum. Lütfen daha sonra tekrar deneyin.", [] # Return empty results list
-        except Exception as e:
-            logging.error(f"Error generating search queries (Iteration {iteration}): {str(e)}")
-            return "Arama sorgularını oluştururken bir hata oluştu.", [] # Return empty results list
+            logging.info(f"Shared HTTP client created (http2={http2}, max_connections={self.max_connections}, per_host={self.max_per_host})")
+        return self._client
+
+    def _host_limiter(self, host):
+        limiter = self._hosts.get(host)
+        if limiter is None:
+            limiter = self._hosts[host] = HostLimiter(self.max_per_host)
+            # Forget idle hosts beyond the cap; busy ones stay until their requests finish
+            if len(self._hosts) > HTTP_MAX_TRACKED_HOSTS:
+                idle = [name for name, entry in self._hosts.items() if not entry.users and name != host]
+                for name in idle[:len(self._hosts) - HTTP_MAX_TRACKED_HOSTS]:
+                    del self._hosts[name]
+        else:
+            self._hosts.move_to_end(host)
+        return limiter
+
+    @contextlib.asynccontextmanager
+    async def stream(self, url, params=None, headers=None, max_bytes=None, timeout=None, follow_redirects=True):
+        """Open a GET through the shared pool. Yields (response, body); iterating body reads at most max_bytes."""
+        client = self._get_client()
+        max_bytes = self.max_response_bytes if max_bytes is None else max_bytes
+        host = urlsplit(url).hostname or ''
+        limiter = self._host_limiter(host)
+        limiter.users += 1
+        limiter.waiting += 1
+        try:
+            await limiter.semaphore.acquire()
+        except BaseException:
+            limiter.users -= 1
+            raise
+        finally:
+            limiter.waiting -= 1
+        self.stats["requests"] += 1
+        self.stats["in_flight"] += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+        try:
+            request_timeout = self.timeout if timeout is None else httpx.Timeout(timeout, connect=min(HTTP_CONNECT_TIMEOUT, timeout))
+            async with client.stream('GET', url, params=params, headers=headers, timeout=request_timeout,
+                                     follow_redirects=follow_redirects) as response:
+                body = HttpBody(response, max_bytes)
+                try:
+                    yield response, body
+                finally:
+                    self.stats["bytes"] += body.size
+                    if body.truncated:
+                        self.stats["truncated"] += 1
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.stats["in_flight"] -= 1
+            limiter.semaphore.release()
+            limiter.users -= 1
+
+    async def get(self, url, params=None, headers=None, max_bytes=None, timeout=None):
+        """GET a URL through the shared pool, reading at most max_bytes of the body."""
+        async with self.stream(url, params=params, headers=headers, max_bytes=max_bytes, timeout=timeout) as (response, body):
+            content = b''.join([chunk async for chunk in body])
+            return HttpResult(str(response.url), response.status_code, response.headers, content, body.truncated)
+
+    def pool_stats(self):
+        """Pool utilisation snapshot: connections, idle/active split, waiters and DNS cache hits."""
+        connections = []
+        if self._client is not None:
+            connections = list(self._transport.pool.connections)
+        idle = sum(1 for connection in connections if connection.is_idle())
+        http2 = sum(1 for connection in connections if 'HTTP/2' in connection.info())
+        return {
+            **self.stats,
+            "connections": len(connections),
+            "idle_connections": idle,
+            "active_connections": len(connections) - idle,
+            "http2_connections": http2,
+            "max_connections": self.max_connections,
+            "host_waiters": {host: limiter.waiting for host, limiter in self._hosts.items() if limiter.waiting},
+            "tracked_hosts": len(self._hosts),
+            "dns_hits": self.dns.hits,
+            "dns_misses": self.dns.misses,
+        }
 
-        search_queries = [q.strip() for q in query_response.text.split('\n') if q.strip()]
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._transport = None
 
-        # Fallback if no queries generated
-        if not search_queries:
-            search_queries = [user_message]
+http_client = HttpClientPool()
+# Result pages are untrusted URLs; this pool only ever connects to public addresses
+page_http_client = HttpClientPool(public_only=True)
 
-        logging.info(f"Generated search queries (Iteration {iteration}): {search_queries}")
+# Search result cache
+def normalize_search_query(query):
+    """Fold case, punctuation and whitespace so near-identical queries share a cache entry."""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', query.casefold()).split())
 
-        # Perform web searches
-        search_results = []
-        try:
-            from duckduckgo_search import DDGS
-            logging.info("DDGS import edildi")
+class SearchCache:
+    """
+    TTL cache for search results: a bounded in-memory LRU tier and an optional
+    SQLite tier that survives restarts. Concurrent lookups of the same query share
+    one in-flight search.
+    """
+    def __init__(self, ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_MAX_ENTRIES, db_path=SEARCH_CACHE_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (results, stored_at, fetch_seconds)
+        self._in_flight = {}
+        self._conn = None
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "coalesced": 0, "misses": 0, "saved_seconds": 0.0}
+        if db_path:
+            Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(db_path, check_same_thread=False)
+            with self._lock, self._conn:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS search_cache (
+                        key TEXT PRIMARY KEY,
+                        results TEXT NOT NULL,
+                        stored_at REAL NOT NULL,
+                        fetch_seconds REAL NOT NULL
+                    )
+                """)
+                self._conn.execute("DELETE FROM search_cache WHERE stored_at < ?", (time.time() - ttl,))
+
+    def _remember(self, key, results, stored_at, fetch_seconds):
+        self._entries[key] = (results, stored_at, fetch_seconds)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_get(self, key):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT results, stored_at, fetch_seconds FROM search_cache WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _disk_put(self, key, results, stored_at, fetch_seconds):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, results, stored_at, fetch_seconds) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(results, ensure_ascii=False), stored_at, fetch_seconds)
+            )
 
-            with DDGS() as ddgs:
-                for query in search_queries:
-                    logging.info(f"DuckDuckGo araması yapılıyor (Iteration {iteration}): {query}")
-                    try:
-                        results = list(ddgs.text(query, max_results=5)) # Increased max_results for deep search
-                        logging.info(f"Bulunan sonuç sayısı (Iteration {iteration}): {len(results)}")
-                        search_results.extend(results)
-                    except Exception as query_error:
-                        logging.warning(f"Arama sorgusu hatası (Iteration {iteration}): {query} - {str(query_error)}")
-        except ImportError:
-            logging.error("DuckDuckGo search modülü bulunamadı.")
-            return "Arama yapılamadı: Modül hatası", [] # Return empty results list
-        except Exception as search_error:
-            logging.error(f"DuckDuckGo arama hatası (Iteration {iteration}): {str(search_error)}", exc_info=True)
-
-            # Fallback to alternative search method
+    async def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry:
+            if time.time() - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                self.stats["saved_seconds"] += entry[2]
+                return entry[0]
+            del self._entries[key]
+        if self._conn is not None:
+            row = await asyncio.to_thread(self._disk_get, key)
+            if row and time.time() - row[1] < self.ttl:
+                results = json.loads(row[0])
+                self._remember(key, results, row[1], row[2])
+                self.stats["disk_hits"] += 1
+                self.stats["saved_seconds"] += row[2]
+                return results
+        return None
+
+    async def _fetch(self, key, fetch):
+        started = time.monotonic()
+        results = await fetch()
+        fetch_seconds = time.monotonic() - started
+        # Failed or empty searches are not cached so the next request tries again
+        if results:
+            stored_at = time.time()
+            self._remember(key, results, stored_at, fetch_seconds)
+            if self._conn is not None:
+                try:
+                    await asyncio.to_thread(self._disk_put, key, results, stored_at, fetch_seconds)
+                except Exception as e:
+                    logging.warning(f"Arama önbelleği diske yazılamadı: {e}")
+        return results
+
+    async def get_or_fetch(self, query, max_results, fetch):
+        """Return cached results for the query, or run fetch() once for all concurrent callers."""
+        key = f"{max_results}:{normalize_search_query(query)}"
+        results = await self._lookup(key)
+        if results is not None:
+            return results
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shield so one caller timing out doesn't cancel the search for the others
+        return await asyncio.shield(task)
+
+    def report(self):
+        lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["coalesced"] + self.stats["misses"]
+        hits = lookups - self.stats["misses"]
+        hit_rate = hits / lookups if lookups else 0.0
+        return {**self.stats, "saved_seconds": round(self.stats["saved_seconds"], 2),
+                "lookups": lookups, "hit_rate": round(hit_rate, 3), "entries": len(self._entries)}
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+# Web search backend
+class WebSearchBackend:
+    """
+    Async search interface. DuckDuckGo's client is blocking, so queries run on a
+    bounded thread pool; the HTML fallback goes through the shared HTTP client. A global semaphore caps
+    concurrent searches and every query has its own timeout.
+    """
+    def __init__(self, max_concurrency=SEARCH_MAX_CONCURRENCY, query_timeout=SEARCH_QUERY_TIMEOUT,
+                 fallback_url=SEARCH_FALLBACK_URL, ddg_enabled=True, cache=None):
+        self.query_timeout = query_timeout
+        self.cache = cache if cache is not None else SearchCache()
+        self.fallback_url = fallback_url
+        self.ddg_enabled = ddg_enabled
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="web-search")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _ddg_search(self, query, max_results):
+        # Runs in a worker thread
+        with DDGS(timeout=self.query_timeout) as ddgs:
+            results = list(ddgs.text(query, max_results=max_results))
+        # DuckDuckGo returns the URL as 'href'; the rest of the bot reads 'link'
+        return [{**result, 'link': result.get('href', result.get('link'))} for result in results]
+
+    @staticmethod
+    def _parse_fallback_results(html, max_results):
+        # Basic parsing, can be improved
+        soup = BeautifulSoup(html, 'html.parser')
+        parsed_results = []
+        for result in soup.find_all('div', class_='g')[:max_results]:
+            title = result.find('h3')
+            link = result.find('a')
+            snippet = result.find('div', class_='VwiC3b')
+            if title and link and snippet:
+                parsed_results.append({
+                    'title': title.text,
+                    'link': link['href'],
+                    'body': snippet.text
+                })
+        return parsed_results
+
+    async def _fallback_search(self, query, max_results):
+        response = await http_client.get(self.fallback_url, params={'q': query}, timeout=self.query_timeout)
+        if response.status_code != 200:
+            return []
+        # HTML parsing is CPU work; keep it off the event loop too
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._parse_fallback_results, response.text, max_results)
+
+    async def search(self, query, max_results=5):
+        """Search one query, served from the cache when a fresh result exists."""
+        return await self.cache.get_or_fetch(query, max_results, lambda: self._search_uncached(query, max_results))
+
+    async def _search_uncached(self, query, max_results):
+        # DuckDuckGo first, the HTML fallback if it fails or times out
+        async with self._semaphore:
+            if self.ddg_enabled:
+                try:
+                    loop = asyncio.get_running_loop()
+                    results = await asyncio.wait_for(
+                        loop.run_in_executor(self._executor, self._ddg_search, query, max_results),
+                        timeout=self.query_timeout
+                    )
+                    logging.info(f"DuckDuckGo: {len(results)} sonuç ({query})")
+                    return results
+                except Exception as search_error:
+                    logging.warning(f"DuckDuckGo arama hatası, fallback kullanılıyor: {query} - {search_error!r}")
             try:
-                import requests
-
-                def fallback_search(query):
-                    headers = {
-                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                    }
-                    search_url = f"https://www.google.com/search?q={query}"
-                    response = requests.get(search_url, headers=headers)
-
-                    if response.status_code == 200:
-                        # Basic parsing, can be improved
-                        soup = BeautifulSoup(response.text, 'html.parser')
-                        search_results_fallback = soup.find_all('div', class_='g')
-
-                        parsed_results = []
-                        for result in search_results_fallback[:5]: # Increased max_results for fallback as well
-                            title = result.find('h3')
-                            link = result.find('a')
-                            snippet = result.find('div', class_='VwiC3b')
-
-                            if title and link and snippet:
-                                parsed_results.append({
-                                    'title': title.text,
-                                    'link': link['href'],
-                                    'body': snippet.text
-                                })
-
-                        return parsed_results
-                    return []
-
-                for query in search_queries:
-                    results = fallback_search(query)
-                    search_results.extend(results)
-
-                logging.info(f"Fallback arama sonuç sayısı (Iteration {iteration}): {len(search_results)}")
+                results = await asyncio.wait_for(self._fallback_search(query, max_results), timeout=self.query_timeout)
+                logging.info(f"Fallback arama: {len(results)} sonuç ({query})")
+                return results
             except Exception as fallback_error:
-                logging.error(f"Fallback arama hatası (Iteration {iteration}): {str(fallback_error)}")
-                return f"Arama yapılamadı: {str(fallback_error)}", [] # Return empty results list
+                logging.error(f"Fallback arama hatası: {query} - {fallback_error!r}")
+                return []
 
-        logging.info(f"Toplam bulunan arama sonuç sayısı (Iteration {iteration}): {len(search_results)}")
+    async def search_many(self, queries, max_results=5):
+        """Run all queries concurrently and return their results in query order."""
+        batches = await asyncio.gather(*(self.search(query, max_results) for query in queries))
+        return [result for batch in batches for result in batch]
 
-        # Check if search results are empty
-        if not search_results:
-            return "Arama sonucu bulunamadı. Lütfen farklı bir şekilde sormayı deneyin.", [] # Return empty results list
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.cache.close()
 
-        # Prepare search context (no change needed here for now)
-        search_context = "\n\n".join([
-            f"Arama Sonucu {i+1}: {result.get('body', 'İçerik yok')}\nKaynak: {result.get('link', 'Bağlantı yok')}"
-            for i, result in enumerate(search_results)
-        ])
+web_search_backend = WebSearchBackend()
+
+# Search result deduplication
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid', 'ref', 'ref_src', 'ref_url', 'cmpid', 'ocid'}
+
+def canonicalize_url(url):
+    """Normalize a URL for exact-duplicate checks: scheme and host case, www, default ports, tracking params, fragments."""
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url
+    if not parts.netloc:
+        return url
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_') and key.lower() not in TRACKING_PARAMS
+    )
+    path = parts.path.rstrip('/') or '/'
+    # http and https copies of a page are the same result
+    return urlunsplit(('https', host, path, urlencode(query), ''))
+
+def word_shingles(text, shingle_size=3):
+    words = re.findall(r'\w+', text.casefold())
+    return [' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))] if words else []
+
+def simhash(text, shingle_size=3):
+    """64-bit SimHash over word shingles."""
+    shingles = word_shingles(text, shingle_size)
+    if not shingles:
+        return 0
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def format_search_results(results):
+    """Search results as prompt context, one numbered block per result."""
+    return "\n\n".join([
+        f"Arama Sonucu {i+1}: {result.get('body', 'İçerik yok')}\nKaynak: {result.get('link', 'Bağlantı yok')}"
+        for i, result in enumerate(results)
+    ])
+
+class SearchResultDeduplicator:
+    """
+    Incremental dedup for search results: exact matches on the canonical URL, near
+    duplicates (syndicated copies, mirrors) by SimHash distance between snippets.
+    Feed results as they arrive; only the new ones come back, and `last_novelty`
+    is the share of the batch's snippet shingles that had not been seen before.
+    """
+    def __init__(self, max_distance=SEARCH_SIMHASH_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._urls = set()
+        self._fingerprints = []  # a deep search keeps a few dozen results, a linear scan is enough
+        self._shingles = set()
+        self.last_novelty = 1.0
+        self.stats = {"kept": 0, "duplicate_urls": 0, "near_duplicates": 0, "tokens_saved": 0}
+
+    def _duplicate_reason(self, result):
+        link = result.get('link') or result.get('href')
+        url = canonicalize_url(link) if link else None
+        if url and url in self._urls:
+            return "duplicate_urls", url, None
+        body = result.get('body') or ''
+        fingerprint = simhash(body) if len(body.split()) >= 5 else None
+        if fingerprint is not None:
+            for seen in self._fingerprints:
+                if bin(fingerprint ^ seen).count('1') <= self.max_distance:
+                    return "near_duplicates", url, fingerprint
+        return None, url, fingerprint
+
+    def add_many(self, results):
+        """Return the results not seen before, in order."""
+        batch_shingles = set()
+        for result in results:
+            batch_shingles.update(word_shingles(result.get('body') or ''))
+        self.last_novelty = len(batch_shingles - self._shingles) / len(batch_shingles) if batch_shingles else 0.0
+        self._shingles |= batch_shingles
+        kept = []
+        for result in results:
+            reason, url, fingerprint = self._duplicate_reason(result)
+            if reason:
+                self.stats[reason] += 1
+                self.stats["tokens_saved"] += token_counter.count(format_search_results([result]))
+                continue
+            if url:
+                self._urls.add(url)
+            if fingerprint is not None:
+                self._fingerprints.append(fingerprint)
+            self.stats["kept"] += 1
+            kept.append(result)
+        return kept
+
+# Page fetching and content extraction
+class ReadableTextParser(HTMLParser):
+    """Incremental HTML-to-text extractor: keeps paragraph-like blocks, skips scripts, navigation and boilerplate."""
+    SKIP_TAGS = {'script', 'style', 'noscript', 'svg', 'nav', 'header', 'footer', 'aside', 'form', 'iframe', 'template', 'button', 'select'}
+    BLOCK_TAGS = {'p', 'div', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'article', 'section', 'main', 'blockquote', 'pre', 'td', 'dd', 'br', 'tr', 'table', 'ul', 'ol'}
+    VOID_TAGS = {'br', 'img', 'hr', 'meta', 'link', 'input', 'source', 'wbr', 'area', 'base', 'col', 'embed', 'param', 'track'}
+    MIN_BLOCK_CHARS = 40  # shorter blocks are usually menus, buttons or captions
+
+    def __init__(self, max_chars=PAGE_TEXT_MAX_CHARS):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.blocks = []
+        self.title = ''
+        self.text_chars = 0
+        self._current = []
+        self._skip_depth = 0
+        self._in_title = False
+
+    def _flush_block(self):
+        text = ' '.join(' '.join(self._current).split())
+        self._current = []
+        if len(text) >= self.MIN_BLOCK_CHARS and self.text_chars < self.max_chars:
+            text = text[:self.max_chars - self.text_chars]
+            self.blocks.append(text)
+            self.text_chars += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == 'title':
+            self._in_title = True
+        elif tag in self.BLOCK_TAGS:
+            self._flush_block()
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self._flush_block()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag == 'title':
+            self._in_title = False
+        elif tag in self.BLOCK_TAGS:
+            self._flush_block()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip_depth:
+            self._current.append(data)
+
+    def close(self):
+        super().close()
+        self._flush_block()
+
+def split_into_passages(blocks, passage_chars=PAGE_PASSAGE_CHARS):
+    """Pack text blocks into passages of about passage_chars, splitting long blocks at sentence ends."""
+    passages = []
+    current = ''
+    for block in blocks:
+        pieces = [block] if len(block) <= passage_chars else re.split(r'(?<=[.!?])\s+', block)
+        for piece in pieces:
+            while len(piece) > passage_chars:
+                cut = piece.rfind(' ', 0, passage_chars)
+                cut = cut if cut > 0 else passage_chars
+                if current:
+                    passages.append(current)
+                    current = ''
+                passages.append(piece[:cut])
+                piece = piece[cut:].lstrip()
+            if current and len(current) + len(piece) + 1 > passage_chars:
+                passages.append(current)
+                current = ''
+            current = f"{current} {piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+class PageFetcher:
+    """
+    Fetches result pages concurrently through the shared HTTP client and extracts
+    their readable text while streaming, so a page stops downloading as soon as
+    enough text has been read. Requests to one host are serialized and spaced out
+    across all fetchers sharing the client, and the whole stage has a time budget:
+    pages still loading when it runs out contribute whatever text they had so far.
+    """
+    def __init__(self, client=None, max_bytes=PAGE_FETCH_MAX_BYTES, max_chars=PAGE_TEXT_MAX_CHARS,
+                 host_interval=PAGE_FETCH_HOST_INTERVAL, allow_private=False):
+        self.client = client or page_http_client
+        self.max_bytes = max_bytes
+        self.max_chars = max_chars
+        self.host_interval = host_interval
+        self.allow_private = allow_private
+
+    async def _is_public(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            return False
+        if self.allow_private:
+            return True
+        # Search results are untrusted; don't let them point us at internal services.
+        # This only skips obvious cases early; page_http_client enforces it on connect.
+        try:
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            address = ipaddress.ip_address(await self.client.dns.resolve(parts.hostname, port))
+        except (OSError, ValueError):
+            return False
+        return address.is_global
+
+    async def _fetch_page(self, url, page):
+        if not await self._is_public(url):
+            logging.info(f"Sayfa atlandı (geçersiz veya özel adres): {url}")
+            return
+        host = urlsplit(url).hostname
+        # Spacing is shared with every other fetcher using this client
+        async with self.client.pacer.turn(host, self.host_interval):
+            # Follow redirects by hand so every hop is checked like the first URL
+            for _ in range(PAGE_FETCH_MAX_REDIRECTS + 1):
+                async with self.client.stream(url, max_bytes=self.max_bytes, follow_redirects=False) as (response, body):
+                    if response.is_redirect:
+                        url = urljoin(url, response.headers['location'])
+                        if not await self._is_public(url):
+                            logging.info(f"Sayfa atlandı (özel adrese yönlendirme): {url}")
+                            return
+                        continue
+                    content_type = response.headers.get('content-type', '')
+                    if response.status_code != 200 or not content_type.startswith(('text/html', 'text/plain', 'application/xhtml')):
+                        logging.info(f"Sayfa atlandı ({response.status_code}, {content_type}): {url}")
+                        return
+                    parser = page['parser']
+                    try:
+                        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+                    except LookupError:
+                        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                    async for chunk in body:
+                        parser.feed(decoder.decode(chunk))
+                        page['bytes'] += len(chunk)
+                        if parser.text_chars >= self.max_chars:
+                            break
+                    return
+            logging.info(f"Sayfa atlandı (çok fazla yönlendirme): {url}")
+
+    async def fetch_passages(self, urls, budget=PAGE_FETCH_BUDGET):
+        """Fetch the pages and return passages as dicts with 'link', 'title' and 'text', in URL order."""
+        started = time.monotonic()
+        pages = {url: {'parser': ReadableTextParser(self.max_chars), 'bytes': 0} for url in dict.fromkeys(urls)}
+        tasks = {asyncio.ensure_future(self._fetch_page(url, page)): url for url, page in pages.items()}
+        if not tasks:
+            return []
+        done, pending = await asyncio.wait(tasks, timeout=budget)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if not task.cancelled() and task.exception():
+                logging.warning(f"Sayfa alınamadı: {tasks[task]} - {task.exception()!r}")
+        passages = []
+        for url, page in pages.items():
+            parser = page['parser']
+            parser.close()
+            for text in split_into_passages(parser.blocks):
+                passages.append({'link': url, 'title': ' '.join(parser.title.split()), 'text': text})
+        logging.info(f"Page fetch: {len(done)}/{len(tasks)} pages finished, {len(pending)} cut by the {budget}s budget, "
+                     f"{sum(page['bytes'] for page in pages.values())} bytes read, {len(passages)} passages, "
+                     f"{time.monotonic() - started:.2f}s")
+        return passages
+
+# Search query generation and execution
+async def generate_search_queries(user_message, user_id, iteration=0):
+    """Ask Gemini for up to 3 search queries for the message, using recent conversation context. Returns None on failure."""
+    # Konuşma geçmişini al
+    context_messages = user_memory.get_recent_messages(user_id, 5) # Son 5 mesajı alalım, isteğe göre ayarlanabilir
+    history_text = "\n".join([
+        f"{'Kullanıcı' if msg['role'] == 'user' else 'Asistan'}: {msg['content']}"
+        for msg in context_messages
+    ])
+
+    query_generation_prompt = f"""
+    Görevin, kullanıcının son mesajını ve önceki konuşma bağlamını dikkate alarak en alakalı web arama sorgularını oluşturmak.
+    Bu sorgular, derinlemesine araştırma yapmak için kullanılacak. Eğer kullanıcının son mesajı önceki konuşmaya bağlı bir devam sorusu ise,
+    bağlamı kullanarak daha eksiksiz ve anlamlı sorgular üret.
+
+    Önceki Konuşma Bağlamı (Son 5 Mesaj):
+    ```
+    {history_text}
+    ```
+
+    Kullanıcı Mesajı: {user_message}
+
+    Kurallar:
+    - En fazla 3 sorgu oluştur
+    - Her sorgu yeni bir satırda olmalı
+    - Sorgular net ve spesifik olmalı
+    - Türkçe dilinde ve güncel bilgi içermeli
+    """
+
+    # Use Gemini to generate search queries with timeout
+    logging.info(f"Generating search queries with Gemini (Iteration {iteration})")
+    try:
+        query_response = await gemini_models.generate("search_queries", query_generation_prompt)
+        logging.info(f"Gemini response received for queries (Iteration {iteration}): {query_response.text}")
+    except asyncio.TimeoutError:
+        logging.error(f"Gemini API request timed out (Query generation, Iteration {iteration})")
+        return None
+    except Exception as e:
+        logging.error(f"Error generating search queries (Iteration {iteration}): {str(e)}")
+        return None
+
+    search_queries = [q.strip() for q in query_response.text.split('\n') if q.strip()][:3]
 
-        return search_context, search_results # Return both context and results for deeper processing
+    # Fallback if no queries generated
+    if not search_queries:
+        search_queries = [user_message]
+
+    logging.info(f"Generated search queries (Iteration {iteration}): {search_queries}")
+    return search_queries
+
+async def run_search_queries(search_queries, iteration=0, deduplicator=None):
+    """Run the queries concurrently and return (search_context, new_results)."""
+    logging.info(f"Web araması yapılıyor (Iteration {iteration}): {search_queries}")
+    search_results = await web_search_backend.search_many(search_queries, max_results=5) # Increased max_results for deep search
+    # Queries overlap, so drop results already returned by another query (or an earlier iteration)
+    if deduplicator is None:
+        deduplicator = SearchResultDeduplicator()
+    search_results = deduplicator.add_many(search_results)
+
+    logging.info(f"Toplam bulunan arama sonuç sayısı (Iteration {iteration}): {len(search_results)}")
+
+    # Check if search results are empty
+    if not search_results:
+        return "Arama sonucu bulunamadı. Lütfen farklı bir şekilde sormayı deneyin.", [] # Return empty results list
+
+    return format_search_results(search_results), search_results
+
+# Intelligent web search function
+async def intelligent_web_search(user_message, user_id, iteration=0, deduplicator=None): # user_id parametresi eklendi
+    """
+    Intelligently generate and perform web searches using Gemini, now with iteration info and user context
+    """
+    try:
+        logging.info(f"Web search başlatıldı (Iteration {iteration}): {user_message}, User ID: {user_id}")
+
+        search_queries = await generate_search_queries(user_message, user_id, iteration)
+        if search_queries is None:
+            return "Üzgünüm, şu anda arama yapamıyorum. Lütfen daha sonra tekrar deneyin.", [] # Return empty results list
+
+        return await run_search_queries(search_queries, iteration, deduplicator) # Return both context and results for deeper processing
 
     except Exception as e:
         logging.error(f"Web arama genel hatası (Iteration {iteration}): {str(e)}", exc_info=True)
@@ -611,26 +3039,49 @@ async def perform_deep_search(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     MAX_ITERATIONS = 3  # Limit iterations to prevent infinite loops (can be adjusted)
     all_search_results = []
-    current_query = user_message
-    model = genai.GenerativeModel('gemini-2.0-flash-lite')
+    results_by_iteration = []
+    deduplicator = SearchResultDeduplicator()
+    start_deadline(DEEP_SEARCH_DEADLINE)
 
     try:
         await context.bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.TYPING)
 
+        search_queries = await generate_search_queries(user_message, user_id, 1)
+        if search_queries is None:
+            await update.message.reply_text("Üzgünüm, şu anda arama yapamıyorum. Lütfen daha sonra tekrar deneyin.")
+            return
+
         for iteration in range(MAX_ITERATIONS):
-            search_context, search_results = await intelligent_web_search(current_query, model, user_id, iteration + 1) # user_id eklendi
+            # Refined queries run directly and concurrently; no second query-generation round trip
+            iteration_started = time.monotonic()
+            search_context, search_results = await run_search_queries(search_queries, iteration + 1, deduplicator)
+            search_seconds = time.monotonic() - iteration_started
+            novelty = deduplicator.last_novelty
+            logging.info(f"Deep search iteration {iteration + 1}: {len(search_queries)} queries, {len(search_results)} new results, "
+                         f"novelty {novelty:.2f}, search {search_seconds:.2f}s")
             if not search_results:
+                if all_search_results:
+                    logging.info(f"Deep search iteration {iteration + 1} found nothing new, stopping.")
+                    break
                 await update.message.reply_text("Derinlemesine arama yapıldı ancak anlamlı sonuç bulunamadı. Lütfen sorgunuzu kontrol edin veya daha sonra tekrar deneyin.")
                 return
 
             all_search_results.extend(search_results)
+            results_by_iteration.append(search_results)
+
+            # Stop when this round mostly repeated what we already had, or there are no rounds left to refine for
+            if iteration > 0 and novelty < DEEP_SEARCH_MIN_NOVELTY:
+                logging.info(f"Deep search novelty {novelty:.2f} below {DEEP_SEARCH_MIN_NOVELTY}, stopping after iteration {iteration + 1}.")
+                break
+            if iteration == MAX_ITERATIONS - 1:
+                break
 
             # --- Chain of Thoughts and Query Refinement ---
             analysis_prompt = f"""
             Görevin: Web arama sonuçlarını analiz ederek daha derinlemesine arama yapmak için yeni ve geliştirilmiş arama sorguları üretmek.
 
             Kullanıcı Sorgusu: "{user_message}"
-            Mevcut Arama Sorgusu (Iteration {iteration + 1}): "{current_query}"
+            Mevcut Arama Sorguları (Iteration {iteration + 1}): {search_queries}
             Arama Sonuçları (Iteration {iteration + 1}):
             {search_context}
 
@@ -644,10 +3095,12 @@ async def perform_deep_search(update: Update, context: ContextTypes.DEFAULT_TYPE
             """
 
             try:
-                query_refinement_response = await model.generate_content_async(analysis_prompt)
+                refine_started = time.monotonic()
+                query_refinement_response = await gemini_models.generate("deep_search", analysis_prompt)
                 refined_queries = [q.strip() for q in query_refinement_response.text.split('\n') if q.strip()][:3] # Limit to 3 refined queries
+                logging.info(f"Deep search iteration {iteration + 1}: refinement {time.monotonic() - refine_started:.2f}s")
                 if refined_queries:
-                    current_query = " ".join(refined_queries) # Use refined queries for the next iteration, combining them for broader search in next iteration
+                    search_queries = refined_queries # Each refined query is searched on its own in the next iteration
                     logging.info(f"Refined queries for iteration {iteration + 2}: {refined_queries}")
                 else:
                     logging.info(f"No refined queries generated in iteration {iteration + 1}, stopping deep search.")
@@ -657,15 +3110,41 @@ async def perform_deep_search(update: Update, context: ContextTypes.DEFAULT_TYPE
                 logging.info("Stopping deep search due to query refinement error.")
                 break # Stop if query refinement fails
 
+        logging.info(f"Deep search dedup: {deduplicator.stats}")
+
+        # Optionally read the top result pages instead of relying on snippets alone
+        page_passages_text = ""
+        if DEEP_SEARCH_FETCH_PAGES > 0 and all_search_results:
+            top_links = [result['link'] for result in all_search_results if str(result.get('link', '')).startswith('http')][:DEEP_SEARCH_FETCH_PAGES]
+            passages = await PageFetcher().fetch_passages(top_links)
+            passages_per_page = {}
+            selected = []
+            for passage in passages:
+                # A few passages per page keep the final prompt bounded
+                if passages_per_page.get(passage['link'], 0) < 3:
+                    passages_per_page[passage['link']] = passages_per_page.get(passage['link'], 0) + 1
+                    selected.append(passage)
+            page_passages_text = "\n\n".join(
+                f"Sayfa Metni ({passage['title'] or passage['link']}): {passage['text']}\nKaynak: {passage['link']}"
+                for passage in selected
+            )
+
         # --- Final Response Generation ---
         if all_search_results:
+            all_results_text = "\n\n".join(
+                f"Iteration {i+1} Results:\n{format_search_results(results)}"
+                for i, results in enumerate(results_by_iteration)
+            )
             # Summarize all results and create a comprehensive response
             final_prompt = f"""
             Görevin: Derinlemesine web araması sonuçlarını kullanarak kullanıcıya kapsamlı ve bilgilendirici bir cevap oluşturmak.
 
             Kullanıcı Sorgusu: "{user_message}"
             Tüm Arama Sonuçları:
-            {''.join([f'Iteration {i+1} Results:\n' + '\\n'.join([f"Arama Sonucu {j+1}: {res.get('body', 'İçerik yok')}\\nKaynak: {res.get('link', 'Bağlantı yok')}" for j, res in enumerate(all_search_results[i*5:(i+1)*5])]) + '\\n\\n' for i in range(MAX_ITERATIONS)])}
+            {all_results_text}
+
+            Sayfa İçeriklerinden Bölümler:
+            {page_passages_text or 'Yok'}
 
             Yönergeler:
             1. Tüm arama sonuçlarını özetle ve ana temaları belirle.
@@ -677,7 +3156,7 @@ async def perform_deep_search(update: Update, context: ContextTypes.DEFAULT_TYPE
             """
 
             try:
-                final_response = await model.generate_content_async(final_prompt)
+                final_response = await gemini_models.generate("deep_search", final_prompt)
                 # **Yeni Kontrol: Yanıt Engellenmiş mi? (Derin Arama)**
                 if final_response.prompt_feedback and final_response.prompt_feedback.block_reason:
                     block_reason = final_response.prompt_feedback.block_reason
@@ -686,7 +3165,7 @@ async def perform_deep_search(update: Update, context: ContextTypes.DEFAULT_TYPE
                     await update.message.reply_text(error_message)
                 else:
                     response_text = final_response.text if hasattr(final_response, 'text') else final_response.candidates[0].content.parts[0].text
-                    response_text = add_emojis_to_text(response_text)
+                    response_text = await add_emojis_to_text(response_text)
                     await split_and_send_message(update, response_text)
 
                     # Save interaction to memory (important to record deep search context if needed later)
@@ -694,6 +3173,9 @@ async def perform_deep_search(update: Update, context: ContextTypes.DEFAULT_TYPE
                     user_memory.add_message(user_id, "assistant", response_text)
 
 
+            except GeminiUnavailable as unavailable_error:
+                logging.error(f"Gemini unavailable, sending degraded reply: {unavailable_error}")
+                await update.message.reply_text(get_error_message('service_unavailable', user_lang))
             except Exception as final_response_error:
                 logging.error(f"Error generating final response for deep search: {final_response_error}")
                 await update.message.reply_text(get_error_message('ai_error', user_lang))
@@ -757,14 +3239,13 @@ async def should_perform_web_search(message_text, conversation_context, user_id)
         Yanıt SADECE JSON formatında olmalı, açıklama veya ek metin içermemeli.
         """
         
-        model = genai.GenerativeModel('gemini-2.0-flash-lite')
-        response = await model.generate_content_async(evaluation_prompt)
+        response_text = await gemini_models.generate_text("search_decision", evaluation_prompt)
         
         # Yanıt metninden JSON çıkar
         import json
         import re
         
-        response_text = response.text.strip()
+        response_text = (response_text or '').strip()
         
         # JSON formatını temizle (sadece süslü parantezler arasındaki içeriği al)
         json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
@@ -785,6 +3266,173 @@ async def should_perform_web_search(message_text, conversation_context, user_id)
         logger.error(f"Web arama kararı hatası: {str(e)}")
         return False, f"Hata: {str(e)}"
 
+# Token budgeting for prompt assembly
+class TokenCounter:
+    """
+    Cheap prompt token estimator calibrated against the token counts Gemini
+    reports in usage_metadata. Per-text estimates are cached, so history
+    messages are only measured once.
+    """
+
+    def __init__(self):
+        self.ratio = 1.0  # actual / estimated, exponential moving average
+
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def _base_estimate(text):
+        # ~4 characters per token for Latin scripts, but never fewer than the word count
+        return max(len(text) // 4, len(text.split())) + 1
+
+    def count(self, text):
+        return int(self._base_estimate(text) * self.ratio) + 1
+
+    def observe(self, estimated_tokens, response):
+        """Update the calibration from a response's usage metadata."""
+        usage = getattr(response, 'usage_metadata', None)
+        actual = getattr(usage, 'prompt_token_count', 0) if usage else 0
+        if not actual or not estimated_tokens:
+            return
+        observed = self.ratio * actual / estimated_tokens
+        self.ratio = min(max(0.8 * self.ratio + 0.2 * observed, 0.5), 3.0)
+
+token_counter = TokenCounter()
+
+def format_history(messages):
+    return "\n".join([
+        f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
+        for msg in messages
+    ])
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text so its estimate fits max_tokens (proportional cut by characters)."""
+    if max_tokens <= 0:
+        return ""
+    tokens = token_counter.count(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:int(len(text) * max_tokens / tokens)]
+
+def is_token_limit_error(error):
+    message = str(error).lower()
+    return "token limit" in message or "exceeds the maximum number of tokens" in message or "input token count" in message
+
+def build_chat_prompt(personality_context, history_messages, message_text, user_lang, web_search_response, budget):
+    """
+    Assemble the chat prompt in one pass within `budget` tokens. The personality,
+    instructions and user message are always included; search results keep at
+    least CONTEXT_SEARCH_SHARE of what is left and history is packed newest first.
+    Returns the prompt and its estimated token count.
+    """
+    def render(history_text, search_text):
+        prompt = f"""{personality_context}
+
+Task: Respond to the user's message naturally and engagingly in their language.
+Role: You are Nyxie having a conversation with the user.
+
+Previous conversation context:
+{history_text}
+
+Guidelines:
+1. Respond in the detected language: {user_lang}
+2. Use natural and friendly language
+3. Be culturally appropriate
+4. Keep responses concise
+5. Remember previous context
+6. Give your response directly without any prefix or label
+7. Do not start your response with "Yanıt:" or any similar prefix
+
+User's message: {message_text}"""
+        if search_text:
+            prompt += f"\n\nAdditional Context (Web Search Results):\n{search_text}"
+        return prompt
+
+    remaining = budget - token_counter.count(render("", ""))
+    history_lines = [format_history([msg]) for msg in history_messages]
+    history_costs = [token_counter.count(line) for line in history_lines]
+
+    search_tokens = token_counter.count(web_search_response) if web_search_response else 0
+    search_allowance = min(search_tokens, max(remaining - sum(history_costs), int(remaining * CONTEXT_SEARCH_SHARE)))
+    search_text = truncate_to_tokens(web_search_response, search_allowance) if web_search_response else ""
+
+    history_allowance = remaining - search_allowance
+    kept = []
+    for line, cost in zip(reversed(history_lines), reversed(history_costs)):
+        if cost > history_allowance:
+            break
+        kept.append(line)
+        history_allowance -= cost
+    kept.reverse()
+
+    if len(kept) < len(history_lines) or len(search_text) < len(web_search_response or ""):
+        logger.info(f"Prompt packed into {budget} tokens: {len(kept)}/{len(history_lines)} history messages, "
+                    f"search context {len(search_text)}/{len(web_search_response or '')} chars")
+
+    prompt = render("\n".join(kept), search_text)
+    return prompt, token_counter.count(prompt)
+
+# Turn pipeline: stages run as a dependency graph
+class TurnStage:
+    """
+    One step of a turn. `func` receives the results of finished stages by name.
+    On timeout or error the stage yields `fallback` (called with the results
+    if callable); stages without a fallback propagate the error.
+    """
+    REQUIRED = object()
+
+    def __init__(self, name, func, deps=(), timeout=None, fallback=REQUIRED):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.timeout = timeout
+        self.fallback = fallback
+
+async def run_turn_pipeline(stages, label=""):
+    """Run each stage as soon as its dependencies finish and log the critical path."""
+    results, spans, tasks = {}, {}, {}
+    turn_started = time.perf_counter()
+
+    async def run(stage):
+        await asyncio.gather(*(tasks[dep] for dep in stage.deps))
+        started = time.perf_counter()
+        try:
+            results[stage.name] = await asyncio.wait_for(stage.func(results), timeout=stage.timeout)
+        except Exception as e:
+            if stage.fallback is TurnStage.REQUIRED:
+                raise
+            if isinstance(e, asyncio.TimeoutError):
+                logger.warning(f"Stage '{stage.name}' timed out after {stage.timeout}s, using fallback")
+            else:
+                logger.error(f"Stage '{stage.name}' failed, using fallback: {e}")
+            results[stage.name] = stage.fallback(results) if callable(stage.fallback) else stage.fallback
+        finally:
+            spans[stage.name] = (started - turn_started, time.perf_counter() - turn_started)
+
+    # Stages must be listed after their dependencies
+    for stage in stages:
+        tasks[stage.name] = asyncio.create_task(run(stage))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        _log_turn_timings(stages, spans, time.perf_counter() - turn_started, label)
+    return results
+
+def _log_turn_timings(stages, spans, total, label):
+    # Walk back from the last stage to finish through the dependency that finished last
+    by_name = {stage.name: stage for stage in stages}
+    finished = [name for name in by_name if name in spans]
+    if not finished:
+        return
+    path, current = [], max(finished, key=lambda name: spans[name][1])
+    while current:
+        path.append(current)
+        deps = [dep for dep in by_name[current].deps if dep in spans]
+        current = max(deps, key=lambda dep: spans[dep][1]) if deps else None
+    critical = " -> ".join(f"{name} {spans[name][1] - spans[name][0]:.2f}s" for name in reversed(path))
+    others = ", ".join(f"{name} {spans[name][1] - spans[name][0]:.2f}s" for name in finished if name not in path)
+    logger.info(f"Turn timings{' ' + label if label else ''}: total {total:.2f}s, critical path: {critical}" + (f" (parallel: {others})" if others else ""))
+
 # Handle message function (modified to handle /derinarama command and context-aware search)
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info("Entering handle_message function")
@@ -813,6 +3461,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.message.text:
             message_text = update.message.text.strip()
             logger.info(f"Processed message text: {message_text}")
+            turn_started = time.monotonic()
+            start_deadline(TURN_DEADLINE)
 
             # Show typing indicator while processing
             async def show_typing():
@@ -830,121 +3480,114 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Start typing indicator in background
             typing_task = asyncio.create_task(show_typing())
 
-            try:
-                # Detect language from the current message
-                user_lang = await detect_and_set_user_language(message_text, user_id)
-                logger.info(f"Detected language: {user_lang}")
-
-                # Get conversation history with token management
-                MAX_RETRIES = 100
-                retry_count = 0
-                context_messages = []
-
-                while retry_count < MAX_RETRIES:
-                    try:
-                        context_messages = user_memory.get_relevant_context(user_id)
+            # Fallback language for error messages until detection finishes
+            user_lang = user_memory.get_user_settings(user_id).get('language', 'tr')
 
-                        # Get personality context
-                        personality_context = get_time_aware_personality(
-                            datetime.now(),
-                            user_lang,
-                            user_memory.get_user_settings(user_id).get('timezone', 'Europe/Istanbul')
+            try:
+                # Streamed replies become visible while generation is still running
+                streamer = StreamingReply(update.message) if STREAM_REPLIES else None
+
+                async def language_stage(results):
+                    return await detect_and_set_user_language(message_text, user_id)
+
+                async def history_stage(results):
+                    # Recent history; the prompt builder decides how much of it fits the budget
+                    return user_memory.get_recent_messages(user_id, CONTEXT_MAX_MESSAGES)
+
+                async def search_decision_stage(results):
+                    # Web araması gerekip gerekmediğini değerlendir (YENİ: Koşullu web araması)
+                    return await should_perform_web_search(message_text, format_history(results["history"]), user_id)
+
+                async def search_stage(results):
+                    should_search, search_reason = results["search_decision"]
+                    if not should_search:
+                        logger.info(f"Web araması atlandı. Neden: {search_reason}")
+                        return ""
+                    logger.info(f"Web araması yapılıyor. Neden: {search_reason}")
+                    web_search_response, _ = await intelligent_web_search(message_text, user_id)
+                    if not web_search_response or len(web_search_response.strip()) <= 10:
+                        return ""
+                    return web_search_response
+
+                async def generate_stage(results):
+                    personality_context = get_time_aware_personality(
+                        datetime.now(),
+                        results["language"],
+                        user_memory.get_user_settings(user_id).get('timezone', 'Europe/Istanbul')
+                    )
+                    # Pack everything into the token budget before the first request; if the
+                    # API still rejects the prompt, retry once with half the budget
+                    for attempt, budget in enumerate((CONTEXT_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGET // 2)):
+                        ai_prompt, estimated_tokens = build_chat_prompt(
+                            personality_context, results["history"], message_text, results["language"],
+                            results["search"], budget
                         )
-
-                        # Construct AI prompt
-                        ai_prompt = f"""{personality_context}
-
-Task: Respond to the user's message naturally and engagingly in their language.
-Role: You are Nyxie having a conversation with the user.
-
-Previous conversation context:
-{context_messages}
-
-Guidelines:
-1. Respond in the detected language: {user_lang}
-2. Use natural and friendly language
-3. Be culturally appropriate
-4. Keep responses concise
-5. Remember previous context
-6. Give your response directly without any prefix or label
-7. Do not start your response with "Yanıt:" or any similar prefix
-
-User's message: {message_text}"""
-
-                        # Web search integration (YENİ: Koşullu web araması)
                         try:
-                            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-                            
-                            # Web araması gerekip gerekmediğini değerlendir
-                            should_search, search_reason = await should_perform_web_search(
-                                message_text, 
-                                context_messages, 
-                                user_id
-                            )
-                            
-                            web_search_response = ""
-                            if should_search:
-                                logger.info(f"Web araması yapılıyor. Neden: {search_reason}")
-                                web_search_response, _ = await intelligent_web_search(message_text, model, user_id)
-                                
-                                if web_search_response and len(web_search_response.strip()) > 10:
-                                    ai_prompt += f"\n\nAdditional Context (Web Search Results):\n{web_search_response}"
-                                    logger.info("Web arama sonuçları prompt'a eklendi")
+                            if streamer is None:
+                                response = await gemini_models.generate("chat", ai_prompt)
                             else:
-                                logger.info(f"Web araması atlandı. Neden: {search_reason}")
-
-                            # Generate AI response
-                            response = await model.generate_content_async(ai_prompt)
-
-                            # **Yeni Kontrol: Yanıt Engellenmiş mi? (Normal Mesaj)**
-                            if response.prompt_feedback and response.prompt_feedback.block_reason:
-                                block_reason = response.prompt_feedback.block_reason
-                                logger.warning(f"Prompt blocked for regular message. Reason: {block_reason}")
-                                error_message = get_error_message('blocked_prompt', user_lang)
-                                await update.message.reply_text(error_message)
-                                break # Retry döngüsünden çık
-                            else: # Yanıt engellenmemişse normal işleme devam et
-                                response_text = response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
-
-                                # Add emojis and send response
-                                response_text = add_emojis_to_text(response_text)
-                                await split_and_send_message(update, response_text)
-
-                                # Save successful interaction to memory
-                                user_memory.add_message(user_id, "user", message_text)
-                                user_memory.add_message(user_id, "assistant", response_text)
-                                break  # Exit retry loop on success
-
-                        except Exception as search_error:
-                            if "Token limit exceeded" in str(search_error):
-                                # Remove oldest messages and retry
-                                user_memory.trim_context(user_id)
-                                retry_count += 1
-                                logger.warning(f"Token limit exceeded, retrying {retry_count}/{MAX_RETRIES}")
-
-                                # Send periodic update about retrying
-                                if retry_count % 10 == 0:
-                                    await update.message.reply_text(f"🔄 Devam eden token yönetimi... ({retry_count} deneme)")
-
-                                if retry_count == MAX_RETRIES:
-                                    error_message = get_error_message('token_limit', user_lang)
-                                    await update.message.reply_text(error_message)
-                            else:
-                                raise search_error
-
-                    except Exception as context_error:
-                        logger.error(f"Context retrieval error: {context_error}")
-                        retry_count += 1
-                        if retry_count == MAX_RETRIES:
-                            error_message = get_error_message('general', user_lang)
-                            await update.message.reply_text(error_message)
-                            break
-
-                if retry_count == MAX_RETRIES:
-                    logger.error("Max retries reached for token management")
-                    error_message = get_error_message('max_retries', user_lang)
+                                response = await gemini_models.generate("chat", ai_prompt, stream=True)
+                                await stream_response(response, streamer)
+                            token_counter.observe(estimated_tokens, response)
+                            return response
+                        except Exception as generation_error:
+                            if not is_token_limit_error(generation_error):
+                                raise
+                            logger.warning(f"Token limit exceeded with a budget of {budget} tokens (attempt {attempt + 1})")
+                    return None
+
+                def reply_text(results):
+                    response = results["generate"]
+                    if response is None or (response.prompt_feedback and response.prompt_feedback.block_reason):
+                        return None
+                    return response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
+
+                async def emoji_stage(results):
+                    text = reply_text(results)
+                    return await add_emojis_to_text(text)
+
+                results = await run_turn_pipeline([
+                    TurnStage("language", language_stage, timeout=STAGE_TIMEOUTS["language"], fallback=user_lang),
+                    TurnStage("history", history_stage, timeout=STAGE_TIMEOUTS["history"], fallback=[]),
+                    TurnStage("search_decision", search_decision_stage, deps=("history",),
+                              timeout=STAGE_TIMEOUTS["search_decision"], fallback=(False, "timeout")),
+                    TurnStage("search", search_stage, deps=("search_decision",),
+                              timeout=STAGE_TIMEOUTS["search"], fallback=""),
+                    TurnStage("generate", generate_stage, deps=("language", "history", "search"),
+                              timeout=STAGE_TIMEOUTS["generate"]),
+                    TurnStage("emoji", emoji_stage, deps=("generate",),
+                              timeout=STAGE_TIMEOUTS["emoji"], fallback=reply_text),
+                ], label=f"user {user_id}")
+
+                user_lang = results["language"]
+                logger.info(f"Detected language: {user_lang}")
+                response = results["generate"]
+
+                if response is None:
+                    await update.message.reply_text(get_error_message('token_limit', user_lang))
+                # **Yeni Kontrol: Yanıt Engellenmiş mi? (Normal Mesaj)**
+                elif response.prompt_feedback and response.prompt_feedback.block_reason:
+                    block_reason = response.prompt_feedback.block_reason
+                    logger.warning(f"Prompt blocked for regular message. Reason: {block_reason}")
+                    error_message = get_error_message('blocked_prompt', user_lang)
                     await update.message.reply_text(error_message)
+                else: # Yanıt engellenmemişse normal işleme devam et
+                    response_text = results["emoji"]
+                    if streamer is not None and streamer.started:
+                        await streamer.finish(response_text)
+                        first_visible = streamer.first_visible_at - turn_started
+                    else:
+                        await split_and_send_message(update, response_text)
+                        first_visible = time.monotonic() - turn_started
+                    logger.info(f"Time to first visible reply: {first_visible:.2f}s ({'streamed' if streamer is not None and streamer.started else 'buffered'})")
+
+                    # Save successful interaction to memory
+                    user_memory.add_message(user_id, "user", message_text)
+                    user_memory.add_message(user_id, "assistant", response_text)
 
+            except GeminiUnavailable as e:
+                logger.error(f"Gemini unavailable, sending degraded reply: {e}")
+                await update.message.reply_text(get_error_message('service_unavailable', user_lang))
             except Exception as e:
                 logger.error(f"Message processing error: {e}")
                 error_message = get_error_message('general', user_lang)
@@ -976,11 +3619,306 @@ User's message: {message_text}"""
         error_message = get_error_message('general', user_lang)
         await update.message.reply_text(error_message)
 
+# Image preprocessing
+def select_photo_size(photos, target_side=IMAGE_MAX_SIDE):
+    """Smallest Telegram rendition whose longer side reaches target_side, else the largest one."""
+    by_side = sorted(photos, key=lambda p: (max(p.width, p.height), p.file_size or 0))
+    for photo in by_side:
+        if max(photo.width, photo.height) >= target_side:
+            return photo
+    return by_side[-1]
+
+def _encode_jpeg(img, max_bytes):
+    for quality in IMAGE_JPEG_QUALITIES:
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True)
+        if out.tell() <= max_bytes:
+            return out.getvalue(), img
+    # Still too big at the lowest quality: shrink until it fits
+    while out.tell() > max_bytes and min(img.size) > 64:
+        img = img.resize((max(1, img.width * 3 // 4), max(1, img.height * 3 // 4)), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=IMAGE_JPEG_QUALITIES[-1], optimize=True)
+    return out.getvalue(), img
+
+def preprocess_image(data, max_side=IMAGE_MAX_SIDE, max_bytes=IMAGE_MAX_BYTES):
+    """
+    Downscale an image to max_side and re-encode it as a JPEG of at most max_bytes,
+    without EXIF/ICC metadata. Blocking (decoding is CPU work); run it in a thread.
+    Returns (jpeg bytes, (width, height)).
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        if (img.format == "JPEG" and len(data) <= max_bytes and max(img.size) <= max_side
+                and "exif" not in img.info and "icc_profile" not in img.info):
+            # Already small and clean; re-encoding would only cost quality
+            return data, img.size
+        # JPEG decoders can scale by 1/2..1/8 while decoding, far cheaper than a full decode
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        encoded, img = _encode_jpeg(img, max_bytes)
+        return encoded, img.size
+
+def image_dhash(data):
+    """64-bit difference hash: compares neighbouring pixels of a 9x8 grayscale thumbnail,
+    so recompressed, resized or re-forwarded copies of an image get (nearly) the same bits."""
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("L", (64, 64))
+        pixels = img.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with Hamming distance; search only
+    visits children whose edge distance is within max_distance of the query's."""
+    def __init__(self):
+        self.root = None  # [hash, values, {distance: child}]
+
+    def add(self, key, value):
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = bin(key ^ node[0]).count('1')
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """(distance, value) pairs within max_distance of key, nearest first."""
+        found, stack = [], [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = bin(key ^ node[0]).count('1')
+            if distance <= max_distance:
+                found.extend((distance, value) for value in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(found, key=lambda item: item[0])
+
+class ImageAnalysisCache:
+    """
+    Reuses image analyses for repeated and forwarded images. Keys always include the
+    caption and language, so the same image asked a different question misses.
+    Telegram's file_unique_id gives an exact match before any download; otherwise
+    a dHash lookup in a per-(caption, language) BK-tree finds near-duplicates, within
+    max_distance for anyone's image or same_user_distance for the asking user's own.
+    """
+    def __init__(self, ttl=IMAGE_CACHE_TTL, max_entries=IMAGE_CACHE_MAX_ENTRIES, max_distance=IMAGE_CACHE_MAX_DISTANCE,
+                 same_user_distance=IMAGE_CACHE_SAME_USER_DISTANCE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.same_user_distance = max(same_user_distance, max_distance)
+        self._entries = OrderedDict()  # entry id -> (scope, image hash, text, expires_at, user id)
+        self._by_file = {}  # (file_unique_id, caption, language) -> entry id
+        self._trees = {}  # (caption, language) -> BKTree of entry ids
+        self._scope_sizes = {}  # (caption, language) -> live entries; a scope's tree goes with its last entry
+        self._stale_scopes = set()  # trees still holding evicted entries
+        self._next_id = 0
+        self.stats = {"lookups": 0, "file_id_hits": 0, "hash_hits": 0}
+
+    @staticmethod
+    def _scope(caption, language):
+        return (' '.join((caption or '').lower().split()), language)
+
+    def _live(self, entry_id):
+        entry = self._entries.get(entry_id)
+        if entry is None or entry[3] <= time.monotonic():
+            return None
+        self._entries.move_to_end(entry_id)
+        return entry
+
+    def get_by_file(self, file_unique_id, caption, language):
+        """Exact match on the Telegram file; no download needed."""
+        self.stats["lookups"] += 1
+        entry = self._live(self._by_file.get((file_unique_id, *self._scope(caption, language))))
+        if entry is None:
+            return None
+        self.stats["file_id_hits"] += 1
+        return entry[2]
+
+    def get_similar(self, file_unique_id, image_hash, caption, language, user_id=None):
+        """Nearest cached analysis of a perceptually identical image. Call after a
+        get_by_file miss; a hit also remembers file_unique_id for next time."""
+        scope = self._scope(caption, language)
+        tree = self._tree(scope)
+        for distance, entry_id in tree.search(image_hash, self.same_user_distance) if tree else ():
+            entry = self._live(entry_id)
+            if entry is not None and (distance <= self.max_distance or (user_id is not None and entry[4] == user_id)):
+                self.stats["hash_hits"] += 1
+                self._by_file[(file_unique_id, *scope)] = entry_id
+                return entry[2]
+        return None
+
+    def put(self, file_unique_id, image_hash, caption, language, text, user_id=None):
+        scope = self._scope(caption, language)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (scope, image_hash, text, time.monotonic() + self.ttl, user_id)
+        self._scope_sizes[scope] = self._scope_sizes.get(scope, 0) + 1
+        self._by_file[(file_unique_id, *scope)] = entry_id
+        if image_hash is not None:
+            self._trees.setdefault(scope, BKTree()).add(image_hash, entry_id)
+        now = time.monotonic()
+        while self._entries and (len(self._entries) > self.max_entries or next(iter(self._entries.values()))[3] <= now):
+            _, (evicted_scope, _, _, _, _) = self._entries.popitem(last=False)
+            self._scope_sizes[evicted_scope] -= 1
+            if self._scope_sizes[evicted_scope]:
+                self._stale_scopes.add(evicted_scope)
+            else:
+                # Last entry of this caption/language: drop the scope entirely
+                del self._scope_sizes[evicted_scope]
+                self._trees.pop(evicted_scope, None)
+                self._stale_scopes.discard(evicted_scope)
+        if len(self._by_file) > 2 * self.max_entries:
+            self._by_file = {key: entry_id for key, entry_id in self._by_file.items() if entry_id in self._entries}
+
+    def _tree(self, scope):
+        # BK-trees can't delete; rebuild a scope's tree lazily once entries were evicted from it
+        if scope in self._stale_scopes:
+            self._stale_scopes.discard(scope)
+            tree = BKTree()
+            for entry_id, (entry_scope, image_hash, _, _, _) in self._entries.items():
+                if entry_scope == scope and image_hash is not None:
+                    tree.add(image_hash, entry_id)
+            if tree.root is None:
+                self._trees.pop(scope, None)
+                return None
+            self._trees[scope] = tree
+        return self._trees.get(scope)
+
+    def report(self):
+        hits = self.stats["file_id_hits"] + self.stats["hash_hits"]
+        lookups = self.stats["lookups"]
+        return {**self.stats, "hit_rate": round(hits / lookups, 3) if lookups else 0.0, "entries": len(self._entries),
+                "scopes": len(self._trees)}
+
+image_analysis_cache = ImageAnalysisCache()
+
+# Totals of what rendition selection and preprocessing saved, logged at shutdown
+image_stats = {"images": 0, "largest_bytes": 0, "uploaded_bytes": 0, "estimated_seconds_saved": 0.0}
+
+def record_image_savings(largest_bytes, downloaded_bytes, uploaded_bytes, download_seconds, preprocess_seconds):
+    """
+    Log bytes saved against downloading and uploading the largest rendition as-is.
+    Time saved is estimated from the measured download throughput, applied to
+    both the skipped download and the smaller upload, minus the time spent preprocessing.
+    """
+    throughput = downloaded_bytes / download_seconds if download_seconds > 0 else 0
+    transfer_saved = (largest_bytes - downloaded_bytes) + (largest_bytes - uploaded_bytes)
+    seconds_saved = (transfer_saved / throughput if throughput else 0.0) - preprocess_seconds
+    image_stats["images"] += 1
+    image_stats["largest_bytes"] += largest_bytes
+    image_stats["uploaded_bytes"] += uploaded_bytes
+    image_stats["estimated_seconds_saved"] += seconds_saved
+    logger.info(
+        f"Image upload: {uploaded_bytes} bytes instead of {largest_bytes} "
+        f"({largest_bytes - uploaded_bytes} saved), downloaded {downloaded_bytes} bytes in {download_seconds:.2f}s, "
+        f"preprocessed in {preprocess_seconds:.2f}s, ~{seconds_saved:.2f}s saved"
+    )
+
+# Video ingestion
+class VideoTooLarge(Exception):
+    pass
+
+async def download_to_tempfile(telegram_file, max_bytes=VIDEO_MAX_BYTES):
+    """
+    Stream a Telegram file into an anonymous temp file on disk without ever holding
+    it whole in RAM. Raises VideoTooLarge past max_bytes. The caller closes the
+    returned file.
+    """
+    # A real file object: genai.upload_file only accepts io.IOBase instances, which
+    # SpooledTemporaryFile isn't before Python 3.11
+    video_tmp = tempfile.TemporaryFile()
+    try:
+        if not telegram_file.file_path.startswith(("http://", "https://")):
+            # Local Bot API server: the file is already on this machine
+            with open(telegram_file.file_path, 'rb') as source:
+                while chunk := source.read(64 * 1024):
+                    video_tmp.write(chunk)
+                    if video_tmp.tell() > max_bytes:
+                        raise VideoTooLarge(f"video exceeds {max_bytes} bytes")
+        else:
+            # file_path embeds the bot token; httpx errors quote the URL, so redact it before anyone logs them
+            try:
+                async with http_client.stream(telegram_file.file_path, max_bytes=max_bytes + 1,
+                                              timeout=VIDEO_DOWNLOAD_TIMEOUT) as (response, body):
+                    response.raise_for_status()
+                    async for chunk in body:
+                        video_tmp.write(chunk)
+                    if body.truncated or body.size > max_bytes:
+                        raise VideoTooLarge(f"video exceeds {max_bytes} bytes")
+            except httpx.HTTPError as e:
+                raise httpx.HTTPError(redact_bot_token(f"{type(e).__name__}: {e}")) from None
+        video_tmp.seek(0)
+        return video_tmp
+    except BaseException:
+        video_tmp.close()
+        raise
+
+class GeminiFileUploader:
+    """
+    Sends media through the Gemini File API instead of inlining it in the request,
+    then waits until Gemini has processed it. The returned file can be passed as a
+    content part; delete() removes it once the answer is in.
+    """
+    async def upload(self, fileobj, mime_type):
+        uploaded = await asyncio.to_thread(genai.upload_file, fileobj, mime_type=mime_type)
+        remaining = remaining_time()
+        give_up_at = time.monotonic() + (VIDEO_PROCESSING_TIMEOUT if remaining is None else min(VIDEO_PROCESSING_TIMEOUT, remaining))
+        while uploaded.state.name == "PROCESSING":
+            if time.monotonic() > give_up_at:
+                await self.delete(uploaded)
+                raise asyncio.TimeoutError(f"Gemini still processing {uploaded.name}")
+            await asyncio.sleep(1)
+            uploaded = await asyncio.to_thread(genai.get_file, uploaded.name)
+        if uploaded.state.name != "ACTIVE":
+            await self.delete(uploaded)
+            raise RuntimeError(f"Gemini could not process {uploaded.name}: {uploaded.state.name}")
+        return uploaded
+
+    async def delete(self, uploaded):
+        try:
+            await asyncio.to_thread(genai.delete_file, uploaded.name)
+        except Exception as e:
+            # Gemini expires uploads on its own after 48 hours
+            logging.warning(f"Could not delete uploaded file {uploaded.name}: {e}")
+
+video_uploader = GeminiFileUploader()
+video_jobs = asyncio.Semaphore(VIDEO_MAX_CONCURRENT_JOBS)
+
+def peak_rss_mb():
+    """Peak resident memory of the process so far, in MB (None where unsupported)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB elsewhere
+
 # Image and Video handlers (düzenlenmiş)
 async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ... (same as before)
     user_id = str(update.effective_user.id)
 
+    start_deadline(TURN_DEADLINE)
+
     try:
         # Enhanced logging for debugging
         logger.info(f"Starting image processing for user {user_id}")
@@ -1002,25 +3940,15 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Görsel bulunamadı. Lütfen tekrar deneyin.")
             return
 
-        # Get the largest available photo
+        # Smallest rendition that is large enough for analysis
         try:
-            photo = max(update.message.photo, key=lambda x: x.file_size)
+            photo = select_photo_size(update.message.photo)
+            largest_photo = max(update.message.photo, key=lambda x: (x.width * x.height, x.file_size or 0))
         except Exception as photo_error:
             logger.error(f"Error selecting photo: {photo_error}")
             await update.message.reply_text("⚠️ Görsel seçiminde hata oluştu. Lütfen tekrar deneyin.")
             return
 
-        # Download photo
-        try:
-            photo_file = await context.bot.get_file(photo.file_id)
-            photo_bytes = bytes(await photo_file.download_as_bytearray())
-        except Exception as download_error:
-            logger.error(f"Photo download error: {download_error}")
-            await update.message.reply_text("⚠️ Görsel indirilemedi. Lütfen tekrar deneyin.")
-            return
-
-        logger.info(f"Photo bytes downloaded: {len(photo_bytes)} bytes")
-
         # Comprehensive caption handling with extensive logging
         caption = update.message.caption
         logger.info(f"Original caption: {caption}")
@@ -1036,6 +3964,60 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
         caption = str(caption).strip()
         logger.info(f"Final processed caption: {caption}")
 
+        async def save_and_send_analysis(response_text):
+            # Cached and fresh analyses leave the same exchange in memory
+            user_memory.add_message(user_id, "user", f"[Image] {caption}")
+            user_memory.add_message(user_id, "assistant", response_text)
+
+            # Uzun mesajları böl ve gönder
+            await split_and_send_message(update, response_text)
+
+        async def reply_with_cached_analysis(response_text, how):
+            logger.info(f"Image analysis served from cache ({how}) for user {user_id}")
+            await save_and_send_analysis(response_text)
+
+        # Same Telegram file, same question: answer before downloading anything
+        cached_analysis = image_analysis_cache.get_by_file(photo.file_unique_id, update.message.caption, user_lang)
+        if cached_analysis is not None:
+            await reply_with_cached_analysis(cached_analysis, "file id")
+            return
+
+        # Download photo
+        try:
+            download_started = time.monotonic()
+            photo_file = await context.bot.get_file(photo.file_id)
+            photo_bytes = bytes(await photo_file.download_as_bytearray())
+            download_seconds = time.monotonic() - download_started
+        except Exception as download_error:
+            logger.error(f"Photo download error: {download_error}")
+            await update.message.reply_text("⚠️ Görsel indirilemedi. Lütfen tekrar deneyin.")
+            return
+
+        logger.info(f"Photo bytes downloaded: {len(photo_bytes)} bytes ({photo.width}x{photo.height})")
+
+        # Forwarded or re-uploaded copies have new file ids but the same pixels
+        try:
+            image_hash = await asyncio.to_thread(image_dhash, photo_bytes)
+        except Exception as hash_error:
+            logger.warning(f"Image hashing failed: {hash_error}")
+            image_hash = None
+        if image_hash is not None:
+            cached_analysis = image_analysis_cache.get_similar(photo.file_unique_id, image_hash, update.message.caption, user_lang, user_id)
+            if cached_analysis is not None:
+                await reply_with_cached_analysis(cached_analysis, "perceptual hash")
+                return
+
+        # Downscale and recompress off the event loop; the original bytes still work if this fails
+        preprocess_started = time.monotonic()
+        try:
+            image_bytes, image_size = await asyncio.to_thread(preprocess_image, photo_bytes)
+            logger.info(f"Image prepared for upload: {image_size[0]}x{image_size[1]}, {len(image_bytes)} bytes")
+        except Exception as preprocess_error:
+            logger.warning(f"Image preprocessing failed, uploading the original: {preprocess_error}")
+            image_bytes = photo_bytes
+        record_image_savings(largest_photo.file_size or len(photo_bytes), len(photo_bytes), len(image_bytes),
+                             download_seconds, time.monotonic() - preprocess_started)
+
         # Create a context-aware prompt that includes language preference
         personality_context = get_time_aware_personality(
             datetime.now(),
@@ -1070,10 +4052,9 @@ Kullanıcının isteği (varsa): {caption}"""
 
         try:
             # Prepare the message with both text and image
-            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-            response = await model.generate_content_async([
+            response = await gemini_models.generate("image", [
                 analysis_prompt,
-                {"mime_type": "image/jpeg", "data": photo_bytes}
+                {"mime_type": "image/jpeg", "data": image_bytes}
             ])
 
             # **Yeni Kontrol: Yanıt Engellenmiş mi? (Resim)**
@@ -1086,15 +4067,15 @@ Kullanıcının isteği (varsa): {caption}"""
                 response_text = response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
 
                 # Add culturally appropriate emojis
-                response_text = add_emojis_to_text(response_text)
+                response_text = await add_emojis_to_text(response_text)
+                image_analysis_cache.put(photo.file_unique_id, image_hash, update.message.caption, user_lang, response_text, user_id)
 
-                # Save the interaction
-                user_memory.add_message(user_id, "user", f"[Image] {caption}")
-                user_memory.add_message(user_id, "assistant", response_text)
-
-                # Uzun mesajları böl ve gönder
-                await split_and_send_message(update, response_text)
+                # Save the interaction and reply
+                await save_and_send_analysis(response_text)
 
+        except GeminiUnavailable as unavailable_error:
+            logger.error(f"Gemini unavailable, sending degraded reply: {unavailable_error}")
+            await update.message.reply_text(get_error_message('service_unavailable', user_lang))
         except Exception as processing_error:
             logger.error(f"Görsel işleme hatası: {processing_error}", exc_info=True)
             error_message = get_error_message('ai_error', user_lang)
@@ -1108,6 +4089,8 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ... (same as before)
     user_id = str(update.effective_user.id)
 
+    start_deadline(TURN_DEADLINE)
+
     try:
         # Enhanced logging for debugging
         logger.info(f"Starting video processing for user {user_id}")
@@ -1136,9 +4119,33 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("⚠️ Video bulunamadı. Lütfen tekrar deneyin.")
             return
 
-        video_file = await context.bot.get_file(video.file_id)
-        video_bytes = bytes(await video_file.download_as_bytearray())
-        logger.info(f"Video bytes downloaded: {len(video_bytes)} bytes")
+        if video.file_size and video.file_size > VIDEO_MAX_BYTES:
+            logger.warning(f"Video too large: {video.file_size} bytes")
+            await update.message.reply_text(f"⚠️ Video çok büyük. En fazla {VIDEO_MAX_BYTES // (1024 * 1024)} MB boyutunda video gönderebilirsin.")
+            return
+
+        # Download to a temp file and hand it to the File API; the video is never held whole in memory
+        try:
+            async with video_jobs:
+                rss_before = peak_rss_mb()
+                ingest_started = time.monotonic()
+                video_file = await context.bot.get_file(video.file_id)
+                with await download_to_tempfile(video_file) as video_tmp:
+                    video_size = video_tmp.seek(0, io.SEEK_END)
+                    video_tmp.seek(0)
+                    uploaded_video = await video_uploader.upload(video_tmp, video.mime_type or "video/mp4")
+                rss_after = peak_rss_mb()
+        except VideoTooLarge as size_error:
+            logger.warning(f"Video rejected: {size_error}")
+            await update.message.reply_text(f"⚠️ Video çok büyük. En fazla {VIDEO_MAX_BYTES // (1024 * 1024)} MB boyutunda video gönderebilirsin.")
+            return
+        except Exception as ingest_error:
+            logger.error(f"Video download/upload error: {ingest_error}", exc_info=True)
+            await update.message.reply_text("⚠️ Video işlenemedi. Lütfen tekrar deneyin.")
+            return
+
+        rss_note = f", peak RSS {rss_after:.0f} MB (+{rss_after - rss_before:.0f} MB during this video)" if rss_after is not None else ""
+        logger.info(f"Video ingested: {video_size} bytes in {time.monotonic() - ingest_started:.2f}s{rss_note}")
 
         # Comprehensive caption handling with extensive logging
         caption = update.message.caption
@@ -1190,11 +4197,7 @@ Kullanıcının isteği (varsa): {caption}"""
 
         try:
             # Prepare the message with both text and video
-            model = genai.GenerativeModel('gemini-2.0-flash-lite')
-            response = await model.generate_content_async([
-                analysis_prompt,
-                {"mime_type": "video/mp4", "data": video_bytes}
-            ])
+            response = await gemini_models.generate("video", [analysis_prompt, uploaded_video])
 
             # **Yeni Kontrol: Yanıt Engellenmiş mi? (Video)**
             if response.prompt_feedback and response.prompt_feedback.block_reason:
@@ -1206,7 +4209,7 @@ Kullanıcının isteği (varsa): {caption}"""
                 response_text = response.text if hasattr(response, 'text') else response.candidates[0].content.parts[0].text
 
                 # Add culturally appropriate emojis
-                response_text = add_emojis_to_text(response_text)
+                response_text = await add_emojis_to_text(response_text)
 
                 # Save the interaction
                 user_memory.add_message(user_id, "user", f"[Video] {caption}")
@@ -1215,10 +4218,15 @@ Kullanıcının isteği (varsa): {caption}"""
                 # Uzun mesajları böl ve gönder
                 await split_and_send_message(update, response_text)
 
+        except GeminiUnavailable as unavailable_error:
+            logger.error(f"Gemini unavailable, sending degraded reply: {unavailable_error}")
+            await update.message.reply_text(get_error_message('service_unavailable', user_lang))
         except Exception as processing_error:
             logger.error(f"Video processing error: {processing_error}", exc_info=True)
             error_message = get_error_message('ai_error', user_lang)
             await update.message.reply_text(error_message)
+        finally:
+            await video_uploader.delete(uploaded_video)
 
 
     except Exception as e:
@@ -1234,41 +4242,188 @@ async def handle_memory_error(update: Update):
     error_message = "Üzgünüm, bellek sınırına ulaşıldı. Lütfen biraz bekleyip tekrar dener misin? 🙏"
     await update.message.reply_text(error_message)
 
-# Emoji adding function (same as before)
-def add_emojis_to_text(text):
-    # ... (same as before)
-    try:
-        # Use Gemini to suggest relevant emojis
-        emoji_model = genai.GenerativeModel('gemini-2.0-flash-lite')
-
-        # Prompt Gemini to suggest emojis based on text context
-        emoji_prompt = f"""
-        Analyze the following text and suggest the most appropriate and minimal emoji(s) that capture its essence:
-
-        Text: "{text}"
-
-        Guidelines:
-        - Suggest only 0-1 emojis
-        - Choose emojis that truly represent the text's mood or main topic
-        - If no emoji fits, return an empty string
+# Emoji adding function
+# Local lexicon: CLDR emoji name -> keyword stems in the languages the bot speaks.
+# Stems match whole words or words with a short suffix ("kahve" -> "kahvesi"); stems of 4 letters
+# or fewer only match whole words. Leave out function words and stems that mean something else in
+# another supported language ("para" is money in Turkish but "for" in Spanish and Portuguese).
+EMOJI_LEXICON = {
+    ':hot_beverage:': ['coffee', 'kahve', 'café', 'cafe', 'kaffee', 'caffè', 'tea', 'çay', 'tee', 'thé', 'espresso'],
+    ':pizza:': ['pizza'],
+    ':hamburger:': ['burger', 'hamburger', 'fastfood'],
+    ':sushi:': ['sushi'],
+    ':red_apple:': ['fruit', 'meyve', 'apple', 'elma', 'fruta', 'fruits', 'obst', 'frutta', 'diet', 'diyet'],
+    ':wine_glass:': ['wine', 'şarap', 'vino', 'vin', 'wein', 'vinho'],
+    ':birthday_cake:': ['birthday', 'doğum günü', 'doğumgün', 'cumpleaños', 'anniversaire', 'geburtstag', 'compleanno', 'aniversário', 'cake', 'kuchen', 'gâteau'],
+    ':party_popper:': ['congrat', 'tebrik', 'kutlar', 'felicidades', 'félicitations', 'glückwunsch', 'congratulazioni', 'parabéns', 'celebrat', 'party', 'fiesta', 'fête'],
+    ':musical_notes:': ['music', 'müzik', 'song', 'şarkı', 'música', 'musique', 'musik', 'musica', 'canción', 'chanson', 'canzone', 'melod'],
+    ':soccer_ball:': ['football', 'futbol', 'soccer', 'fútbol', 'fußball', 'calcio', 'futebol', 'maç', 'goal', 'gol'],
+    ':video_game:': ['game', 'games', 'oyun', 'gaming', 'juego', 'jeu', 'spiel', 'gioco', 'jogo', 'playstation', 'xbox', 'nintendo'],
+    ':movie_camera:': ['movie', 'film', 'cinema', 'sinema', 'película', 'cinéma', 'kino', 'filme'],
+    ':television:': ['series', 'serie', 'série', 'netflix', 'episode'],
+    ':camera:': ['photo', 'fotoğraf', 'foto', 'picture', 'resim', 'görsel', 'image', 'bild', 'imagen'],
+    ':books:': ['book', 'books', 'kitap', 'libro', 'livre', 'buch', 'reading', 'okuma', 'novel', 'library', 'kütüphane'],
+    ':graduation_cap:': ['school', 'okul', 'exam', 'sınav', 'university', 'üniversite', 'student', 'öğrenci', 'escuela', 'école', 'schule', 'scuola', 'escola', 'examen', 'prüfung', 'esame', 'lesson', 'ders'],
+    ':briefcase:': ['work', 'iş yeri', 'office', 'ofis', 'job', 'meeting', 'toplantı', 'trabajo', 'travail', 'arbeit', 'lavoro', 'trabalho', 'career', 'kariyer'],
+    ':laptop:': ['computer', 'bilgisayar', 'laptop', 'software', 'yazılım', 'code', 'kod', 'program', 'python', 'javascript', 'ordenador', 'ordinateur', 'computador'],
+    ':robot:': ['robot', 'yapay zeka', 'artificial intelligence', 'protogen', 'android', 'künstliche', 'intelligenza'],
+    ':mobile_phone:': ['phone', 'telefon', 'smartphone', 'iphone', 'teléfono', 'téléphone', 'telefono'],
+    ':gear:': ['settings', 'ayar', 'config', 'setup', 'kurulum', 'install'],
+    ':rocket:': ['rocket', 'roket', 'space', 'uzay', 'nasa', 'launch', 'espacio', 'espace', 'weltraum', 'spazio', 'startup'],
+    ':telescope:': ['astronom', 'planet', 'gezegen', 'galaxy', 'galaksi', 'yıldız', 'telescope', 'teleskop', 'universe', 'evren'],
+    ':test_tube:': ['science', 'bilim', 'experiment', 'deney', 'chemistry', 'kimya', 'ciencia', 'wissenschaft', 'scienza', 'ciência', 'laborat'],
+    ':dna:': ['dna', 'genetik', 'genetic', 'biology', 'biyoloji', 'cell', 'hücre'],
+    ':stethoscope:': ['doctor', 'doktor', 'health', 'sağlık', 'hastane', 'hospital', 'médico', 'médecin', 'arzt', 'medico', 'salud', 'santé', 'gesundheit', 'salute', 'saúde'],
+    ':pill:': ['medicine', 'ilaç', 'pill', 'medicamento', 'médicament', 'medikament', 'medicina'],
+    ':chart_increasing:': ['stock', 'borsa', 'market', 'piyasa', 'econom', 'ekonomi', 'invest', 'yatırım', 'bitcoin', 'crypto', 'kripto', 'inflation', 'enflasyon', 'dolar', 'dollar', 'euro'],
+    ':money_bag:': ['money', 'salary', 'maaş', 'dinero', 'argent', 'geld', 'soldi', 'dinheiro', 'price', 'fiyat', 'precio', 'prix', 'preis', 'prezzo', 'preço'],
+    ':shopping_cart:': ['shopping', 'alışveriş', 'buy', 'satın', 'compra', 'achat', 'einkauf', 'acquist'],
+    ':airplane:': ['travel', 'seyahat', 'flight', 'uçak', 'uçuş', 'tatil', 'vacation', 'viaje', 'voyage', 'reise', 'viaggio', 'viagem', 'airport', 'havaliman'],
+    ':beach_with_umbrella:': ['beach', 'plaj', 'sahil', 'deniz', 'playa', 'plage', 'strand', 'spiaggia', 'praia', 'summer', 'yaz tatili'],
+    ':automobile:': ['cars', 'araba', 'otomobil', 'driving', 'coche', 'voiture', 'auto', 'carro', 'traffic', 'trafik'],
+    ':house:': ['home', 'house', 'ev', 'casa', 'maison', 'haus', 'apartment', 'daire'],
+    ':globe_showing_Europe-Africa:': ['world', 'dünya', 'country', 'ülke', 'global', 'mundo', 'monde', 'welt', 'mondo', 'history', 'geography', 'coğrafya'],
+    ':sun:': ['sunny', 'güneş', 'güneşli', 'soleil', 'sonne', 'hot weather', 'sıcak'],
+    ':cloud_with_rain:': ['rain', 'yağmur', 'lluvia', 'pluie', 'regen', 'pioggia', 'chuva', 'storm', 'fırtına'],
+    ':snowflake:': ['snow', 'kar yağışı', 'winter', 'kış', 'nieve', 'neige', 'schnee', 'neve', 'cold', 'soğuk'],
+    ':crescent_moon:': ['night', 'gece', 'noche', 'nuit', 'nacht', 'notte', 'noite', 'moon', 'ay ışığı'],
+    ':sleeping_face:': ['sleep', 'uyku', 'uyu', 'tired', 'yorgun', 'dormir', 'schlaf', 'dormire', 'sleepy'],
+    ':dog_face:': ['dog', 'köpek', 'puppy', 'perro', 'chien', 'hund', 'cane', 'cachorro'],
+    ':cat_face:': ['cat', 'kedi', 'kitten', 'gato', 'katze', 'gatto'],
+    ':seedling:': ['plant', 'bitki', 'garden', 'bahçe', 'nature', 'doğa', 'tree', 'ağaç', 'naturaleza', 'nature', 'natur', 'natura', 'climate', 'iklim'],
+    ':artist_palette:': ['artist', 'artwork', 'sanat', 'paint', 'resim yap', 'draw', 'çiz', 'arte', 'kunst', 'design', 'tasarım'],
+    ':newspaper:': ['news', 'haberler', 'gündem', 'noticia', 'nouvelles', 'nachricht', 'notizie', 'notícia', 'journal'],
+    ':shield:': ['security', 'güvenlik', 'privacy', 'gizlilik', 'password', 'şifre', 'seguridad', 'sécurité', 'sicherheit', 'sicurezza', 'segurança'],
+    ':key:': ['anahtar', 'login', 'giriş yap'],
+    ':light_bulb:': ['idea', 'fikir', 'tips', 'ipucu', 'öneri', 'suggest', 'idée', 'idee', 'ideia', 'tavsiye', 'advice'],
+    ':magnifying_glass_tilted_left:': ['search', 'arama', 'araştır', 'research', 'búsqueda', 'recherche', 'suche', 'ricerca', 'pesquisa'],
+    ':bullseye:': ['goal', 'hedef', 'target', 'amaç', 'objetivo', 'objectif', 'ziel', 'obiettivo'],
+    ':flexed_biceps:': ['gym', 'spor', 'sport', 'workout', 'antrenman', 'fitness', 'exercise', 'egzersiz', 'deporte', 'training'],
+    ':waving_hand:': ['hello', 'merhaba', 'selam', 'hola', 'bonjour', 'hallo', 'ciao', 'olá', 'goodbye', 'güle güle', 'hoşça kal', 'adiós', 'au revoir', 'tschüss'],
+    ':folded_hands:': ['thank', 'teşekkür', 'sağol', 'gracias', 'merci', 'danke', 'grazie', 'obrigad', 'please', 'lütfen', 'por favor'],
+    ':warning:': ['warning', 'uyarı', 'dikkat', 'danger', 'tehlike', 'caution', 'advertencia', 'attention', 'achtung', 'attenzione', 'atenção'],
+    ':hourglass_done:': ['wait', 'bekle', 'deadline', 'süre', 'attendre', 'warten', 'aspetta'],
+    ':red_heart:': ['love', 'sevgi', 'seviyorum', 'aşk', 'amor', 'amour', 'liebe', 'amore', 'heart', 'kalp'],
+}
+
+# Sentiment stems used when no topic keyword matches
+POSITIVE_STEMS = ['great', 'happy', 'glad', 'awesome', 'wonderful', 'excellent', 'amazing', 'nice', 'good', 'fun',
+                  'harika', 'mutlu', 'sevin', 'güzel', 'süper', 'mükemmel', 'iyi', 'eğlen',
+                  'feliz', 'genial', 'bueno', 'heureux', 'génial', 'super', 'glücklich', 'toll', 'felice', 'ottimo', 'ótimo']
+NEGATIVE_STEMS = ['sad', 'sorry', 'unfortunat', 'problem', 'error', 'failed', 'failure', 'bad', 'terrible',
+                  'üzgün', 'üzül', 'maalesef', 'sorun', 'hata', 'kötü', 'ne yazık',
+                  'triste', 'lo siento', 'désolé', 'malheureuse', 'traurig', 'leider', 'purtroppo', 'infelizmente']
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+EMOJI_SCAN_CHARS = 2000
+
+def _build_emoji_index():
+    """Map every keyword stem (single words and phrases) to its emoji."""
+    index = {}
+    for name, keywords in EMOJI_LEXICON.items():
+        symbol = emoji.emojize(name)
+        if not emoji.is_emoji(symbol):
+            logger.warning(f"Unknown emoji name in lexicon: {name}")
+            continue
+        for keyword in keywords:
+            index.setdefault(keyword.casefold(), []).append(symbol)
+    for stem in POSITIVE_STEMS:
+        index.setdefault(stem.casefold(), []).append(+1)
+    for stem in NEGATIVE_STEMS:
+        index.setdefault(stem.casefold(), []).append(-1)
+    return index
+
+EMOJI_INDEX = _build_emoji_index()
+EMOJI_MAX_PHRASE_WORDS = max(len(stem.split()) for stem in EMOJI_INDEX)
+
+def _stem_matches(word, stem_length):
+    # Short stems must match exactly ("gene" is not "general"); longer ones may carry a suffix ("kitaplar")
+    if stem_length <= 4:
+        return stem_length == len(word)
+    return len(word) - stem_length <= (3 if stem_length < 6 else 6)
+
+def suggest_emoji_locally(text):
+    """Pick 0-1 emoji for text from keyword and sentiment scores. Pure CPU, no I/O."""
+    # The topic of a reply is almost always set in its opening; cap the work for long answers
+    words = WORD_PATTERN.findall(text[:EMOJI_SCAN_CHARS].casefold())
+    topic_scores, first_seen, sentiment = {}, {}, 0
+    for position, word in enumerate(words):
+        candidates = []
+        for length in range(min(3, len(word)), len(word) + 1):
+            hits = EMOJI_INDEX.get(word[:length])
+            if hits and _stem_matches(word, length):
+                candidates.extend(hits)
+        # Multi-word keywords ("doğum günü", "yapay zeka")
+        for span in range(2, EMOJI_MAX_PHRASE_WORDS + 1):
+            if position + span <= len(words):
+                candidates.extend(EMOJI_INDEX.get(" ".join(words[position:position + span]), ()))
+        for candidate in candidates:
+            if isinstance(candidate, int):
+                sentiment += candidate
+            else:
+                topic_scores[candidate] = topic_scores.get(candidate, 0) + 1
+                first_seen.setdefault(candidate, position)
+
+    if topic_scores:
+        # Most mentioned topic; ties go to the one mentioned first
+        return max(topic_scores, key=lambda symbol: (topic_scores[symbol], -first_seen[symbol]))
+    if sentiment > 0:
+        return emoji.emojize(':smiling_face_with_smiling_eyes:')
+    if sentiment < 0:
+        return emoji.emojize(':pensive_face:')
+    return ""
+
+def _ends_with_emoji(text):
+    tail = text.rstrip()[-8:]
+    return bool(tail) and any(item['match_end'] == len(tail) for item in emoji.emoji_list(tail))
+
+async def suggest_emoji_with_gemini(text):
+    """Optional LLM mode (EMOJI_MODE=llm). Async with a short timeout; never blocks the loop."""
+    # Prompt Gemini to suggest emojis based on text context
+    emoji_prompt = f"""
+    Analyze the following text and suggest the most appropriate and minimal emoji(s) that capture its essence:
+
+    Text: "{text}"
+
+    Guidelines:
+    - Suggest only 0-1 emojis
+    - Choose emojis that truly represent the text's mood or main topic
+    - If no emoji fits, return an empty string
+
+    Response format: Just the emoji or empty string
+    """
 
-        Response format: Just the emoji or empty string
-        """
+    emoji_response = await gemini_models.generate_text("emoji", emoji_prompt)
+    # **Yeni Kontrol: Yanıt Engellenmiş mi? (Emoji)**
+    if emoji_response is None:
+        logger.warning("Emoji suggestion blocked.") # Sadece logla, emoji eklemeyi atla
+        return ""
+    suggested_emoji = emoji_response.strip()
+    # Only accept an actual emoji, not a sentence
+    return suggested_emoji if suggested_emoji and emoji.purely_emoji(suggested_emoji) else ""
+
+async def add_emojis_to_text(text):
+    """Append a context-relevant emoji using the local lexicon (or Gemini in EMOJI_MODE=llm)."""
+    try:
+        if not text or EMOJI_MODE == "off" or _ends_with_emoji(text):
+            return text
 
-        emoji_response = emoji_model.generate_content(emoji_prompt)
-        # **Yeni Kontrol: Yanıt Engellenmiş mi? (Emoji)**
-        if emoji_response.prompt_feedback and emoji_response.prompt_feedback.block_reason:
-            logger.warning("Emoji suggestion blocked.") # Sadece logla, emoji eklemeyi atla
-            return text # Emoji eklemeyi atla ve orijinal metni döndür
+        suggested_emoji = ""
+        if EMOJI_MODE == "llm":
+            try:
+                suggested_emoji = await suggest_emoji_with_gemini(text)
+            except Exception as e:
+                logger.warning(f"LLM emoji suggestion failed, using local lexicon: {e}")
+                suggested_emoji = suggest_emoji_locally(text)
         else:
-            suggested_emoji = emoji_response.text.strip()
+            suggested_emoji = suggest_emoji_locally(text)
 
-            # If no emoji suggested, return original text
-            if not suggested_emoji:
-                return text
+        # If no emoji suggested, return original text
+        if not suggested_emoji:
+            return text
 
-            # Add emoji at the end
-            return f"{text} {suggested_emoji}"
+        # Add emoji at the end
+        return f"{text} {suggested_emoji}"
     except Exception as e:
         logger.error(f"Error adding context-relevant emojis: {e}")
         return text  # Return original text if emoji addition fails
@@ -1329,9 +4484,38 @@ def get_analysis_prompt(media_type, caption, lang):
     # Fallback to default prompt
     return prompts['default'].get(lang, prompts['default']['en'])
 
+async def post_init(application: Application):
+    # Start background jobs once the event loop is running
+    user_memory.start_background_flush()
+    await gemini_models.warmup()
+
+async def post_shutdown(application: Application):
+    # Persist pending user memory before the process exits
+    await user_memory.close()
+    logger.info(f"Search cache: {web_search_backend.cache.report()}")
+    web_search_backend.close()
+    logger.info(f"HTTP pool: {http_client.pool_stats()}")
+    await http_client.close()
+    logger.info(f"Page fetch HTTP pool: {page_http_client.pool_stats()}")
+    await page_http_client.close()
+    logger.info(f"Classifier cache: {gemini_models.cache.report()}")
+    logger.info(f"Gemini scheduler: {gemini_models.scheduler.report()}")
+    logger.info(f"Image preprocessing: {image_stats}")
+    logger.info(f"Image analysis cache: {image_analysis_cache.report()}")
+    logger.info(f"Gemini resilience: {gemini_models.stats}, circuit {gemini_models.breaker.state} {gemini_models.breaker.stats}")
+    logger.info(f"Language detection tiers: {language_detection_report()}")
+
 def main():
     # Initialize bot
-    application = Application.builder().token(os.getenv("TELEGRAM_TOKEN")).build()
+    application = (
+        Application.builder()
+        .token(os.getenv("TELEGRAM_TOKEN"))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .rate_limiter(OutboundRateLimiter())
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .build()
+    )
 
     # Add command handler for /derinarama
     application.add_handler(CommandHandler("derinarama", handle_message)) # handle_message will now check for /derinarama
@@ -1345,5 +4529,9 @@ def main():
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate-memory':
+        # python bot.py migrate-memory [db_path]: import user_memories/ into SQLite
+        migrate_memory_directory(db_path=sys.argv[2] if len(sys.argv) > 2 else None)
+        sys.exit(0)
     user_memory = UserMemory()
     main()
\ No newline at end of file
@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+# bot.py opens bot_logs.log in the working directory on import; keep it out of the repo
+os.chdir(tempfile.mkdtemp(prefix="nyxie-tests-"))
+
+
+@pytest.fixture
+def local_server():
+    """Start a threaded HTTP server on 127.0.0.1. `routes` maps a path to
+    (status, headers, body) or to a callable(handler) returning that tuple.
+    Yields a function that starts the server and returns its base URL."""
+    servers = []
+
+    def start(routes):
+        class Handler(BaseHTTPRequestHandler):
+            requested = []
+
+            def do_GET(self):
+                Handler.requested.append(self.path)
+                route = routes.get(self.path.split('?')[0])
+                if route is None:
+                    self.send_error(404)
+                    return
+                status, headers, body = route(self) if callable(route) else route
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        start.requested = Handler.requested
+        return f"http://127.0.0.1:{server.server_port}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,41 @@
+import pytest
+
+import bot
+
+
+# Ordinary replies full of function words and look-alikes ("para", "general", "ready", "car", "Art")
+NEUTRAL_REPLIES = {
+    'en': "Sure, here is a general overview. Are you ready? Let me explain the main steps in a simple way, starting with the Roman numerals.",
+    'tr': "Genel olarak bu konuda şunu söyleyebilirim: önce adımları sırayla takip et, sonra sonucu tarih sırasına göre kontrol et.",
+    'es': "Para empezar, necesitas revisar la configuración general del sistema. Esto es para que todo funcione como esperas y esté listo.",
+    'pt': "Para isso, você pode usar a opção geral do menu. Isso serve para deixar tudo pronto para a próxima etapa, sem complicação.",
+    'fr': "J'ai regardé ta question, car elle est intéressante. Il est parti tôt, mais voici une réponse générale et claire.",
+    'de': "Diese Art von Frage ist häufig. Ich erkläre dir kurz den allgemeinen Ablauf, damit du ihn Schritt für Schritt nachvollziehen kannst.",
+    'it': "Per rispondere alla tua domanda, ecco una spiegazione generale. Da solo non basta, quindi vediamo insieme i passaggi.",
+    'ru': "Вот общее объяснение: сначала проверь настройки, затем повтори шаги по порядку.",
+    'ja': "一般的な説明をします。まず設定を確認し、次に手順を順番に繰り返してください。",
+    'ko': "일반적인 설명입니다. 먼저 설정을 확인한 다음 단계를 순서대로 반복하세요.",
+    'zh': "这是一个一般性的说明。先检查设置，然后按顺序重复这些步骤。",
+}
+
+
+@pytest.mark.parametrize("lang", sorted(NEUTRAL_REPLIES))
+def test_unrelated_words_get_no_emoji(lang):
+    assert bot.suggest_emoji_locally(NEUTRAL_REPLIES[lang]) == ""
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Necesito dinero para el viaje de trabajo, el dinero no alcanza", ":money_bag:"),
+    ("Bu kitap çok güzel, diğer kitaplar da öyle", ":books:"),
+    ("Ich trinke gern Kaffee am Morgen", ":hot_beverage:"),
+    ("The stock market rose again today", ":chart_increasing:"),
+    ("Genetik araştırmalar hızla ilerliyor", ":dna:"),
+])
+def test_topic_words_still_match(text, expected):
+    assert bot.suggest_emoji_locally(text) == bot.emoji.emojize(expected)
+
+
+def test_short_stems_only_match_whole_words():
+    assert not bot._stem_matches("general", 4)
+    assert bot._stem_matches("gene", 4)
+    assert bot._stem_matches("kitaplar", 5)
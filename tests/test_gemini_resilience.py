@@ -0,0 +1,134 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import bot
+
+
+class FakeModel:
+    """Plays back a script of (outcome, latency) pairs: "ok", "503" or "400"."""
+    def __init__(self, script, default=("ok", 0)):
+        self.script = list(script)
+        self.default = default
+        self.calls = 0
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.calls += 1
+        outcome, latency = self.script.pop(0) if self.script else self.default
+        await asyncio.sleep(latency)
+        if outcome == "503":
+            raise google_exceptions.ServiceUnavailable("unavailable")
+        if outcome == "400":
+            raise google_exceptions.InvalidArgument("bad request")
+        return SimpleNamespace(text=f"answer {self.calls}", usage_metadata=None)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(bot, "GEMINI_RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(bot, "GEMINI_BREAKER_MIN_TIMEOUT", 0.2)
+
+
+def make_registry(script, default=("ok", 0), threshold=3, cooldown=0.2, tasks=None):
+    registry = bot.ModelRegistry(tasks or {
+        "chat": {"model": "fake", "timeout": None, "priority": bot.PRIORITY_INTERACTIVE},
+        "long": {"model": "fake", "timeout": 0.3, "priority": bot.PRIORITY_INTERACTIVE},
+        "classifier": {"model": "fake", "timeout": 0.1, "priority": bot.PRIORITY_CLASSIFIER, "hedge": True},
+    })
+    model = FakeModel(script, default)
+    registry.get = lambda task: model
+    registry.scheduler = bot.GeminiScheduler(rpm=60000, tpm=10 ** 9)
+    registry.breaker = bot.CircuitBreaker(threshold=threshold, cooldown=cooldown)
+    return registry, model
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_transient_errors_are_retried():
+    registry, model = make_registry([("503", 0), ("503", 0)])
+    response = run(registry.generate("chat", "hi"))
+    assert response.text == "answer 3"
+    assert registry.stats["retries"] == 2
+    assert registry.breaker.state == "closed"
+
+
+def test_non_transient_errors_are_not_retried_and_keep_circuit_closed():
+    registry, model = make_registry([("400", 0)] * 10)
+    for _ in range(5):
+        with pytest.raises(google_exceptions.InvalidArgument):
+            run(registry.generate("chat", "hi"))
+    assert model.calls == 5
+    assert registry.breaker.state == "closed"
+
+
+def test_turn_deadline_bounds_the_call():
+    registry, _ = make_registry([("ok", 5)])
+
+    async def turn():
+        bot.start_deadline(0.2)
+        await registry.generate("chat", "hi")
+
+    started = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        run(turn())
+    assert time.monotonic() - started < 1
+
+
+def test_deadline_timeouts_do_not_open_the_circuit():
+    registry, _ = make_registry([], default=("ok", 5), threshold=2)
+
+    async def tight_turn():
+        bot.start_deadline(0.05)
+        await registry.generate("long", "hi")
+
+    for _ in range(5):
+        with pytest.raises(asyncio.TimeoutError):
+            run(tight_turn())
+    assert registry.breaker.state == "closed"
+    assert registry.stats["uncounted_timeouts"] == 5
+
+
+def test_short_classifier_timeouts_do_not_open_the_circuit():
+    registry, _ = make_registry([], default=("ok", 5), threshold=2)
+    for _ in range(3):
+        with pytest.raises(asyncio.TimeoutError):
+            run(registry.generate("classifier", "hi"))
+    assert registry.breaker.state == "closed"
+
+
+def test_full_budget_timeouts_of_long_tasks_count():
+    registry, _ = make_registry([], default=("ok", 5), threshold=2)
+    with pytest.raises(bot.GeminiUnavailable):
+        run(registry.generate("long", "hi"))
+    assert registry.breaker.state == "open"
+
+
+def test_circuit_opens_fails_fast_and_recovers():
+    registry, model = make_registry([], default=("503", 0), threshold=3, cooldown=0.2)
+    with pytest.raises(bot.GeminiUnavailable):
+        run(registry.generate("chat", "hi"))
+    assert model.calls == 3
+    with pytest.raises(bot.GeminiUnavailable):
+        run(registry.generate("chat", "hi"))
+    assert model.calls == 3  # failed fast, nothing sent
+    assert registry.breaker.stats["fast_failures"] == 1
+
+    time.sleep(0.25)
+    model.default = ("ok", 0)
+    assert run(registry.generate("chat", "hi")).text == "answer 4"
+    assert registry.breaker.state == "closed"
+
+
+def test_hedged_call_returns_the_faster_duplicate(monkeypatch):
+    monkeypatch.setattr(bot, "GEMINI_HEDGE_AFTER", 0.02)
+    registry, model = make_registry([("ok", 0.09), ("ok", 0)])
+    started = time.monotonic()
+    response = run(registry.generate("classifier", "hi"))
+    assert response.text == "answer 2"
+    assert time.monotonic() - started < 0.08
+    assert registry.stats["hedged"] == 1 and registry.stats["hedge_wins"] == 1
@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import bot
+
+
+def test_requests_go_through_the_caching_dns_backend(local_server):
+    base = local_server({
+        "/ok": (200, {"Content-Type": "text/plain"}, b"hello"),
+        "/moved": (302, {"Location": "/ok"}, b""),
+    })
+    pool = bot.HttpClientPool()
+
+    async def run():
+        try:
+            results = [await pool.get(base.replace("127.0.0.1", "localhost") + "/moved") for _ in range(3)]
+            async with pool.stream(base + "/ok"):
+                return results, pool.pool_stats()
+        finally:
+            await pool.close()
+
+    results, stats = asyncio.run(run())
+    assert [(r.status_code, r.content) for r in results] == [(200, b"hello")] * 3
+    assert stats["dns_misses"] == 1 and stats["dns_hits"] >= 2
+    assert stats["connections"] == 1 and stats["active_connections"] == 1
+
+
+def test_read_timeout_is_an_httpx_exception(local_server):
+    def slow(handler):
+        time.sleep(0.5)
+        return 200, {}, b"late"
+    base = local_server({"/slow": slow})
+    pool = bot.HttpClientPool()
+
+    async def run():
+        try:
+            await pool.get(base + "/slow", timeout=0.1)
+        finally:
+            await pool.close()
+
+    with pytest.raises(httpx.TimeoutException):
+        asyncio.run(run())
+
+
+def test_host_limiters_are_bounded_and_keep_busy_hosts(monkeypatch):
+    monkeypatch.setattr(bot, "HTTP_MAX_TRACKED_HOSTS", 8)
+    pool = bot.HttpClientPool(max_per_host=1)
+
+    async def run():
+        busy = pool._host_limiter("busy.example")
+        busy.users += 1
+        await busy.semaphore.acquire()
+        for i in range(100):
+            pool._host_limiter(f"host{i}.example")
+        assert len(pool._hosts) == 8
+        assert pool._hosts["busy.example"] is busy  # a held slot is never forgotten
+        assert "host99.example" in pool._hosts and "host0.example" not in pool._hosts
+
+    asyncio.run(run())
+
+
+def test_dns_cache_is_bounded():
+    backend = bot.CachingDnsBackend(max_entries=4)
+
+    async def run():
+        for port in range(8000, 8010):
+            await backend.resolve("localhost", port)
+        await backend.resolve("localhost", 8009)
+
+    asyncio.run(run())
+    assert list(backend._cache) == [("localhost", port) for port in range(8006, 8010)]
+    assert backend.hits == 1 and backend.misses == 10
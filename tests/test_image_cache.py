@@ -0,0 +1,119 @@
+import asyncio
+import io
+from types import SimpleNamespace
+
+from PIL import Image, ImageDraw
+
+import bot
+
+
+def make_photo(seed=0, size=(1600, 1200)):
+    """Deterministic photo-like picture: a fractal background with a few shapes."""
+    img = Image.effect_mandelbrot(size, (-2.0 + seed * 0.3, -1.2, 1.0 + seed * 0.3, 1.2), 60).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for i in range(6):
+        left = (seed * 97 + i * 211) % (size[0] - 300)
+        top = (seed * 53 + i * 137) % (size[1] - 300)
+        draw.ellipse((left, top, left + 250, top + 180), fill=((i * 40) % 256, 120, (seed * 70) % 256))
+    return img
+
+
+def jpeg(img, quality=90, max_side=None):
+    if max_side:
+        img = img.copy()
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality)
+    return out.getvalue()
+
+
+def test_reencoded_copies_stay_within_radius():
+    original = make_photo()
+    source = bot.image_dhash(jpeg(original, 95))
+    for quality, max_side in [(87, 1280), (70, 800), (50, 320), (40, 640)]:
+        copy = bot.image_dhash(jpeg(original, quality, max_side))
+        assert bin(source ^ copy).count('1') <= bot.IMAGE_CACHE_MAX_DISTANCE
+    unrelated = bot.image_dhash(jpeg(make_photo(seed=3), 95))
+    assert bin(source ^ unrelated).count('1') > bot.IMAGE_CACHE_SAME_USER_DISTANCE
+
+
+def test_wider_radius_only_applies_to_the_same_user():
+    cache = bot.ImageAnalysisCache(max_distance=4, same_user_distance=12)
+    cache.put("a", 0, None, "tr", "analiz", user_id="1")
+    near = (1 << 8) - 1  # 8 bits away
+    assert cache.get_similar("b", near, None, "tr", user_id="2") is None
+    assert cache.get_similar("c", near, None, "tr", user_id="1") == "analiz"
+    assert cache.get_similar("d", 0b111, None, "tr", user_id="2") == "analiz"
+
+
+def test_evicted_scopes_are_dropped():
+    cache = bot.ImageAnalysisCache(max_entries=3)
+    for i in range(100):
+        cache.put(f"file{i}", i, f"caption {i}", "tr", "analiz")
+    assert len(cache._trees) == 3
+    assert len(cache._scope_sizes) == 3 and not cache._stale_scopes
+    # Scopes whose entries all expire go with their last entry
+    cache.put("x", 1, "caption 99", "tr", "analiz")
+    for entry_id in list(cache._entries):
+        scope, image_hash, text, _, user_id = cache._entries[entry_id]
+        cache._entries[entry_id] = (scope, image_hash, text, 0, user_id)
+    cache.put("y", 2, "other", "tr", "analiz")
+    assert cache.get_similar("z", 1, "caption 99", "tr") is None
+    assert list(cache._trees) == [bot.ImageAnalysisCache._scope("other", "tr")]
+
+
+class Message:
+    caption = None
+
+    def __init__(self, file_unique_id, data):
+        self.photo = [SimpleNamespace(file_id=file_unique_id, file_unique_id=file_unique_id,
+                                      width=1280, height=960, file_size=len(data))]
+        self.replies = []
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+
+
+def test_cache_hit_saves_the_same_memory_entry(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    original = make_photo()
+    files = {"first": jpeg(original, 90, 1280), "forwarded": jpeg(original, 60, 800)}
+    calls = []
+
+    async def generate(task, contents, **kwargs):
+        calls.append(task)
+        return SimpleNamespace(prompt_feedback=None, text="analiz")
+
+    async def add_emojis(text):
+        return text
+
+    async def send(update, text):
+        update.message.replies.append(text)
+
+    async def get_file(file_id):
+        async def download_as_bytearray():
+            return bytearray(files[file_id])
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    monkeypatch.setattr(bot, "image_analysis_cache", bot.ImageAnalysisCache())
+    monkeypatch.setattr(bot.gemini_models, "generate", generate)
+    monkeypatch.setattr(bot, "add_emojis_to_text", add_emojis)
+    monkeypatch.setattr(bot, "split_and_send_message", send)
+    monkeypatch.setattr(bot, "user_memory", bot.UserMemory(), raising=False)
+    context = SimpleNamespace(bot=SimpleNamespace(get_file=get_file))
+
+    async def run():
+        updates = [SimpleNamespace(message=Message(file_id, data), effective_user=SimpleNamespace(id=user))
+                   for user, (file_id, data) in enumerate(files.items())]
+        for update in updates:
+            await bot.handle_image(update, context)
+        histories = [[(m["role"], m["content"]) for m in bot.user_memory.get_user_settings(str(user))["messages"]]
+                     for user in range(len(updates))]
+        await bot.user_memory.close()
+        return updates, histories
+
+    updates, (fresh, cached) = asyncio.run(run())
+    assert calls == ["image"]  # the forwarded copy was answered from the cache
+    assert all(update.message.replies == ["analiz"] for update in updates)
+    assert fresh == cached
+    assert fresh[0][1].startswith("[Image] ") and fresh[0][1] != "[Image]"
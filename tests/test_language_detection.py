@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    user_memory = bot.UserMemory()
+    monkeypatch.setattr(bot, "user_memory", user_memory, raising=False)
+    user_memory.update_user_settings("1", {'language': 'tr', 'language_streak': 0})
+    # Local tiers can't decide, so the Gemini tier is asked
+    monkeypatch.setattr(bot, "detect_language_with_langdetect", lambda text: (None, 0.0))
+    yield user_memory
+    asyncio.run(user_memory.close())
+
+
+@pytest.mark.parametrize("error", [bot.GeminiUnavailable("circuit open"), asyncio.TimeoutError()])
+def test_gemini_outage_keeps_the_users_language(memory, monkeypatch, error):
+    async def generate_text(task, prompt):
+        raise error
+    monkeypatch.setattr(bot.gemini_models, "generate_text", generate_text)
+
+    detected = asyncio.run(bot.detect_and_set_user_language("bunu bir daha anlatir misin lutfen", "1"))
+    assert detected == 'tr'
+    settings = memory.get_user_settings("1")
+    assert settings['language'] == 'tr' and settings['language_streak'] == 0
+
+
+def test_gemini_answer_is_saved(memory, monkeypatch):
+    async def generate_text(task, prompt):
+        return "de"
+    monkeypatch.setattr(bot.gemini_models, "generate_text", generate_text)
+
+    assert asyncio.run(bot.detect_and_set_user_language("kannst du das bitte noch einmal erklaren", "1")) == 'de'
+    assert memory.get_user_settings("1")['language'] == 'de'
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import bot
+
+
+def _run_session(messages):
+    async def session():
+        memory = bot.UserMemory(storage_mode="log")
+        for text in messages:
+            memory.add_message("42", "user", text)
+        await memory.close()
+    asyncio.run(session())
+
+
+def _stored_contents(log_path):
+    contents = []
+    for line in log_path.read_text(encoding="utf-8").splitlines():
+        try:
+            contents.append(json.loads(line).get("content"))
+        except json.JSONDecodeError:
+            contents.append(None)
+    return contents
+
+
+def test_append_after_torn_tail_keeps_every_record(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _run_session(["before-crash"])
+    log_path = tmp_path / "user_memories" / "user_42.log"
+    # Simulate a crash in the middle of an append
+    with open(log_path, "ab") as f:
+        f.write(b'{"role": "user", "content": "torn')
+
+    _run_session(["after-restart-1", "after-restart-2"])
+    _run_session([])
+
+    contents = _stored_contents(log_path)
+    assert None not in contents
+    assert contents[-3:] == ["before-crash", "after-restart-1", "after-restart-2"]
+
+
+def test_append_adds_missing_newline(tmp_path):
+    backend = bot.LogMemoryBackend(tmp_path)
+    log_path = backend.get_user_log_path("7")
+    log_path.write_bytes(b'{"role": "user", "content": "a"}\n{"role": "us')
+    backend.write({"user_id": "7", "dropped": 0, "appended": [{"role": "user", "content": "b"}]})
+
+    messages, start, records, corrupt = backend._read_log(log_path)
+    assert [msg["content"] for msg in messages[start:]] == ["a", "b"]
+    assert corrupt == 1
+    assert backend.load("7")["rewrite"] is True
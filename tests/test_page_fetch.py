@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import bot
+
+
+HTML = {"Content-Type": "text/html; charset=utf-8"}
+
+
+def test_public_only_pool_refuses_private_addresses(local_server):
+    base = local_server({"/": (200, HTML, b"<p>internal</p>")})
+    pool = bot.HttpClientPool(public_only=True)
+
+    async def fetch(url):
+        try:
+            return await pool.get(url)
+        finally:
+            await pool.close()
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(fetch(base + "/"))
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(fetch(base.replace("127.0.0.1", "localhost") + "/"))
+
+
+def test_redirect_to_private_address_is_not_followed(local_server):
+    routes = {
+        "/secret": (200, HTML, b"<html><body><p>" + b"instance metadata " * 20 + b"</p></body></html>"),
+        "/page": (200, HTML, b"<html><body><p>" + b"public article text " * 20 + b"</p></body></html>"),
+    }
+    base = local_server(routes)
+    private_base = base.replace("127.0.0.1", "localhost")
+    routes["/start"] = (302, {"Location": private_base + "/secret"}, b"")
+    routes["/hop"] = (302, {"Location": "/page"}, b"")
+
+    # Treat 127.0.0.1 as the "public" host and localhost as an internal one
+    pool = bot.HttpClientPool()
+    fetcher = bot.PageFetcher(client=pool, host_interval=0)
+
+    async def is_public(url):
+        return bot.urlsplit(url).hostname == "127.0.0.1"
+    fetcher._is_public = is_public
+
+    async def run():
+        try:
+            return await fetcher.fetch_passages([base + "/start", base + "/hop"], budget=5)
+        finally:
+            await pool.close()
+
+    passages = asyncio.run(run())
+    text = " ".join(passage["text"] for passage in passages)
+    assert "metadata" not in text
+    assert "public article text" in text
+    assert "/secret" not in local_server.requested
+
+
+def test_redirect_hops_are_limited(local_server):
+    routes = {f"/r{i}": (302, {"Location": f"/r{i + 1}"}, b"") for i in range(10)}
+    routes["/r10"] = (200, HTML, b"<p>" + b"end of the chain " * 20 + b"</p>")
+    base = local_server(routes)
+    pool = bot.HttpClientPool()
+    fetcher = bot.PageFetcher(client=pool, host_interval=0, allow_private=True)
+
+    async def run():
+        try:
+            return await fetcher.fetch_passages([base + "/r0"], budget=5)
+        finally:
+            await pool.close()
+
+    assert asyncio.run(run()) == []
+    assert len(local_server.requested) == bot.PAGE_FETCH_MAX_REDIRECTS + 1
+
+
+def test_concurrent_fetchers_share_per_host_spacing(local_server):
+    times = []
+
+    def page(handler):
+        times.append(time.monotonic())
+        return 200, HTML, b"<p>" + b"some article text " * 20 + b"</p>"
+    base = local_server({"/a": page, "/b": page})
+    pool = bot.HttpClientPool()
+
+    async def run():
+        try:
+            # Two deep searches each build their own fetcher over the shared client
+            fetchers = [bot.PageFetcher(client=pool, host_interval=0.3, allow_private=True) for _ in range(2)]
+            await asyncio.gather(fetchers[0].fetch_passages([base + "/a"]), fetchers[1].fetch_passages([base + "/b"]))
+        finally:
+            await pool.close()
+
+    asyncio.run(run())
+    assert len(times) == 2 and times[1] - times[0] >= 0.25
+
+
+def test_host_pacer_is_bounded():
+    pacer = bot.HostPacer(max_hosts=8)
+
+    async def run():
+        for i in range(100):
+            async with pacer.turn(f"host{i}.example", 0):
+                pass
+
+    asyncio.run(run())
+    assert len(pacer) == 8
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from telegram.error import BadRequest, RetryAfter
+
+import bot
+
+
+CHUNKS = [f"Parça {i} hakkında birkaç kelime daha. " for i in range(20)]
+CHUNK_DELAY = 0.05  # fake model: 20 chunks over about a second
+
+
+class FakeStream:
+    """Async chunk stream shaped like a streaming Gemini response."""
+    def __init__(self, chunks=CHUNKS, delay=CHUNK_DELAY):
+        self.chunks = chunks
+        self.delay = delay
+
+    async def __aiter__(self):
+        for text in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield SimpleNamespace(prompt_feedback=None, text=text)
+
+
+class SentMessage:
+    def __init__(self, chat, text):
+        self.chat = chat
+        self.text = text
+
+    async def edit_text(self, text):
+        await self.chat.maybe_fail("edit")
+        self.text = text
+
+
+class Chat:
+    """Stand-in for update.message; records when each message first became visible."""
+    def __init__(self, failures=()):
+        self.started = time.monotonic()
+        self.messages = []
+        self.first_visible = None
+        self.failures = list(failures)  # (operation, exception) raised once, in order
+
+    async def maybe_fail(self, operation):
+        if self.failures and self.failures[0][0] == operation:
+            raise self.failures.pop(0)[1]
+
+    async def reply_text(self, text):
+        await self.maybe_fail("send")
+        if self.first_visible is None:
+            self.first_visible = time.monotonic() - self.started
+        self.messages.append(SentMessage(self, text))
+        return self.messages[-1]
+
+    @property
+    def shown(self):
+        return [message.text for message in self.messages]
+
+
+def test_streaming_shows_the_first_chunk_long_before_the_buffered_path():
+    async def streamed():
+        chat = Chat()
+        streamer = bot.StreamingReply(chat, edit_interval=0.2)
+        await bot.stream_response(FakeStream(), streamer)
+        await streamer.finish()
+        return chat
+
+    async def buffered():
+        chat = Chat()
+        text = "".join([chunk.text async for chunk in FakeStream()])
+        await bot.split_and_send_message(SimpleNamespace(message=chat), text)
+        return chat
+
+    streamed_chat = asyncio.run(streamed())
+    buffered_chat = asyncio.run(buffered())
+    full_text = "".join(CHUNKS).rstrip()
+    assert streamed_chat.shown == buffered_chat.shown == [full_text]
+    total = CHUNK_DELAY * len(CHUNKS)
+    assert streamed_chat.first_visible < 3 * CHUNK_DELAY
+    assert buffered_chat.first_visible >= 0.9 * total
+    print(f"first visible: streamed {streamed_chat.first_visible:.3f}s, buffered {buffered_chat.first_visible:.3f}s")
+
+
+def test_telegram_errors_mid_stream_do_not_drop_the_answer(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_FINISH_ATTEMPTS", 2)
+    chat = Chat(failures=[
+        ("send", RetryAfter(0)),
+        ("edit", BadRequest("Message is not modified")),
+        ("edit", BadRequest("Bad Request: message can't be edited")),
+    ])
+
+    async def run():
+        streamer = bot.StreamingReply(chat, edit_interval=0)
+        await bot.stream_response(FakeStream(delay=0), streamer)
+        await streamer.finish("".join(CHUNKS) + "🙂")
+
+    asyncio.run(run())
+    assert chat.shown == ["".join(CHUNKS) + "🙂"]
+
+
+def test_persistent_edit_failures_send_the_rest_as_new_messages(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_FINISH_ATTEMPTS", 2)
+
+    class BrokenEdits(Chat):
+        async def maybe_fail(self, operation):
+            if operation == "edit":
+                raise BadRequest("Bad Request: message can't be edited")
+
+    chat = BrokenEdits()
+
+    async def run():
+        streamer = bot.StreamingReply(chat, edit_interval=0)
+        await bot.stream_response(FakeStream(delay=0), streamer)
+        await streamer.finish()
+
+    asyncio.run(run())
+    assert chat.shown[0] == CHUNKS[0].rstrip()
+    assert " ".join(chat.shown) == "".join(CHUNKS).rstrip()
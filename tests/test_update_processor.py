@@ -0,0 +1,92 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+
+import bot
+
+
+def make_update(update_id, user_id, seq):
+    user = User(id=user_id, first_name=f"user{user_id}", is_bot=False)
+    message = Message(message_id=update_id, date=datetime.now(timezone.utc),
+                      chat=Chat(id=user_id, type="private"), from_user=user, text=f"{user_id}-{seq}")
+    return Update(update_id=update_id, message=message)
+
+
+def drive(processor, users, per_user, work):
+    """Feed interleaved updates the way Application does: one task per update, in arrival order."""
+    events = []
+    durations = []
+    running = {"now": 0, "peak": 0}
+
+    async def handle(user_id, seq, duration):
+        running["now"] += 1
+        running["peak"] = max(running["peak"], running["now"])
+        events.append(("start", user_id, seq, time.monotonic()))
+        durations.append(duration)
+        await asyncio.sleep(duration)
+        events.append(("end", user_id, seq, time.monotonic()))
+        running["now"] -= 1
+
+    async def run():
+        rng = random.Random(0)
+        tasks = []
+        update_id = 0
+        for seq in range(per_user):
+            for user_id in range(1, users + 1):
+                update_id += 1
+                update = make_update(update_id, user_id, seq)
+                tasks.append(asyncio.create_task(processor.process_update(update, handle(user_id, seq, work(rng)))))
+        started = time.monotonic()
+        await asyncio.gather(*tasks)
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(run())
+    return events, running["peak"], elapsed, sum(durations)
+
+
+def test_per_user_order_is_kept_while_users_run_concurrently():
+    users, per_user = 8, 10
+    processor = bot.PerUserUpdateProcessor(max_concurrent_updates=16)
+    events, peak, elapsed, serial_time = drive(processor, users, per_user, lambda rng: rng.uniform(0.005, 0.03))
+
+    for user_id in range(1, users + 1):
+        own = [(kind, seq) for kind, uid, seq, _ in events if uid == user_id]
+        # Strictly one at a time and in arrival order: start 0, end 0, start 1, end 1, ...
+        assert own == [(kind, seq) for seq in range(per_user) for kind in ("start", "end")]
+
+    assert peak == users
+    assert elapsed < serial_time / 3
+    assert processor.stats["processed"] == users * per_user
+    assert processor.stats["queued_behind_same_user"] > 0
+    assert not processor._user_locks
+
+
+def test_concurrency_limit_is_respected():
+    processor = bot.PerUserUpdateProcessor(max_concurrent_updates=3)
+    _, peak, _, _ = drive(processor, users=10, per_user=3, work=lambda rng: 0.01)
+    assert peak == 3
+    assert processor.stats["peak_running"] == 3
+
+
+def test_busy_user_does_not_starve_others():
+    processor = bot.PerUserUpdateProcessor(max_concurrent_updates=2)
+    finished = {}
+
+    async def handle(user_id, seq):
+        await asyncio.sleep(0.02)
+        finished[(user_id, seq)] = time.monotonic()
+
+    async def run():
+        started = time.monotonic()
+        # User 1 sends a burst of 20 updates, then user 2 sends one
+        tasks = [asyncio.create_task(processor.process_update(make_update(i, 1, i), handle(1, i))) for i in range(20)]
+        tasks.append(asyncio.create_task(processor.process_update(make_update(99, 2, 0), handle(2, 0))))
+        await asyncio.gather(*tasks)
+        return started
+
+    started = asyncio.run(run())
+    # User 2 runs alongside user 1's backlog instead of after it
+    assert finished[(2, 0)] - started < 0.1
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import bot
+
+
+VIDEO = os.urandom(3 * 1024 * 1024)
+
+
+class LocalUploader:
+    """Stand-in for the Gemini File API: reads the upload in chunks like the resumable uploader."""
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self.uploads = []
+        self.deleted = []
+
+    async def upload(self, fileobj, mime_type):
+        # genai.upload_file treats anything that isn't io.IOBase as a path
+        assert isinstance(fileobj, io.IOBase)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        digest = hashlib.sha256()
+
+        def read():
+            while chunk := fileobj.read(1 << 20):
+                digest.update(chunk)
+        await asyncio.to_thread(read)
+        await asyncio.sleep(0.05)
+        self.active -= 1
+        uploaded = SimpleNamespace(name=f"files/{len(self.uploads)}", mime_type=mime_type, digest=digest.hexdigest())
+        self.uploads.append(uploaded)
+        return uploaded
+
+    async def delete(self, uploaded):
+        self.deleted.append(uploaded.name)
+
+
+class Message:
+    caption = None
+
+    def __init__(self, size):
+        self.video = SimpleNamespace(file_id="video", file_size=size, mime_type="video/mp4")
+        self.replies = []
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+
+
+@pytest.fixture
+def video_url(local_server):
+    base = local_server({"/video.mp4": (200, {"Content-Type": "video/mp4"}, VIDEO)})
+    return base + "/video.mp4"
+
+
+def test_download_streams_to_a_real_file(video_url):
+    async def run():
+        with await bot.download_to_tempfile(SimpleNamespace(file_path=video_url)) as video_tmp:
+            assert isinstance(video_tmp, io.IOBase)
+            return video_tmp.read()
+    assert asyncio.run(run()) == VIDEO
+
+
+def test_download_enforces_size_cap(video_url):
+    async def run():
+        await bot.download_to_tempfile(SimpleNamespace(file_path=video_url), max_bytes=len(VIDEO) - 1)
+    with pytest.raises(bot.VideoTooLarge):
+        asyncio.run(run())
+
+
+def test_handle_video_uploads_file_and_bounds_concurrency(video_url, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    uploader = LocalUploader()
+    prompts = []
+
+    async def generate(task, contents, **kwargs):
+        prompts.append(contents)
+        return SimpleNamespace(prompt_feedback=None, text="analiz")
+
+    async def send(update, text):
+        update.message.replies.append(text)
+
+    async def get_file(file_id):
+        return SimpleNamespace(file_path=video_url)
+
+    monkeypatch.setattr(bot, "video_uploader", uploader)
+    monkeypatch.setattr(bot.gemini_models, "generate", generate)
+    monkeypatch.setattr(bot, "split_and_send_message", send)
+    monkeypatch.setattr(bot, "user_memory", bot.UserMemory(), raising=False)
+    context = SimpleNamespace(bot=SimpleNamespace(get_file=get_file))
+
+    monkeypatch.setattr(bot, "video_jobs", asyncio.Semaphore(2))
+
+    async def run():
+        updates = [SimpleNamespace(message=Message(len(VIDEO)), effective_user=SimpleNamespace(id=i)) for i in range(5)]
+        await asyncio.gather(*(bot.handle_video(update, context) for update in updates))
+        await bot.user_memory.close()
+        return updates
+
+    updates = asyncio.run(run())
+    expected = hashlib.sha256(VIDEO).hexdigest()
+    assert [uploaded.digest for uploaded in uploader.uploads] == [expected] * 5
+    assert uploader.peak == 2
+    assert all(isinstance(contents[1], SimpleNamespace) for contents in prompts)  # file reference, not inline bytes
+    assert sorted(uploader.deleted) == sorted(uploaded.name for uploaded in uploader.uploads)
+    assert all(update.message.replies == ["analiz"] for update in updates)
+
+
+def test_handle_video_rejects_oversized_before_download(monkeypatch):
+    async def get_file(file_id):
+        raise AssertionError("oversized video should not be downloaded")
+
+    monkeypatch.setattr(bot, "user_memory", bot.UserMemory(), raising=False)
+    message = Message(bot.VIDEO_MAX_BYTES + 1)
+    update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=1))
+    asyncio.run(bot.handle_video(update, SimpleNamespace(bot=SimpleNamespace(get_file=get_file))))
+    assert len(message.replies) == 1 and "⚠️" in message.replies[0]
+
+
+def test_download_errors_do_not_leak_the_bot_token(local_server, caplog):
+    base = local_server({})
+    url = base + "/file/bot123456:AAE-secret_token/videos/file_1.mp4"
+
+    async def run():
+        await bot.download_to_tempfile(SimpleNamespace(file_path=url))
+
+    with caplog.at_level(logging.DEBUG):
+        with pytest.raises(httpx.HTTPError) as raised:
+            asyncio.run(run())
+    assert "404" in str(raised.value)
+    assert "secret_token" not in str(raised.value) and "/bot<token>/" in str(raised.value)
+    assert raised.value.__cause__ is None and raised.value.__suppress_context__
+    assert "secret_token" not in caplog.text  # httpx's own request log stays quiet below WARNING
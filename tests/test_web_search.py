@@ -0,0 +1,71 @@
+import asyncio
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import bot
+
+
+SERVER_LATENCY = 0.3
+
+
+def fake_results_page(handler):
+    time.sleep(SERVER_LATENCY)
+    query = parse_qs(urlsplit(handler.path).query)["q"][0]
+    results = "".join(
+        f'<div class="g"><a href="https://example.com/{query}/{i}"><h3>{query} {i}</h3></a>'
+        f'<div class="VwiC3b">snippet {i} for {query}</div></div>'
+        for i in range(3)
+    )
+    return 200, {"Content-Type": "text/html; charset=utf-8"}, f"<html><body>{results}</body></html>".encode()
+
+
+def test_concurrent_searches_keep_event_loop_responsive(local_server, monkeypatch):
+    base = local_server({"/search": fake_results_page})
+    monkeypatch.setattr(bot, "http_client", bot.HttpClientPool(max_per_host=50))
+    backend = bot.WebSearchBackend(max_concurrency=50, fallback_url=base + "/search", ddg_enabled=False)
+    queries = [f"query{i}" for i in range(50)]
+
+    async def run():
+        lags = []
+        stop = asyncio.Event()
+
+        async def ticker():
+            # How late does a 10 ms sleep wake up while the searches run?
+            while not stop.is_set():
+                started = time.monotonic()
+                await asyncio.sleep(0.01)
+                lags.append(time.monotonic() - started - 0.01)
+
+        ticker_task = asyncio.create_task(ticker())
+        started = time.monotonic()
+        results = await backend.search_many(queries, max_results=3)
+        elapsed = time.monotonic() - started
+        stop.set()
+        await ticker_task
+        await bot.http_client.close()
+        backend.close()
+        return results, elapsed, max(lags)
+
+    results, elapsed, max_lag = asyncio.run(run())
+    assert len(results) == 150
+    assert [result["title"] for result in results[::3]] == [f"{query} 0" for query in queries]
+    # Sequentially this would take 50 * SERVER_LATENCY = 15 s
+    assert elapsed < 10 * SERVER_LATENCY
+    assert max_lag < 0.1
+
+
+def test_repeated_query_is_served_from_cache(local_server, monkeypatch):
+    base = local_server({"/search": fake_results_page})
+    monkeypatch.setattr(bot, "http_client", bot.HttpClientPool())
+    backend = bot.WebSearchBackend(fallback_url=base + "/search", ddg_enabled=False)
+
+    async def run():
+        first = await backend.search("Python  asyncio")
+        second = await backend.search("python asyncio")
+        await bot.http_client.close()
+        backend.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second and len(first) == 3
+    assert len(local_server.requested) == 1